@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# The wrapper and its tools are scripts at the top of the repository, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uhc_wrapper  # noqa: E402
+
+
+@pytest.fixture
+def settings():
+    # Just what the config must contain, with nothing written anywhere
+    return uhc_wrapper.validate_config({
+        'java': 'java', 'jar': 'minecraft_server.jar', 'x': 0, 'z': 0, 'minutemarker': 10, 'playersperteam': 3,
+        'revealnames': 20, 'timeout': 5, 'ops': ['Brianetta'],
+        'teamnames': ['Glossy Bears', 'Nosy Moles', 'Witty Salamanders', 'Overjoyed Donkeys'],
+        'eternal': {'mode': 'day', 'timebegin': 40},
+        'worldborder': {'duration': 40, 'finish': 160, 'start': 1520, 'timebegin': 40},
+    })
+
+
+@pytest.fixture
+def wrapper(settings, tmp_path):
+    # A wrapper of its own for each test, so that none of them sees what another left behind
+    instance = uhc_wrapper.engine(settings)
+    instance.directory = str(tmp_path)
+    return instance
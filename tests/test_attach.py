@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def received():
+    return []
+
+
+@pytest.fixture
+def tail(wrapper, tmp_path, received):
+    # Follows latest.log, as attach mode does, keeping whatever it reads
+    path = os.path.join(tmp_path, 'latest.log')
+    with open(path, 'w') as log:
+        log.write('dealt with before attaching\n')
+    tail = wrapper.LogTail(path, received.append)
+    tail.open(from_start=False)
+    return tail
+
+
+def append(path, text):
+    with open(path, 'a') as log:
+        log.write(text)
+
+
+def test_tail_reads_what_is_added(tail, received):
+    append(tail.path, 'one\n')
+    tail.read()
+    append(tail.path, 'two\n')
+    tail.read()
+    assert b''.join(received) == b'one\ntwo\n'
+
+
+def test_tail_follows_a_rotated_log(tail, received):
+    append(tail.path, 'last of the old log\n')
+    os.rename(tail.path, tail.path + '.1')
+    append(tail.path, 'first of the new log\n')
+    tail.read()
+    assert b''.join(received) == b'last of the old log\nfirst of the new log\n'
+    append(tail.path, 'more\n')
+    tail.read()
+    assert b''.join(received).endswith(b'first of the new log\nmore\n')
+
+
+def test_tail_starts_again_on_a_truncated_log(tail, received):
+    append(tail.path, 'a long line, to be cut off by the truncation\n')
+    tail.read()
+    with open(tail.path, 'w') as log:
+        log.write('short\n')
+    tail.read()
+    assert b''.join(received).endswith(b'truncation\nshort\n')
+
+
+def test_tail_waits_for_a_log_that_is_not_there_yet(wrapper, tmp_path):
+    chunks = []
+    tail = wrapper.LogTail(os.path.join(tmp_path, 'latest.log'), chunks.append)
+    tail.open(from_start=False)
+    tail.read()
+    append(tail.path, 'at last\n')
+    tail.read()
+    assert chunks == [b'at last\n']
+
+
+def test_tail_is_woken_by_the_loop(tail, wrapper, received):
+    wrapper.loop = asyncio.new_event_loop()
+
+    async def arrived():
+        tail.start()
+        append(tail.path, 'woken\n')
+        while b''.join(received) != b'woken\n':
+            await asyncio.sleep(0.01)
+    try:
+        wrapper.loop.run_until_complete(asyncio.wait_for(arrived(), 5))
+    finally:
+        wrapper.loop.close()
+
+
+def test_pipe_that_is_missing_is_not_created(wrapper, tmp_path):
+    path = os.path.join(tmp_path, 'uhc_commands')
+    with pytest.raises(OSError):
+        wrapper.PipeTransport(path).send('say hello')
+    assert not os.path.exists(path)
+
+
+def test_pipe_that_is_a_file_is_refused(wrapper, tmp_path):
+    path = os.path.join(tmp_path, 'uhc_commands')
+    open(path, 'w').close()
+    with pytest.raises(ConnectionError):
+        wrapper.PipeTransport(path).send('say hello')
+    assert os.path.getsize(path) == 0
+
+
+def test_pipe_delivers_commands(wrapper, tmp_path):
+    path = os.path.join(tmp_path, 'uhc_commands')
+    os.mkfifo(path)
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(open(path)))
+    reader.start()
+    pipe = wrapper.PipeTransport(path)
+    pipe.send('say hello')
+    pipe.send('say goodbye')
+    pipe.handle.close()
+    reader.join(5)
+    assert received == ['say hello\n', 'say goodbye\n']
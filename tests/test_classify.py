@@ -0,0 +1,39 @@
+import pytest
+
+import uhc_wrapper
+from uhc_wrapper import BorderReport, ChatCommand, Death, Join, LagWarning, Leave, Other
+
+
+@pytest.mark.parametrize('line, event', [
+    ('<Bob> !help me', ChatCommand('Bob', 'help', 'me')),
+    ('<Bob> !begin', ChatCommand('Bob', 'begin', '')),
+    ('Bob[/1.2.3.4:5000] logged in with entity id 3 at (0.5, 64.0, 0.5)', Join('Bob', '1.2.3.4')),
+    ('Bob lost connection: Disconnected', Leave('Bob')),
+    ('World border is currently 1520 blocks wide', BorderReport('World border is currently 1520 blocks wide')),
+    ("Can't keep up! Did the system time change, or is the server overloaded? Running 5000ms behind, "
+     'skipping 100 tick(s)', LagWarning(5000, 100)),
+    ('Bob fell from a high place', Death('Bob', None, None, 'fall')),
+])
+def test_classify(line, event):
+    assert uhc_wrapper.classify(line) == event
+
+
+@pytest.mark.parametrize('line', [
+    '',
+    'Done',
+    '<Bob> hello everybody',
+    'World border is currently being argued about',
+    "Saving chunks for level 'world'/Overworld",
+    'Bob said he logged in',
+])
+def test_classify_leaves_other_lines_alone(line):
+    assert uhc_wrapper.classify(line) == Other(line)
+
+
+@pytest.mark.parametrize('prefix', [
+    '[12:00:00] [Server thread/INFO]: ',  # Vanilla's
+    '[12:00:00 INFO]: ',  # Spigot's
+    '>[12:00:00] [Server thread/WARN]: ',  # After a console prompt
+])
+def test_split_prefix(prefix):
+    assert uhc_wrapper.split_prefix(prefix + '<Bob> !help') == (prefix, '<Bob> !help')
@@ -0,0 +1,90 @@
+import pytest
+
+
+@pytest.fixture
+def now(wrapper):
+    # A clock the test moves on
+    time = [1800000000.0]
+    wrapper.clock = lambda: time[0]
+    return time
+
+
+@pytest.fixture
+def said(wrapper, now):
+    # What the commands tell players
+    messages = []
+    wrapper.announce_gold = lambda name, *lines: messages.append((name,) + lines)
+    return messages
+
+
+@pytest.fixture
+def echo(wrapper):
+    # A command with no cooldown of its own, so only the player's bucket limits it
+    heard = []
+    wrapper.chat_command('echo', 'Say it back', arguments=('words',))(lambda name, args: heard.append(args[0]))
+    return heard
+
+
+def test_bucket_runs_out_and_refills(wrapper, now, echo):
+    for n in range(wrapper.player_burst + 3):
+        wrapper.handle_command('Bob', 'echo', str(n))
+    assert echo == [[str(n)] for n in range(wrapper.player_burst)]
+    assert wrapper.counters['chat_limited'] == 3
+    # A second tops up one token, and no more
+    now[0] += 1
+    wrapper.handle_command('Bob', 'echo', 'again')
+    wrapper.handle_command('Bob', 'echo', 'too soon')
+    assert echo[-1] == ['again'] and len(echo) == wrapper.player_burst + 1
+    # However long it waits, it never holds more than a burst
+    now[0] += 60
+    for n in range(wrapper.player_burst + 1):
+        wrapper.handle_command('Bob', 'echo', 'later')
+    assert echo.count(['later']) == wrapper.player_burst
+
+
+def test_each_player_has_their_own_bucket(wrapper, said, echo):
+    for n in range(wrapper.player_burst):
+        wrapper.handle_command('Bob', 'echo', 'bob')
+    wrapper.handle_command('Alice', 'echo', 'alice')
+    assert echo[-1] == ['alice']
+
+
+def test_cooldown_between_uses_of_one_command(wrapper, now, said):
+    wrapper.handle_command('Bob', 'utc', '')
+    wrapper.handle_command('Bob', 'utc', '')
+    assert said == [('Bob', 'Current UTC time: 08:00 (Friday)')]
+    wrapper.handle_command('Bob', 'time', '')
+    assert said[-1] == ('Bob', 'Game has not started yet')
+    now[0] += 2
+    wrapper.handle_command('Bob', 'utc', '')
+    assert len(said) == 3
+
+
+def test_op_commands_are_only_for_ops(wrapper, said):
+    wrapper.handle_command('Bob', 'x', '100')
+    assert wrapper.x == 0 and said == []
+    wrapper.handle_command('Brianetta', 'x', '100')
+    assert wrapper.x == 100 and said == [('Brianetta', 'X set to 100')]
+
+
+def test_ops_are_not_limited(wrapper, said):
+    for n in range(wrapper.player_burst * 4):
+        wrapper.handle_command('Brianetta', 'utc', '')
+    assert len(said) == wrapper.player_burst * 4
+    assert wrapper.counters['chat_limited'] == 0
+
+
+def test_unknown_commands_are_ignored(wrapper, said):
+    wrapper.handle_command('Bob', 'fly', '')
+    assert said == [] and wrapper.command_buckets == {}
+
+
+def test_usage_for_wrong_arguments(wrapper, said):
+    swapped = []
+    wrapper.swap_team_member = lambda first, second: swapped.append((first, second))
+    wrapper.handle_command('Brianetta', 'TeamSwap', 'Bob')
+    assert said == [('Brianetta', '!teamswap <player1> <player2>')]
+    wrapper.handle_command('Brianetta', 'minutes', 'ten')
+    assert said[-1] == ('Brianetta', '!minutes [number]')
+    wrapper.handle_command('Brianetta', 'teamswap', 'Bob Alice')
+    assert swapped == [('Bob', 'Alice')]
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+import uhc_wrapper
+
+
+######################
+# Config
+
+def test_validate_config_fills_in_defaults(settings):
+    assert settings['transport'] == 'console'
+    assert settings['commandrate'] == 100
+    assert settings['friends'] == []
+    assert settings['events'] == {'file': '', 'maxbytes': 10000000, 'keep': 5}
+
+
+def test_validate_config_keeps_given_settings_in_a_group(settings):
+    checked = uhc_wrapper.validate_config(dict(settings, events={'file': 'events.jsonl'}))
+    assert checked['events'] == {'file': 'events.jsonl', 'maxbytes': 10000000, 'keep': 5}
+
+
+def test_validate_config_says_what_is_missing():
+    with pytest.raises(ValueError) as error:
+        uhc_wrapper.validate_config({'java': 'java'})
+    assert 'config.jar is missing' in str(error.value)
+    assert 'config.java' not in str(error.value)
+
+
+@pytest.mark.parametrize('change, problem', [
+    ({'x': 'middle'}, 'config.x'),
+    ({'transport': 'carrier pigeon'}, 'config.transport'),
+    ({'worldborder': {'duration': 40, 'finish': 'small', 'start': 1520, 'timebegin': 40}}, 'config.worldborder.finish'),
+    ({'playersperteam': 0}, 'config.playersperteam should be at least 1'),
+    ({'timeout': -1}, 'config.timeout should not be negative'),
+    ({'teamnames': []}, 'config.teamnames should have at least one name'),
+])
+def test_validate_config_rejects_bad_settings(settings, change, problem):
+    with pytest.raises(ValueError) as error:
+        uhc_wrapper.validate_config(dict(settings, **change))
+    assert problem in str(error.value)
+
+
+def test_validate_config_rejects_what_is_not_settings():
+    with pytest.raises(ValueError):
+        uhc_wrapper.validate_config(['java'])
+
+
+def test_changed_settings_within_groups(settings):
+    edited = dict(settings, worldborder=dict(settings['worldborder'], duration=50), timeout=10)
+    assert uhc_wrapper.changed_settings(settings, edited) == [('timeout',), ('worldborder', 'duration')]
+    assert uhc_wrapper.changed_settings(settings, settings) == []
+
+
+@pytest.fixture
+def config_file(wrapper, settings, tmp_path):
+    import yaml
+    wrapper.configfile = os.path.join(tmp_path, 'uhc_wrapper.yml')
+
+    def write(**changes):
+        with open(wrapper.configfile, 'w') as config:
+            yaml.safe_dump(dict(settings, **changes), config)
+    write()
+    wrapper.config_loaded = wrapper.load_settings()
+    wrapper.log = lambda line: None
+    return write
+
+
+def test_reload_keeps_what_was_changed_in_game(wrapper, settings, config_file):
+    # !border finish 300, then duration edited in the file
+    wrapper.config['worldborder']['finish'] = 300
+    wrapper.timeout = 9
+    config_file(worldborder=dict(settings['worldborder'], duration=50))
+    wrapper.reload_config()
+    assert wrapper.config['worldborder'] == dict(settings['worldborder'], duration=50, finish=300)
+    assert wrapper.timeout == 9
+
+
+def test_reload_takes_what_was_changed_in_the_file(wrapper, settings, config_file):
+    wrapper.timeout = 9
+    config_file(timeout=20, ops=['Brianetta', 'Daniiiiii'])
+    wrapper.reload_config()
+    assert wrapper.timeout == 20
+    assert wrapper.ops == {'Brianetta', 'Daniiiiii'}
+    assert 'Daniiiiii' in wrapper.spectators
+
+
+def test_reload_ignores_a_broken_file(wrapper, settings, config_file):
+    config_file(timeout=-1)
+    wrapper.reload_config()
+    assert wrapper.timeout == settings['timeout']
@@ -0,0 +1,26 @@
+import pytest
+
+import uhc_wrapper
+from uhc_wrapper import Death
+
+
+@pytest.mark.parametrize('line, death', [
+    ('Player1 was slain by Player2', Death('Player1', 'Player2', None, 'mob')),
+    ('Player1 was slain by Player2 using Big Stick', Death('Player1', 'Player2', 'Big Stick', 'mob')),
+    ('Player1 was shot by Skeleton', Death('Player1', 'Skeleton', None, 'arrow')),
+    ('Player1 was blown up by Creeper', Death('Player1', 'Creeper', None, 'explosion')),
+    ('Player1 fell from a high place', Death('Player1', None, None, 'fall')),
+    ('Player1 drowned', Death('Player1', None, None, 'drown')),
+])
+def test_match_death(line, death):
+    assert uhc_wrapper.match_death(line) == death
+
+
+@pytest.mark.parametrize('line', [
+    'Player1 said hello',
+    'Player1 drowned quite a lot',
+    'Player1 was',
+    'Player1',
+])
+def test_match_death_ignores_other_lines(line):
+    assert uhc_wrapper.match_death(line) is None
@@ -0,0 +1,66 @@
+import pytest
+
+prefix = b'[12:00:00] [Server thread/INFO]: '
+
+
+@pytest.fixture
+def handled(wrapper):
+    # Lines the framer hands on to be handled
+    lines = []
+    wrapper.handle_line = lines.append
+    return lines
+
+
+@pytest.fixture
+def shown(wrapper):
+    # Bytes it only shows
+    data = []
+    wrapper.show_console = data.append
+    return data
+
+
+def test_line_split_across_reads(wrapper, handled):
+    wrapper.feed_console(prefix + b'<Bob> !he')
+    assert handled == []
+    wrapper.feed_console(b'lp\n' + prefix + b'<Bob> !time\n')
+    assert handled == [prefix.decode() + '<Bob> !help', prefix.decode() + '<Bob> !time']
+
+
+def test_line_without_a_newline_waits_until_flushed(wrapper, handled):
+    wrapper.feed_console(prefix + b'Bob fell from a high place\n' + prefix + b'<Bob> !help')
+    assert handled == [prefix.decode() + 'Bob fell from a high place']
+    wrapper.flush_console()
+    assert handled[1:] == [prefix.decode() + '<Bob> !help']
+    assert len(wrapper.console_buffer) == 0
+
+
+def test_carriage_returns_are_dropped(wrapper, handled):
+    wrapper.feed_console(prefix + b'<Bob> !help\r\n')
+    assert handled == [prefix.decode() + '<Bob> !help']
+
+
+def test_character_split_across_reads(wrapper, handled):
+    line = prefix + '<Zoë> !help'.encode()
+    wrapper.feed_console(line[:-8])  # Half way through the ë
+    wrapper.feed_console(line[-8:] + b'\n')
+    assert handled == [prefix.decode() + '<Zoë> !help']
+
+
+def test_uninteresting_lines_are_only_shown(wrapper, handled, shown):
+    chatter = prefix + b"Saving chunks for level 'world'/Overworld\n" + prefix + b'<Bob> hello\n'
+    wrapper.feed_console(chatter + prefix + b'<Bob> !help\n' + chatter)
+    assert handled == [prefix.decode() + '<Bob> !help']
+    assert b''.join(shown) == chatter + chatter
+
+
+def test_a_failing_line_is_logged_and_the_rest_handled_once(wrapper, handled):
+    def handle_line(line):
+        if 'boom' in line:
+            raise ValueError('boom')
+        handled.append(line)
+    wrapper.handle_line = handle_line
+    logged = []
+    wrapper.log = logged.append
+    wrapper.feed_console(prefix + b'<Bob> !help\n' + prefix + b'<Bob> !boom\n' + prefix + b'<Bob> !time\n')
+    assert handled == [prefix.decode() + '<Bob> !help', prefix.decode() + '<Bob> !time']
+    assert len(logged) == 1 and logged[0].startswith('Error handling ') and 'ValueError: boom' in logged[0]
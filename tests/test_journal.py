@@ -0,0 +1,142 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import uhc_wrapper
+
+
+def write_journal(path, records):
+    with open(path, 'w') as journal:
+        journal.write(''.join(json.dumps(record) + '\n' for record in records))
+
+
+def test_snapshot_replays_to_the_same_match(wrapper, settings):
+    wrapper.journal_path = 'unwritten'  # Records are queued, with no writer to take them
+    wrapper.time_start = 1000.0
+    wrapper.teams.update({0: 'Glossy Bears', 1: 'Nosy Moles'})
+    wrapper.join_team('Player1', 0)
+    wrapper.join_team('Player2', 1)
+    wrapper.dead_players.add('Player3')
+    wrapper.disconnected_players['Player2'] = 1100.0
+    wrapper.config['worldborder']['finish'] = 300
+    wrapper.journal_snapshot()
+    snapshot = json.loads(json.dumps(wrapper.journal_queue[-1]))
+
+    recovered = uhc_wrapper.engine(settings, 'uhc_recovered')
+    recovered.replay(snapshot)
+    assert recovered.time_start == 1000.0
+    assert recovered.teams == {0: 'Glossy Bears', 1: 'Nosy Moles'}
+    assert recovered.playerteams == {'Player1': 0, 'Player2': 1}
+    assert recovered.live_teams == {0, 1}
+    assert recovered.dead_players == {'Player3'}
+    assert recovered.disconnected_players == {'Player2': 1100.0}
+    assert recovered.config['worldborder']['finish'] == 300
+
+
+def test_recover_replays_the_journal_up_to_a_half_written_record(wrapper, tmp_path):
+    wrapper.config['journal'] = 'journal.jsonl'
+    records = [['teams', [[0, 'Glossy Bears'], [1, 'Nosy Moles']]], ['join', 'Player1', 0], ['join', 'Player2', 1],
+               ['join', 'Player3', 1], ['leave', 'Player3'], ['dead', 'Player3'], ['set', 'match_decided', True]]
+    write_journal(os.path.join(tmp_path, 'journal.jsonl'), records)
+    with open(os.path.join(tmp_path, 'journal.jsonl'), 'a') as journal:
+        journal.write('["join", "Player4", ')
+    wrapper.recover()
+    assert wrapper.teams == {0: 'Glossy Bears', 1: 'Nosy Moles'}
+    assert wrapper.playerteams == {'Player1': 0, 'Player2': 1}
+    assert wrapper.teammembers == {0: {'Player1'}, 1: {'Player2'}}
+    assert wrapper.dead_players == {'Player3'}
+    assert wrapper.match_decided is True
+    # And the journal carries on from there
+    assert wrapper.journal_path == os.path.join(tmp_path, 'journal.jsonl')
+
+
+def test_recover_without_a_journal_starts_afresh(wrapper, tmp_path):
+    wrapper.config['journal'] = 'journal.jsonl'
+    wrapper.recover()
+    assert wrapper.teams == {}
+    assert wrapper.time_start is None
+
+
+@pytest.fixture
+def logged(wrapper):
+    lines = []
+    wrapper.log = lines.append
+    return lines
+
+
+def test_recover_resumes_a_match_in_progress(wrapper, tmp_path, logged):
+    wrapper.config['journal'] = 'journal.jsonl'
+    wrapper.loop = asyncio.new_event_loop()
+    started = time.time() - 300
+    write_journal(os.path.join(tmp_path, 'journal.jsonl'),
+                  [['teams', [[0, 'Glossy Bears']]], ['join', 'Player1', 0], ['set', 'time_start', started]])
+    try:
+        wrapper.recover()
+        assert 'minutemarker' in wrapper.timers
+        assert wrapper.target_time > time.time()
+        assert logged[0].startswith('Recovered a match in progress')
+    finally:
+        wrapper.cancel_game_events()
+        wrapper.loop.close()
+
+
+def test_recover_leaves_a_finished_match_alone(wrapper, tmp_path, logged):
+    wrapper.config['journal'] = 'journal.jsonl'
+    wrapper.loop = asyncio.new_event_loop()
+    write_journal(os.path.join(tmp_path, 'journal.jsonl'),
+                  [['teams', [[0, 'Glossy Bears']]], ['join', 'Player1', 0], ['set', 'time_start', time.time() - 3000],
+                   ['set', 'match_decided', True]])
+    try:
+        wrapper.recover()
+        assert wrapper.timers == {}
+        assert 'had already finished' in logged[0]
+    finally:
+        wrapper.loop.close()
+
+
+def test_recovered_journal_is_rewritten_as_a_snapshot(wrapper, settings, tmp_path):
+    wrapper.config['journal'] = 'journal.jsonl'
+    path = os.path.join(tmp_path, 'journal.jsonl')
+    write_journal(path, [['teams', [[0, 'Glossy Bears']]], ['join', 'Player1', 0], ['join', 'Player2', 0],
+                         ['dead', 'Player2'], ['leave', 'Player2']])
+    wrapper.recover()
+    for attempt in range(100):
+        with open(path) as journal:
+            records = [json.loads(line) for line in journal]
+        if [record[0] for record in records] == ['snapshot']:
+            break
+        time.sleep(0.05)
+    assert [record[0] for record in records] == ['snapshot']
+    again = uhc_wrapper.engine(dict(settings, journal='journal.jsonl'), 'uhc_again')
+    again.directory = str(tmp_path)
+    again.replay(records[0])
+    assert again.playerteams == {'Player1': 0}
+    assert again.dead_players == {'Player2'}
+
+
+def test_journal_that_cannot_be_written_is_still_drained(wrapper, tmp_path, logged):
+    wrapper.journal_path = os.path.join(tmp_path, 'missing', 'journal.jsonl')
+    writer = threading.Thread(target=wrapper.journal_writer, daemon=True)
+    writer.start()
+    for n in range(3):
+        wrapper.journal('dead', 'Player' + str(n))
+        for attempt in range(100):
+            if len(wrapper.journal_queue) == 0 and len(logged) > n:
+                break
+            time.sleep(0.01)
+    assert writer.is_alive()
+    assert len(wrapper.journal_queue) == 0
+    assert logged[0].startswith('Could not write to the journal')
+    # And once it can be written, it is
+    os.mkdir(os.path.join(tmp_path, 'missing'))
+    wrapper.journal('dead', 'Player3')
+    for attempt in range(100):
+        if os.path.exists(wrapper.journal_path) and os.path.getsize(wrapper.journal_path) > 0:
+            break
+        time.sleep(0.01)
+    with open(wrapper.journal_path) as journal:
+        assert json.loads(journal.read()) == ['dead', 'Player3']
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+warning = ("[12:00:00] [Server thread/INFO]: Can't keep up! Did the system time change, or is the server overloaded? "
+           "Running 5000ms behind, skipping 100 tick(s)")
+
+
+@pytest.fixture
+def now(wrapper):
+    # A clock the test moves on, and a loop for the probes' timers
+    time = [1800000000.0]
+    wrapper.clock = lambda: time[0]
+    wrapper.loop = asyncio.new_event_loop()
+    wrapper.log = lambda line: None
+    yield time
+    wrapper.loop.close()
+
+
+def next_probe(wrapper):
+    # Seconds until the lag monitor asks again
+    return round(wrapper.timers['lag'].when() - wrapper.loop.time())
+
+
+def test_warning_engages_the_throttle_until_it_ages_out(wrapper, now):
+    assert wrapper.classify(warning.split(': ', 1)[1]) == wrapper.LagWarning(5000, 100)
+    wrapper.handle_line(warning)
+    assert wrapper.ticks_per_second() == pytest.approx(20 * 60 / 65)
+    assert wrapper.command_throttle == pytest.approx((60 / 65) ** 2)
+    now[0] += wrapper.lag_window + 1
+    wrapper.update_throttle()
+    assert wrapper.ticks_per_second() == 20 and wrapper.command_throttle == 1
+    assert len(wrapper.lag_warnings) == 0 and wrapper.lag_behind == 0
+
+
+def test_slow_probes_engage_the_throttle_and_quick_ones_release_it(wrapper, now):
+    wrapper.lag_answered(now[0] - 0.4, 'World border is currently 1520 blocks wide')
+    assert wrapper.command_throttle == pytest.approx(0.25)
+    # While it's slowed down, the server is asked again sooner, to notice when it recovers
+    assert next_probe(wrapper) == 1
+    assert any(line.endswith('(slowed down), 0 waiting') for line in wrapper.lag_report())
+    for n in range(3):
+        wrapper.lag_answered(now[0], 'World border is currently 1520 blocks wide')
+        assert wrapper.command_throttle < 1 and next_probe(wrapper) == 1
+    wrapper.lag_answered(now[0], 'World border is currently 1520 blocks wide')
+    assert wrapper.command_throttle == 1 and next_probe(wrapper) == wrapper.lag_probe_every
+
+
+def test_throttle_never_stops_commands_altogether(wrapper, now):
+    for n in range(20):
+        wrapper.server_lagging(60000)
+    wrapper.lag_answered(now[0] - 30, None)
+    assert wrapper.command_throttle == 0.1
+
+
+def test_only_critical_commands_keep_full_speed(wrapper):
+    # 100 commands a second, slowed to 20 for all but the critical ones
+    sent = []
+    done = threading.Event()
+
+    class Recorder:
+        def send(self, command):
+            sent.append((command, time.monotonic()))
+            if len(sent) == 12:
+                done.set()
+
+    wrapper.transport = Recorder()
+    wrapper.command_rate = 100
+    wrapper.command_throttle = 0.2
+    wrapper.send_many(['say ' + str(n) for n in range(6)], wrapper.lane_normal)
+    wrapper.send_many(['gamemode 3 Bob' + str(n) for n in range(6)], wrapper.lane_critical)
+    threading.Thread(target=wrapper.command_writer, daemon=True).start()
+    assert done.wait(5)
+    # The critical lane goes first, 10ms apart; the rest 50ms apart
+    assert [command for command, when in sent[:6]] == ['gamemode 3 Bob' + str(n) for n in range(6)]
+    assert sent[5][1] - sent[0][1] < 0.2
+    assert sent[11][1] - sent[6][1] >= 0.2
@@ -0,0 +1,61 @@
+import gzip
+import json
+import os
+
+from uhc_wrapper import Death, Join
+
+
+def read_events(path, packed=False):
+    with (gzip.open(path, 'rt') if packed else open(path)) as events:
+        return [json.loads(line) for line in events]
+
+
+def test_events_are_recorded(wrapper, tmp_path):
+    wrapper.config['events'] = {'file': 'events.jsonl', 'maxbytes': 1000000, 'keep': 2}
+    wrapper.clock = lambda: 1800000000.25
+    wrapper.log_event(Join('Bob', '10.0.0.1'))
+    wrapper.log_event(Death('Bob', 'Zombie', None, 'mob'))
+    wrapper.flush_log()
+    assert read_events(os.path.join(tmp_path, 'events.jsonl')) == [
+        {'time': 1800000000.25, 'type': 'Join', 'name': 'Bob', 'ip': '10.0.0.1'},
+        {'time': 1800000000.25, 'type': 'Death', 'victim': 'Bob', 'killer': 'Zombie', 'weapon': None, 'cause': 'mob'}]
+
+
+def test_no_events_without_a_file(wrapper, tmp_path):
+    wrapper.log_event(Join('Bob', '10.0.0.1'))
+    wrapper.flush_log()
+    assert os.listdir(tmp_path) == []
+
+
+def test_events_are_rotated_at_their_size_limit(wrapper, tmp_path):
+    # Each record is about 60 bytes, so every few flushes fill a file
+    wrapper.config['events'] = {'file': 'events.jsonl', 'maxbytes': 200, 'keep': 2}
+    path = os.path.join(tmp_path, 'events.jsonl')
+    for n in range(40):
+        wrapper.log_event(Join('Player' + str(n), '10.0.0.1'))
+        wrapper.flush_log()
+    assert sorted(os.listdir(tmp_path)) == ['events.jsonl', 'events.jsonl.1.gz', 'events.jsonl.2.gz']
+    newest, older = read_events(path + '.1.gz', packed=True), read_events(path + '.2.gz', packed=True)
+    current = read_events(path) if os.path.exists(path) else []
+    # Nothing is lost between one file and the next, and the oldest have gone
+    names = [event['name'] for event in older + newest + current]
+    assert names == ['Player' + str(n) for n in range(40 - len(names), 40)]
+
+
+def test_rotation_keeps_as_many_as_asked(wrapper, tmp_path):
+    path = os.path.join(tmp_path, 'events.jsonl')
+    for n in range(4):
+        with open(path, 'w') as events:
+            events.write(str(n) + '\n')
+        wrapper.rotate_events(path, 3)
+    assert sorted(os.listdir(tmp_path)) == ['events.jsonl.1.gz', 'events.jsonl.2.gz', 'events.jsonl.3.gz']
+    assert [gzip.open(path + '.' + str(n) + '.gz').read() for n in (1, 2, 3)] == [b'3\n', b'2\n', b'1\n']
+
+
+def test_log_labels_a_supervised_match(wrapper, capsys):
+    wrapper.match_name = 'north'
+    wrapper.log('Reloaded')
+    wrapper.show_console(b'[12:00:00] [Server thread/INFO]: Bob joined the game\r\n')
+    wrapper.flush_log()
+    assert capsys.readouterr().out.splitlines() == [
+        '[north] Reloaded', '[north] [12:00:00] [Server thread/INFO]: Bob joined the game']
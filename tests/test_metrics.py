@@ -0,0 +1,41 @@
+import pytest
+
+
+def test_timed_passes_arguments_through_and_records_the_call(wrapper):
+    @wrapper.timed('greet')
+    def greet(name, greeting='Hello'):
+        return greeting + ' ' + name
+
+    assert greet('Bob') == 'Hello Bob'
+    assert greet('Bob', greeting='Hi') == 'Hi Bob'
+    assert wrapper.histograms[('handler', 'greet')].count == 2
+
+
+def test_timed_records_a_call_that_fails(wrapper):
+    @wrapper.timed('fail')
+    def fail():
+        raise ValueError('no')
+
+    with pytest.raises(ValueError):
+        fail()
+    assert wrapper.histograms[('handler', 'fail')].count == 1
+
+
+def test_histogram_buckets(wrapper):
+    histogram = wrapper.Histogram()
+    for value in (0.000001, 0.003, 0.003, 10):
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.counts[0] == 1
+    assert histogram.counts[wrapper.Histogram.buckets.index(0.005)] == 2
+    assert histogram.counts[-1] == 1
+
+
+def test_metrics_text(wrapper):
+    wrapper.counters['lines'] += 3
+    wrapper.observe('classify', 'Death', 0.002)
+    text = wrapper.metrics_text()
+    assert 'uhc_lines_total 3\n' in text
+    assert '# TYPE uhc_classify_seconds histogram\n' in text
+    assert 'uhc_classify_seconds_count{event="Death"} 1\n' in text
+    assert text.endswith('\n')
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from uhc_wrapper import spiral
+
+reply = 'World border is currently 1520 blocks wide'
+
+
+@pytest.fixture
+def op(wrapper):
+    # An op in the game to take round 25 areas, with the teleports recorded and the server's
+    # answers left to the test
+    wrapper.loop = asyncio.new_event_loop()
+    wrapper.log = lambda line: None
+    wrapper.players.add('Brianetta')
+    wrapper.config['pregen']['step'] = 400
+    wrapper.pregen_settle = 0
+    seen = SimpleNamespace(teleports=[], asked=[], said=[])
+    wrapper.send = lambda command, lane=None: seen.teleports.append(command) if command.startswith('tp ') else None
+    wrapper.query = lambda command, callback, timeout=5, silent=False: seen.asked.append(callback)
+    wrapper.announce_gold = lambda name, *lines: seen.said.extend(lines)
+    yield seen
+    wrapper.loop.close()
+
+
+def visit(wrapper, seen, areas):
+    # Let the timers run until the server is asked, then say it has caught up, for each of so many areas
+    for n in range(areas):
+        for wait in range(100):
+            if len(seen.asked) > 0:
+                break
+            wrapper.loop.run_until_complete(asyncio.sleep(0.01))
+        seen.asked.pop(0)(reply)
+
+
+def saved(wrapper, done):
+    # The checkpoint is written in the background
+    path = wrapper.pregen_checkpoint_path()
+    for n in range(100):
+        wrapper.loop.run_until_complete(asyncio.sleep(0.01))
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint['done'] == done:
+                return checkpoint
+    pytest.fail('No checkpoint with ' + str(done) + ' done')
+
+
+def place(position):
+    return 'tp Brianetta ' + str(position[0] * 400) + ' 128 ' + str(position[1] * 400)
+
+
+def test_spiral_visits_every_area_once_each_next_to_the_last():
+    positions = spiral(2)
+    assert sorted(positions) == [(dx, dz) for dx in range(-2, 3) for dz in range(-2, 3)]
+    assert all(abs(ax - bx) + abs(az - bz) == 1 for (ax, az), (bx, bz) in zip(positions, positions[1:]))
+
+
+def test_interrupted_run_resumes_from_its_checkpoint(wrapper, op):
+    wrapper.start_pregen('Brianetta')
+    positions = wrapper.pregen.positions
+    assert len(positions) == 25 and op.said[0] == 'Starting pregeneration of 25 areas, 400 blocks apart'
+    visit(wrapper, op, 12)
+    wrapper.stop_pregen('stopped by Brianetta')
+    assert saved(wrapper, 12) == {'x': 0, 'z': 0, 'size': 1520, 'step': 400, 'done': 12}
+    assert op.teleports == [place(position) for position in positions[:13]]
+    # Nothing more is asked once it has stopped
+    wrapper.loop.run_until_complete(asyncio.sleep(0.05))
+    assert op.asked == [] and wrapper.pregen is None
+    del op.teleports[:]
+    wrapper.start_pregen('Brianetta')
+    assert op.said[-2:] == ['Resuming pregeneration of 25 areas, 400 blocks apart', 'Pregenerated 12 of 25 areas (48%)']
+    visit(wrapper, op, 13)
+    # Back to the centre once it's done
+    assert op.teleports[:-1] == [place(position) for position in positions[12:]]
+    assert op.said[-1] == 'Pregeneration finished. The map is ready.'
+    assert wrapper.pregen is None and not os.path.exists(wrapper.pregen_checkpoint_path())
+
+
+def test_checkpoint_for_another_area_is_not_resumed(wrapper, op):
+    with open(wrapper.pregen_checkpoint_path(), 'w') as checkpoint_file:
+        json.dump({'x': 500, 'z': 0, 'size': 1520, 'step': 400, 'done': 12}, checkpoint_file)
+    wrapper.start_pregen('Brianetta')
+    assert wrapper.pregen.done == 0 and op.teleports == [place((0, 0))]
+
+
+def test_checkpoint_every_few_areas(wrapper, op):
+    wrapper.pregen_checkpoint_every = 5
+    wrapper.start_pregen('Brianetta')
+    visit(wrapper, op, 5)
+    assert saved(wrapper, 5)['done'] == 5
+
+
+def test_busy_server_is_asked_again_before_moving_on(wrapper, op):
+    wrapper.start_pregen('Brianetta')
+    wrapper.loop.run_until_complete(asyncio.sleep(0.01))
+    op.asked.pop(0)(None)
+    assert wrapper.pregen.done == 0 and len(op.teleports) == 1
+    visit(wrapper, op, 1)
+    assert wrapper.pregen.done == 1 and len(op.teleports) == 2
+
+
+def test_op_leaving_stops_it(wrapper, op):
+    wrapper.start_pregen('Brianetta')
+    visit(wrapper, op, 1)
+    wrapper.players.remove('Brianetta')
+    visit(wrapper, op, 1)
+    assert wrapper.pregen is None
+    assert saved(wrapper, 2)['done'] == 2
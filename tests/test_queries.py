@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def console(wrapper):
+    # The wrapper asking on the console, with the test playing the server
+    wrapper.loop = asyncio.new_event_loop()
+    wrapper.transport = wrapper.ConsoleTransport()
+    wrapper.log = lambda line: None
+    yield wrapper
+    wrapper.loop.close()
+
+
+def answer(wrapper, number, *lines):
+    # What the server says to a query's sentinels and command
+    wrapper.handle_line('[12:00:00] [Server thread/INFO]: Player uhc_sentinel_' + str(number) + 'a has no scores recorded')
+    for line in lines:
+        wrapper.handle_line('[12:00:00] [Server thread/INFO]: ' + line)
+    wrapper.handle_line('[12:00:00] [Server thread/INFO]: Player uhc_sentinel_' + str(number) + 'z has no scores recorded')
+
+
+def settle(wrapper, seconds=0):
+    wrapper.loop.run_until_complete(asyncio.sleep(seconds))
+
+
+def test_query_is_sent_between_sentinels(console):
+    console.query('worldborder get', lambda reply: None)
+    number = console.query_number
+    assert list(console.outbound[console.lane_critical]) == [
+        'scoreboard players list uhc_sentinel_' + str(number) + 'a', 'worldborder get',
+        'scoreboard players list uhc_sentinel_' + str(number) + 'z']
+
+
+def test_overlapping_queries_get_their_own_replies(console):
+    replies = {}
+    console.query('list', lambda reply: replies.setdefault('list', reply))
+    console.query('worldborder get', lambda reply: replies.setdefault('border', reply))
+    first, second = console.query_number - 1, console.query_number
+    answer(console, first, 'There are 1/20 players online:', 'Bob')
+    answer(console, second, 'World border is currently 1520 blocks wide')
+    settle(console)
+    assert replies == {'list': 'There are 1/20 players online:\nBob',
+                       'border': 'World border is currently 1520 blocks wide'}
+    assert console.queries == {}
+
+
+def test_asking_again_shares_the_answer(console):
+    replies = []
+    console.query('list', replies.append)
+    console.query('list', replies.append)
+    assert len(console.outbound[console.lane_critical]) == 3
+    answer(console, console.query_number, 'There are 0/20 players online:', '')
+    settle(console)
+    assert replies == ['There are 0/20 players online:\n'] * 2
+
+
+def test_unrelated_lines_between_sentinels_are_still_handled(console):
+    replies = []
+    console.query('worldborder get', replies.append)
+    answer(console, console.query_number, 'Bob fell from a high place', 'World border is currently 1520 blocks wide')
+    settle(console)
+    assert 'Bob' in console.dead_players
+    assert console.reply_line(replies[0], 'World border is currently') == \
+        ('World border is currently 1520 blocks wide', '')
+
+
+def test_no_reply_in_time(console):
+    replies = []
+    console.query('worldborder get', replies.append, timeout=0.05)
+    settle(console, 0.1)
+    assert replies == [None]
+    assert console.queries == {} and console.asking == {}
+    # A late answer is ignored, and what comes after it isn't taken for a reply
+    answer(console, console.query_number, 'World border is currently 1520 blocks wide')
+    assert console.query_open is None
+    settle(console)
+    assert replies == [None]
+
+
+def test_sentinels_are_not_shown(console):
+    shown = []
+    console.log = shown.append
+    console.query('worldborder get', lambda reply: None, silent=True)
+    answer(console, console.query_number, 'World border is currently 1520 blocks wide')
+    console.handle_line('[12:00:00] [Server thread/INFO]: Player uhc_sentinel_999a has no scores recorded')
+    assert shown == []
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+
+import uhc_simulator
+import uhc_wrapper
+
+
+@pytest.fixture
+def world():
+    return uhc_simulator.World()
+
+
+@pytest.fixture
+def server(world):
+    server = uhc_simulator.start_rcon(world, 0, 'secret')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def client(server, password='secret'):
+    return uhc_wrapper.RconClient('127.0.0.1', server.server_address[1], password)
+
+
+def test_reply(server):
+    assert client(server).send('worldborder get').result(timeout=5) == 'World border is currently 60000000 blocks wide'
+
+
+def test_reply_over_several_packets(server, world):
+    # The server splits a reply at 4096 bytes
+    world.players = ['Player' + str(n) for n in range(1000)]
+    reply = client(server).send('list').result(timeout=5)
+    assert len(reply.encode()) > 2 * 4096
+    assert reply.endswith(', '.join(world.players))
+
+
+def test_reply_of_exactly_one_packet(server, world):
+    # Nothing about a full packet says whether another follows it
+    world.players = ['x' * 4000, 'y' * (4096 - 4000 - len('There are 2/20 players online:') - 2)]
+    reply = client(server).send('list').result(timeout=5)
+    assert len(reply.encode()) == 4096
+
+
+def test_pipelined_commands_are_answered_in_order(server, world):
+    rcon = client(server)
+    replies = []
+    for size in range(100, 120):
+        replies.append(rcon.send('worldborder set ' + str(size)))
+        replies.append(rcon.send('worldborder get'))
+    for n, size in enumerate(range(100, 120)):
+        assert replies[2 * n].result(timeout=5) == 'Set world border to ' + str(size) + ' blocks wide'
+        assert replies[2 * n + 1].result(timeout=5) == 'World border is currently ' + str(size) + ' blocks wide'
+    assert [command for when, command in world.received][:2] == ['worldborder set 100', 'worldborder get']
+
+
+def test_wrong_password(server):
+    rcon = client(server, 'guess')
+    with pytest.raises(ConnectionError):
+        rcon.open()
+    # Sending never raises; the reply has already failed
+    reply = rcon.send('list')
+    assert reply.done()
+    assert isinstance(reply.exception(), ConnectionError)
+
+
+class DroppingHandler(uhc_simulator.RconHandler):
+    # Hangs up after the first packet of a long reply, once everything else has been asked
+    def write(self, request_id, kind, body):
+        uhc_simulator.RconHandler.write(self, request_id, kind, body)
+        if kind == 0 and len(body) == 4096:
+            time.sleep(0.2)
+            raise ConnectionError('hung up')
+
+
+def test_connection_dropped_mid_reply_fails_what_is_waiting(server, world):
+    server.RequestHandlerClass = DroppingHandler
+    world.players = ['Player' + str(n) for n in range(1000)]
+    rcon = client(server)
+    long_reply, after = rcon.send('list'), rcon.send('worldborder get')
+    with pytest.raises(ConnectionError):
+        long_reply.result(timeout=5)
+    with pytest.raises(ConnectionError):
+        after.result(timeout=5)
+    # The next command connects afresh
+    server.RequestHandlerClass = uhc_simulator.RconHandler
+    assert rcon.send('worldborder get').result(timeout=5) == 'World border is currently 60000000 blocks wide'
+
+
+def test_rcon_running_switches_commands_over(wrapper, server):
+    wrapper.config.update(transport='rcon', rcon={'host': '127.0.0.1', 'port': server.server_address[1],
+                                                  'password': 'secret'})
+    wrapper.loop = asyncio.new_event_loop()
+    wrapper.transport = wrapper.ConsoleTransport()
+
+    async def switched():
+        wrapper.handle_line('[12:00:00] [RCON Listener #1/INFO]: RCON running on 0.0.0.0:25575')
+        while not wrapper.transport.replies:
+            await asyncio.sleep(0.01)
+    try:
+        wrapper.loop.run_until_complete(asyncio.wait_for(switched(), 5))
+    finally:
+        wrapper.loop.close()
+    assert isinstance(wrapper.transport, wrapper.RconClient)
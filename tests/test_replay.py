@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+tests = os.path.dirname(os.path.abspath(__file__))
+data = os.path.join(tests, 'data')
+
+
+@pytest.mark.parametrize('hash_seed', ['0', '1', '2'])
+def test_short_match_matches_golden_transcript(tmp_path, hash_seed):
+    # A 16 minute match: players join, team up, fight it out, one lags and one leaves.
+    # Run under different string hashes, as nothing the wrapper sends may depend on set order.
+    # If a change to the wrapper is meant to change what it sends, write a new golden transcript with
+    #   python3 uhc_replay.py tests/data/short_match.jsonl --transcript tests/data/short_match.txt
+    result = subprocess.run(
+        [sys.executable, os.path.join(os.path.dirname(tests), 'uhc_replay.py'),
+         os.path.join(data, 'short_match.jsonl'), '--golden', os.path.join(data, 'short_match.txt')],
+        cwd=tmp_path, capture_output=True, text=True, timeout=120, env=dict(os.environ, PYTHONHASHSEED=hash_seed))
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Matches ' in result.stdout
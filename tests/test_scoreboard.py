@@ -0,0 +1,97 @@
+import pytest
+
+wanted = {0: 'Glossy Bears', 1: 'Nosy Moles'}
+
+
+def sent(wrapper):
+    # Everything waiting to go to the server, taken off the lanes
+    commands = [command for lane in wrapper.outbound for command in lane]
+    for lane in wrapper.outbound:
+        lane.clear()
+    return commands
+
+
+@pytest.fixture
+def board(wrapper):
+    # The scoreboard as the lobby has it, with nothing left to send
+    wrapper.sync_teams(wanted, {'Alice': 0, 'Bob': 0, 'Carol': 1})
+    wrapper.sync_objectives(wrapper.lobby_objectives, {'list': 'health'})
+    sent(wrapper)
+    return wrapper
+
+
+def test_first_sync_clears_what_a_restart_left(wrapper):
+    wrapper.sync_teams(wanted, {'Bob': 0, 'Carol': 1})
+    commands = sent(wrapper)
+    assert commands[0] == 'scoreboard teams remove 0'
+    assert commands[-2:] == ['scoreboard teams join 0 Bob', 'scoreboard teams join 1 Carol']
+    wrapper.sync_objectives(wrapper.lobby_objectives, {'list': 'health'})
+    assert sent(wrapper) == ['scoreboard objectives remove dead', 'scoreboard objectives remove health',
+                             'scoreboard objectives remove indeathroom', 'scoreboard objectives remove spectating',
+                             'scoreboard objectives add health health', 'scoreboard objectives add spectating dummy',
+                             'scoreboard objectives setdisplay list health']
+
+
+def test_unchanged_model_sends_nothing(board):
+    board.sync_teams(wanted, {'Alice': 0, 'Bob': 0, 'Carol': 1})
+    board.sync_objectives(board.lobby_objectives, {'list': 'health'})
+    assert sent(board) == []
+
+
+def test_moving_a_player_sends_only_their_join(board):
+    board.sync_teams(wanted, {'Alice': 0, 'Bob': 1, 'Carol': 1})
+    assert sent(board) == ['scoreboard teams join 1 Bob']
+
+
+def test_leaving_player_sends_only_a_leave(board):
+    board.sync_teams(wanted, {'Alice': 0, 'Carol': 1})
+    assert sent(board) == ['scoreboard teams leave Bob']
+
+
+def test_renamed_team_is_made_again_with_its_members(board):
+    board.sync_teams({0: 'Glossy Bears', 1: 'Witty Salamanders'}, {'Alice': 0, 'Bob': 0, 'Carol': 1})
+    assert sent(board) == ['scoreboard teams remove 1', 'scoreboard teams add 1 Witty Salamanders',
+                           'scoreboard teams option 1 color blue',
+                           'scoreboard teams option 1 nametagVisibility hideForOtherTeams',
+                           'scoreboard teams join 1 Carol']
+
+
+def test_joins_are_batched(board):
+    members = {'Player' + str(n).zfill(2): 0 for n in range(45)}
+    board.sync_teams(wanted, members)
+    commands = sent(board)
+    assert commands[0] == 'scoreboard teams leave Alice Bob Carol'
+    assert [command.count(' Player') for command in commands[1:]] == [20, 20, 5]
+
+
+def test_objective_changes_send_only_their_own_commands(board):
+    board.sync_objectives(board.game_objectives, {'list': 'health'})
+    assert sent(board) == ['scoreboard objectives add dead stat.deaths', 'scoreboard objectives add indeathroom dummy']
+    board.sync_objectives(board.game_objectives, {'list': 'health', 'sidebar': 'dead'})
+    assert sent(board) == ['scoreboard objectives setdisplay sidebar dead']
+
+
+def test_score_is_only_sent_when_it_changes(board):
+    board.set_score('Bob', 'spectating', 1)
+    board.set_score('Bob', 'spectating', 1)
+    board.set_score('Carol', 'spectating', 0)
+    assert sent(board) == ['scoreboard players set Bob spectating 1', 'scoreboard players set Carol spectating 0']
+    board.set_score('Bob', 'spectating', 0)
+    assert sent(board) == ['scoreboard players set Bob spectating 0']
+
+
+def test_selector_forgets_what_was_known(board):
+    board.set_score('Bob', 'spectating', 1)
+    board.set_score('@a', 'spectating', 0)
+    board.set_score('Bob', 'spectating', 1)
+    assert sent(board) == ['scoreboard players set Bob spectating 1', 'scoreboard players set @a spectating 0',
+                           'scoreboard players set Bob spectating 1']
+
+
+def test_removing_an_objective_forgets_its_scores(board):
+    board.set_score('Bob', 'spectating', 1)
+    board.sync_objectives({'health': 'health'}, {'list': 'health'})
+    board.sync_objectives(board.lobby_objectives, {'list': 'health'})
+    sent(board)
+    board.set_score('Bob', 'spectating', 1)
+    assert sent(board) == ['scoreboard players set Bob spectating 1']
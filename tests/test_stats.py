@@ -0,0 +1,91 @@
+import os
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def database(wrapper):
+    # The statements a match queues, run against a database in memory rather than by the writer thread
+    wrapper.stats_path = ':memory:'
+    wrapper.log = lambda line: None
+    database = sqlite3.connect(':memory:')
+    database.executescript(wrapper.stats_tables)
+
+    def run():
+        with database:
+            while len(wrapper.stats_queue) > 0:
+                database.execute(*wrapper.stats_queue.popleft())
+        return database
+    return run
+
+
+def play_match(wrapper, now=1800000000.0):
+    # Two teams of two. Bob falls, Carol kills Dave, and Carol's team wins.
+    wrapper.clock = lambda: now
+    wrapper.teams.update({0: 'Glossy Bears', 1: 'Nosy Moles'})
+    for name, team in (('Alice', 0), ('Bob', 1), ('Carol', 0), ('Dave', 1)):
+        wrapper.join_team(name, team)
+        wrapper.players.add(name)
+    wrapper.time_start = now
+    wrapper.stats_begin()
+    wrapper.clock = lambda: now + 600
+    wrapper.death('Bob', cause='fall')
+    wrapper.clock = lambda: now + 1200
+    wrapper.death('Dave', 'Carol', 'Excalibur', 'mob')
+
+
+def test_one_match(wrapper, database):
+    play_match(wrapper)
+    rows = database()
+    match = 'uhc-1800000000000'
+    assert rows.execute('SELECT id, started, finished, result, winner, teamsize, teams, players FROM matches').fetchall() \
+        == [(match, 1800000000.0, 1800001200.0, 'won', 'Glossy Bears', 3, 2, 4)]
+    assert rows.execute('SELECT player, team, place, died, killer, weapon, cause FROM players ORDER BY player').fetchall() \
+        == [('Alice', 'Glossy Bears', 1, None, None, None, None),
+            ('Bob', 'Nosy Moles', 4, 1800000600.0, None, None, 'fall'),
+            ('Carol', 'Glossy Bears', 1, None, None, None, None),
+            ('Dave', 'Nosy Moles', 3, 1800001200.0, 'Carol', 'Excalibur', 'mob')]
+    assert rows.execute('SELECT team, size, place FROM teams ORDER BY team').fetchall() == \
+        [('Glossy Bears', 2, 1), ('Nosy Moles', 2, 2)]
+    assert rows.execute('SELECT killer, victim FROM kills').fetchall() == [('Carol', 'Dave')]
+
+
+def test_leaderboards_after_one_match(wrapper, database):
+    play_match(wrapper)
+    boards = wrapper.leaderboards(database())
+    assert boards['killers'] == [('Carol', 1)]
+    assert boards['winners'] == [('Alice', 1), ('Carol', 1)]
+    summary = wrapper.summarise_stats(database(), '')
+    assert summary['players']['Carol'] == (1, 1, 0, 20.0, 1)
+    assert summary['players']['Bob'] == (1, 0, 1, 10.0, 0)
+
+
+def test_deaths_before_the_match_are_not_counted(wrapper, database):
+    wrapper.teams.update({0: 'Glossy Bears'})
+    wrapper.join_team('Alice', 0)
+    wrapper.death('Alice', cause='fall')
+    assert database().execute('SELECT COUNT(*) FROM players').fetchone() == (0,)
+
+
+def test_writer_batches_into_a_file(wrapper, tmp_path):
+    wrapper.config['stats'] = {'file': 'stats.db', 'season': ''}
+    wrapper.stats_batch_wait = 0
+    wrapper.open_stats()
+    play_match(wrapper)
+    wrapper.flush_stats()
+    with sqlite3.connect(os.path.join(tmp_path, 'stats.db')) as rows:
+        assert rows.execute('SELECT result, winner FROM matches').fetchall() == [('won', 'Glossy Bears')]
+    assert wrapper.stats_summary['killers'] == [('Carol', 1)]
+
+
+def test_writer_gives_up_on_a_database_it_cannot_open(wrapper, tmp_path):
+    wrapper.config['stats'] = {'file': os.path.join('missing', 'stats.db'), 'season': ''}
+    logged = []
+    wrapper.log = logged.append
+    wrapper.open_stats()
+    wrapper.stats_thread.join(5)
+    assert wrapper.stats_path is None
+    assert logged[0].startswith('Could not open the statistics database')
+    wrapper.stats('SELECT 1')
+    wrapper.flush_stats()
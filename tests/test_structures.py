@@ -0,0 +1,74 @@
+import random
+
+import uhc_wrapper
+
+
+def blocks(plan):
+    # What each block ends up as when the fills are made in order
+    world = {}
+    for x1, y1, z1, x2, y2, z2, block in plan:
+        for x in range(x1, x2 + 1):
+            for y in range(y1, y2 + 1):
+                for z in range(z1, z2 + 1):
+                    world[(x, y, z)] = block
+    return world
+
+
+def test_plan_fills_one_box():
+    assert uhc_wrapper.plan_fills([(0, 0, 0, 3, 0, 3, 'stone')]) == [(0, 0, 0, 3, 0, 3, 'stone')]
+
+
+def test_plan_fills_builds_a_hollow_box_in_layers():
+    volumes = [(0, 0, 0, 3, 0, 3, 'stone'), (1, 0, 1, 2, 0, 2, 'air')]
+    assert uhc_wrapper.plan_fills(volumes) == volumes
+
+
+def test_plan_fills_hidden_volumes_are_left_out():
+    volumes = [(1, 0, 1, 2, 0, 2, 'air'), (0, 0, 0, 3, 0, 3, 'stone')]
+    assert uhc_wrapper.plan_fills(volumes) == [(0, 0, 0, 3, 0, 3, 'stone')]
+
+
+def test_plan_fills_only_what_changed():
+    built = [(0, 0, 0, 3, 0, 3, 'stone')]
+    assert uhc_wrapper.plan_fills(built, built) == []
+    assert uhc_wrapper.plan_fills(built + [(1, 0, 1, 2, 0, 2, 'air')], built) == [(1, 0, 1, 2, 0, 2, 'air')]
+
+
+def test_plan_fills_builds_the_same_as_the_volumes():
+    # Whichever way it's planned, the result is what filling every volume in order would give
+    rng = random.Random(1)
+    for attempt in range(200):
+        volumes = []
+        for n in range(rng.randint(1, 6)):
+            x1, y1, z1 = rng.randint(0, 8), rng.randint(0, 4), rng.randint(0, 8)
+            volumes.append((x1, y1, z1, x1 + rng.randint(0, 6), y1 + rng.randint(0, 3), z1 + rng.randint(0, 6),
+                            rng.choice(['stone', 'air', 'glass'])))
+        previous = volumes[:rng.randint(0, len(volumes))] or None
+        world = blocks(previous or [])
+        world.update(blocks(uhc_wrapper.plan_fills(volumes, previous)))
+        expected = blocks(previous or [])
+        expected.update(blocks(volumes))
+        assert world == expected
+
+
+def test_plan_fills_merges_neighbouring_boxes():
+    # Two halves of one block, side by side, are one fill
+    assert uhc_wrapper.plan_fills([(0, 0, 0, 1, 0, 0, 'stone'), (2, 0, 0, 3, 0, 0, 'stone')]) == \
+        [(0, 0, 0, 3, 0, 0, 'stone')]
+
+
+def test_first_builds_take_no_more_commands_than_before(wrapper):
+    # The fills and setblocks these structures took when they were written out by hand
+    for structure, commands in ((wrapper.lobby_structure, 5), (wrapper.death_room_structure, 4),
+                                (wrapper.lobby_command_bank, 6), (wrapper.game_command_bank, 11)):
+        assert len(wrapper.plan_fills(structure())) <= commands, structure.__name__
+
+
+def test_build_structure_sends_only_what_changed(wrapper):
+    wrapper.build_structure('commandbank', wrapper.lobby_command_bank())
+    wrapper.outbound[wrapper.lane_normal].clear()
+    wrapper.build_structure('commandbank', wrapper.lobby_command_bank())
+    assert list(wrapper.outbound[wrapper.lane_normal]) == []
+    wrapper.build_structure('commandbank', wrapper.command_bank_structure())
+    # The bedrock goes back over the command blocks, and nothing else
+    assert [command.split()[0] for command in wrapper.outbound[wrapper.lane_normal]] == ['fill']
@@ -0,0 +1,45 @@
+from collections import Counter
+
+
+def test_allocate_teams_sizes_differ_by_no_more_than_one(wrapper):
+    pool = ['Player' + str(n) for n in range(10)]
+    allocation = wrapper.allocate_teams(pool, 4)
+    assert sorted(allocation) == sorted(pool)
+    sizes = Counter(allocation.values())
+    assert sorted(sizes) == [0, 1, 2, 3]
+    assert max(sizes.values()) - min(sizes.values()) <= 1
+
+
+def test_allocate_teams_keeps_friends_together(wrapper):
+    wrapper.config['friends'] = [['Player1', 'Player5', 'Player9'], ['Player2', 'Absent']]
+    pool = ['Player' + str(n) for n in range(12)]
+    allocation = wrapper.allocate_teams(pool, 4)
+    assert allocation['Player1'] == allocation['Player5'] == allocation['Player9']
+    assert 'Absent' not in allocation
+    assert sorted(Counter(allocation.values()).values()) == [3, 3, 3, 3]
+
+
+def test_allocate_teams_splits_a_group_too_big_for_one_team(wrapper):
+    wrapper.config['friends'] = [['Player' + str(n) for n in range(5)]]
+    allocation = wrapper.allocate_teams(['Player' + str(n) for n in range(6)], 2)
+    assert sorted(Counter(allocation.values()).values()) == [3, 3]
+
+
+def test_allocate_teams_spreads_skill(wrapper):
+    wrapper.config['skill'] = {'Ace': 10, 'Pro': 9, 'Novice': 1, 'Newbie': 0}
+    allocation = wrapper.allocate_teams(['Ace', 'Pro', 'Novice', 'Newbie'], 2)
+    assert allocation['Ace'] != allocation['Pro']
+    assert allocation['Ace'] == allocation['Newbie']
+
+
+def test_create_teams_beyond_the_colours(wrapper):
+    # 40 players in pairs need 20 teams, more than there are colours or names
+    wrapper.teamsize = 2
+    wrapper.players.update('Player' + str(n) for n in range(40))
+    wrapper.spectators.clear()
+    wrapper.create_teams()
+    assert len(wrapper.teams) == 20
+    assert len(set(wrapper.teams.values())) == 20
+    assert all(len(name) <= 32 for name in wrapper.teams.values())
+    assert sorted(Counter(wrapper.playerteams.values()).values()) == [2] * 20
+    assert {wrapper.team_colour(team) for team in wrapper.teams} == set(wrapper.teamcolours.values())
@@ -0,0 +1,255 @@
+######################
+# UHC Wrapper benchmarks
+# Measures the hot paths of uhc_wrapper.py without a Minecraft server
+# Run from the directory containing uhc_wrapper.yml:
+#   python3 uhc_benchmark.py [--players 500] [--rate 5000] [--seconds 5] [latest.log ...]
+# Given log files, their lines are used as the corpus; otherwise one is made up.
+# The live measurements run uhc_simulator.py as the server, at the given load.
+######################
+
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import os
+import random
+import re
+import sys
+import time
+
+import uhc_wrapper
+
+# The death regex as it was before the trie, for comparison
+old_death = re.compile('.+ was shot by arrow|.+ was shot by .+|.+ was shot by .+ using .+|.+ was pricked to death|' +
+                       '.+ walked into a cactus while trying to escape .+|.+ was stabbed to death|.+ drowned|' +
+                       '.+ drowned whilst trying to escape .+|.+ experienced kinetic energy|.+ blew up|' +
+                       '.+ was blown up by .+|.+ hit the ground too hard|.+ fell from a high place|' +
+                       '.+ fell off a ladder|.+ fell off some vines|.+ fell out of the water|' +
+                       '.+ fell into a patch of fire|.+ fell into a patch of cacti|.+ was doomed to fall by .+|' +
+                       '.+ was shot off some vines by .+|.+ was shot off a ladder by .+|' +
+                       '.+ was blown from a high place by .+|.+ was squashed by a falling anvil|' +
+                       '.+ was squashed by a falling block|.+ went up in flames|.+ burned to death|' +
+                       '.+ was burnt to a crisp whilst fighting .+|.+ walked into a fire whilst fighting .+|' +
+                       '.+ tried to swim in lava|.+ tried to swim in lava while trying to escape .+|' +
+                       '.+ was struck by lightning|.+ was slain by .+|.+ was slain by .+ using .+|' +
+                       '.+ got finished off by .+|.+ got finished off by .+ using .+|.+ was fireballed by .+|' +
+                       '.+ was killed by magic|.+ was killed by .+ using magic|.+ starved to death|' +
+                       '.+ suffocated in a wall|.+ was killed while trying to hurt .+|.+ fell out of the world|' +
+                       '.+ fell from a high place and fell out of the world|.+ withered away|.+ was pummeled by .+')
+
+killers = ['Zombie', 'Skeleton', 'Cave Spider', 'Creeper', 'Witch', 'Enderman']
+chatter = ['Saving chunks for level \'world\'/Overworld', 'Saving chunks for level \'world\'/Nether',
+           'Saving chunks for level \'world\'/The End', 'ThreadedAnvilChunkStorage (world): All chunks are saved',
+           'Preparing spawn area: 42%', 'Can\'t keep up! Did the system time change, or is the server overloaded? ' +
+           'Running 2103ms behind, skipping 42 tick(s)']
+prefixes = ['[12:34:56] [Server thread/INFO]: ', '[12:34:56 INFO]: ']  # Vanilla's, and Spigot's
+
+
+def make_corpus(size, players=100, seed=1):
+    # Roughly the mix of a busy match: mostly chunk noise, some chat, a few deaths
+    rng = random.Random(seed)
+    names = ['Player' + str(n) for n in range(players)]
+    deaths = [message for message, cause in uhc_wrapper.death_messages]
+    corpus = []
+    for n in range(size):
+        roll = rng.random()
+        name = rng.choice(names)
+        if roll < 0.70:
+            line = rng.choice(chatter)
+        elif roll < 0.90:
+            line = '<' + name + '> ' + ' '.join(rng.choice(['gg', 'anyone', 'near', 'spawn', 'was', 'by', 'help'])
+                                                for w in range(rng.randint(1, 12)))
+        elif roll < 0.95:
+            line = rng.choice([name + '[/10.0.0.' + str(n % 250) + ':51234] logged in with entity id ' + str(n) +
+                               ' at (0.5, 64.0, 0.5)', name + ' lost connection: Disconnected'])
+        else:
+            message = rng.choice(deaths)
+            line = name + ' ' + message.replace('{killer}', rng.choice(killers + names))
+            if message == 'was killed by {killer}':
+                line += ' using magic'
+            elif message.endswith('by {killer}') and rng.random() < 0.2:
+                line += ' using [' + rng.choice(['Excalibur', 'Bow of Doom']) + ']'
+        corpus.append(rng.choice(prefixes) + line)
+    return corpus
+
+
+def read_corpus(filenames):
+    corpus = []
+    for filename in filenames:
+        with open(filename, errors='replace') as handle:
+            corpus.extend(line.rstrip('\r\n') for line in handle)
+    return corpus
+
+
+def timed(function, lines, repeat=5):
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            function(line)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(title, elapsed, count):
+    print('{:<40} {:>10.1f} ms {:>12.0f} lines/sec'.format(title, elapsed * 1000, count / elapsed))
+
+
+def report_times(title, times):
+    # Median, 99th percentile and worst of a list of durations, in milliseconds
+    if times == []:
+        print('{:<40} {:>10}'.format(title, 'none'))
+        return
+    times = sorted(times)
+    print('{:<40} p50 {:>8.2f} ms   p99 {:>8.2f} ms   max {:>8.2f} ms   ({} samples)'.format(
+        title, times[len(times) // 2] * 1000, times[len(times) * 99 // 100] * 1000, times[-1] * 1000, len(times)))
+
+
+def reset_wrapper():
+    # Forget whatever a previous benchmark did to the wrapper's state
+    uhc_wrapper.players.clear()
+    uhc_wrapper.disconnected_players.clear()
+    uhc_wrapper.dead_players.clear()
+    with uhc_wrapper.outbound_ready:
+        for lane in uhc_wrapper.outbound:
+            lane.clear()
+
+
+def bench_death(corpus):
+    lines = [uhc_wrapper.split_prefix(line)[1] for line in corpus]
+    print('Death matcher, ' + str(len(lines)) + ' lines')
+    report('  old regex', timed(old_death.match, lines), len(lines))
+    report('  death trie', timed(uhc_wrapper.match_death, lines), len(lines))
+    # The two should agree about who died, apart from chat that the old regex took for deaths
+    disagree, chat = 0, 0
+    for line in lines:
+        m = old_death.match(line)
+        event = uhc_wrapper.match_death(line)
+        old_victim = uhc_wrapper.fix_name(m.group().split()[0]) if m is not None else None
+        if old_victim != (event.victim if event is not None else None):
+            if line.startswith('<'):
+                chat += 1
+            else:
+                disagree += 1
+    print('  chat lines the old regex took for deaths: ' + str(chat))
+    print('  victims differing from old regex: ' + str(disagree))
+
+
+def bench_parse(corpus):
+    # Lines a second through prefix stripping and classification, then through
+    # the whole of the console path, handlers and all (with the output thrown away)
+    print('Console parsing, ' + str(len(corpus)) + ' lines')
+    report('  split_prefix + classify', timed(lambda line: uhc_wrapper.classify(uhc_wrapper.split_prefix(line)[1]),
+                                              corpus), len(corpus))
+    # The byte prefilter may let through lines that turn out to be nothing, but must never hold back an event
+    candidate = uhc_wrapper.regexp['candidate']
+    missed = sum(1 for line in corpus if candidate.match(line.encode()) is None and
+                 not isinstance(uhc_wrapper.classify(uhc_wrapper.split_prefix(line)[1]), uhc_wrapper.Other))
+    print('  events the prefilter missed: ' + str(missed))
+    data = ('\n'.join(corpus) + '\n').encode()
+    chunks = [data[start:start + 4096] for start in range(0, len(data), 4096)]
+    best = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for n in range(3):
+            reset_wrapper()
+            start = time.perf_counter()
+            for chunk in chunks:
+                uhc_wrapper.feed_console(chunk)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+            uhc_wrapper.flush_log()
+    reset_wrapper()
+    report('  feed_console, 4k reads', best, len(corpus))
+
+
+def bench_live(players, rate, seconds):
+    # Runs the simulator as the wrapper's server, generating rate lines a second, and measures
+    # how long a command takes to be answered, and how late the wrapper's timers fire
+    print('Live, simulator with ' + str(players) + ' players at ' + str(rate) + ' lines/sec for ' +
+          str(seconds) + ' seconds')
+    simulator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uhc_simulator.py')
+    uhc_wrapper.commandline = ' '.join([sys.executable, simulator, '--players', str(players), '--rate', str(rate)])
+    uhc_wrapper.command_rate = 1000
+    uhc_wrapper.loop = asyncio.new_event_loop()
+    reset_wrapper()
+    round_trips = []
+    lateness = []
+
+    def answered(started, reply):
+        if reply is not None:
+            round_trips.append(time.perf_counter() - started)
+
+    def probe():
+        uhc_wrapper.query('worldborder get', functools.partial(answered, time.perf_counter()))
+        uhc_wrapper.loop.call_later(0.05, probe)
+
+    def timer(due):
+        lateness.append(time.time() - due)
+
+    def set_timers():
+        # Ten timers a second, each due a little while from now, as the game's events are
+        for n in range(10):
+            due = time.time() + random.uniform(0.1, 1)
+            uhc_wrapper.schedule(('benchmark', len(lateness), n, due), due, timer, due)
+        uhc_wrapper.loop.call_later(1, set_timers)
+
+    lines = uhc_wrapper.counters['lines']
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            uhc_wrapper.spawn()
+            uhc_wrapper.loop.call_later(0.5, probe)
+            uhc_wrapper.loop.call_soon(set_timers)
+            uhc_wrapper.loop.call_later(seconds, uhc_wrapper.loop.stop)
+            started = time.perf_counter()
+            uhc_wrapper.loop.run_forever()
+            elapsed = time.perf_counter() - started
+            lines = uhc_wrapper.counters['lines'] - lines
+            uhc_wrapper.flush_log()
+    finally:
+        uhc_wrapper.minecraft.terminate(force=True)
+        for handle in uhc_wrapper.timers.values():
+            handle.cancel()
+        uhc_wrapper.timers.clear()
+        uhc_wrapper.loop.close()
+    report('  lines read', elapsed, lines)
+    report_times('  query round trip', round_trips)
+    report_times('  timer lateness', lateness)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for uhc_wrapper.py')
+    parser.add_argument('--players', type=int, default=500, help='players in the simulated match')
+    parser.add_argument('--rate', type=int, default=5000, help='lines a second from the simulator')
+    parser.add_argument('--seconds', type=float, default=5, help='how long to run the simulator for')
+    parser.add_argument('--no-live', action='store_true', help='skip the measurements that need the simulator')
+    parser.add_argument('logfiles', nargs='*', help='logs to use as the corpus')
+    arguments = parser.parse_args()
+    # The real settings, with nothing written anywhere that matters
+    settings = uhc_wrapper.load_settings()
+    settings.update({'journal': '', 'events': dict(settings['events'], file=''),
+                     'stats': dict(settings['stats'], file='')})
+    uhc_wrapper.setup(settings)
+    if arguments.logfiles != []:
+        corpus = read_corpus(arguments.logfiles)
+    else:
+        corpus = make_corpus(200000, arguments.players)
+    bench_death(corpus)
+    bench_parse(corpus)
+    if not arguments.no_live:
+        bench_live(arguments.players, arguments.rate, arguments.seconds)
@@ -0,0 +1,164 @@
+######################
+# UHC Wrapper replay
+# Plays a console recording, made with uhc_wrapper.py --record FILE, back through the wrapper
+# as fast as it will go, on a virtual clock, and writes down every command it would have sent.
+# Timers, timeouts and rate limits all see the recorded times, so a 90 minute match takes
+# seconds, and the same recording always gives the same commands.
+# Run from the directory containing uhc_wrapper.yml:
+#   python3 uhc_replay.py match.jsonl [--transcript commands.txt] [--golden expected.txt] [--verbose]
+# Given --golden, the commands are compared with an earlier transcript, and any differences
+# shown; it exits with status 1 if there are any.
+######################
+
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import contextlib
+import difflib
+import json
+import os
+import random
+import selectors
+import sys
+import tempfile
+import time
+
+import uhc_wrapper
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    # Instead of waiting for the next timer to be due, the clock jumps straight to it
+    def __init__(self, loop):
+        selectors.DefaultSelector.__init__(self)
+        self.virtual_loop = loop
+
+    def select(self, timeout=None):
+        self.virtual_loop.waiting()
+        if timeout is not None and timeout > 0:
+            self.virtual_loop.now += timeout
+        return selectors.DefaultSelector.select(self, 0)
+
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+    # Its clock starts at 0, as the real loop's does; at the size of a wall clock time, a float
+    # is too coarse for the loop to be sure a timer it has jumped to is due
+    def __init__(self, waiting):
+        self.now = 0.0
+        self.waiting = waiting  # Called whenever the loop has nothing left to do for now
+        asyncio.SelectorEventLoop.__init__(self, VirtualSelector(self))
+
+    def time(self):
+        return self.now
+
+    def run_in_executor(self, executor, function, *args):
+        # Done there and then, so that when it finishes doesn't depend on another thread
+        future = self.create_future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class Replay:
+    def __init__(self, recording):
+        self.recording = recording
+        header = json.loads(recording.readline())
+        self.start = header['start']
+        self.transcript = []
+        self.reads = 0
+        self.loop = VirtualLoop(self.drain)
+        # The recorded settings, with nothing written anywhere that matters
+        settings = uhc_wrapper.validate_config(header['config'])
+        settings.update({'journal': '', 'events': dict(settings['events'], file=''),
+                         'stats': dict(settings['stats'], file='')})
+        uhc_wrapper.setup(settings)
+        uhc_wrapper.directory = tempfile.mkdtemp(prefix='uhc_replay_')
+        uhc_wrapper.configfile = os.path.join(uhc_wrapper.directory, uhc_wrapper.configfile)
+        uhc_wrapper.loop = self.loop
+        uhc_wrapper.clock = self.clock
+        uhc_wrapper.transport = uhc_wrapper.ConsoleTransport()  # Only asked whether it replies; nothing is sent
+        uhc_wrapper.server_stopped = self.loop.stop
+        random.seed(0)
+
+    def clock(self):
+        return self.start + self.loop.now
+
+    def drain(self):
+        # What the command writer would have sent by now, in the order it would have sent it
+        offset = '{:10.3f} '.format(self.loop.now)
+        with uhc_wrapper.outbound_ready:
+            for lane in uhc_wrapper.outbound:
+                while len(lane) > 0:
+                    self.transcript.append(offset + lane.popleft())
+
+    def feed_next(self):
+        line = self.recording.readline()
+        if line == '':
+            self.loop.call_soon(self.loop.stop)
+            return
+        when, data = json.loads(line)
+        self.loop.call_at(when - self.start, self.feed, data)
+
+    def feed(self, data):
+        self.reads += 1
+        uhc_wrapper.feed_console(data.encode('utf-8', 'surrogateescape'))
+        self.feed_next()
+
+    def run(self):
+        uhc_wrapper.start_lag_monitor()
+        self.feed_next()
+        try:
+            self.loop.run_forever()
+        finally:
+            uhc_wrapper.flush_console()
+            self.drain()
+            self.loop.close()
+            uhc_wrapper.flush_log()
+        return self.transcript
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a console recording through uhc_wrapper.py')
+    parser.add_argument('recording', help='made with uhc_wrapper.py --record')
+    parser.add_argument('--transcript', help='write the commands sent to this file')
+    parser.add_argument('--golden', help='compare the commands sent with this transcript')
+    parser.add_argument('--verbose', action='store_true', help='show the wrapper\'s output')
+    arguments = parser.parse_args()
+    started = time.perf_counter()
+    with open(arguments.recording) as recording, open(os.devnull, 'w') as devnull:
+        replay = Replay(recording)
+        with contextlib.redirect_stdout(sys.stdout if arguments.verbose else devnull):
+            transcript = replay.run()
+    elapsed = time.perf_counter() - started
+    print('Replayed {:.1f} minutes of console ({} reads, {} lines) in {:.2f} seconds; {} commands'.format(
+        replay.loop.now / 60, replay.reads, uhc_wrapper.counters['lines'], elapsed,
+        len(transcript)))
+    if arguments.transcript is not None:
+        with open(arguments.transcript, 'w') as transcript_file:
+            transcript_file.write(''.join(line + '\n' for line in transcript))
+    if arguments.golden is not None:
+        with open(arguments.golden) as golden_file:
+            golden = golden_file.read().splitlines()
+        differences = list(difflib.unified_diff(golden, transcript, arguments.golden, 'replay', lineterm=''))
+        for line in differences:
+            print(line)
+        print(('Differs from ' if differences else 'Matches ') + arguments.golden)
+        if differences:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
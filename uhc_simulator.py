@@ -0,0 +1,217 @@
+######################
+# UHC Wrapper simulator
+# A stand-in for a Minecraft server, for trying out uhc_wrapper.py without Java
+# Talks on its console, and answers RCON requests, the way a 1.9 server would,
+# generating as much player activity as asked for, and records every command.
+# To have the wrapper run it instead of Minecraft, put this in uhc_wrapper.yml:
+#   java: python3 uhc_simulator.py --players 500 --rate 2000
+######################
+
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import random
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+
+class World:
+    # Just enough of a server's state to answer the wrapper's queries
+    def __init__(self, record=None):
+        self.players = []
+        self.border = 60000000
+        self.lock = threading.Lock()
+        self.received = []
+        self.record = open(record, 'w') if record is not None else None
+
+    def command(self, command):
+        # Record a command, and return the lines of the server's reply to it
+        with self.lock:
+            self.received.append((time.time(), command))
+            if self.record is not None:
+                self.record.write(command + '\n')
+                self.record.flush()
+            words = command.split()
+            if command == 'list':
+                return ['There are ' + str(len(self.players)) + '/' + str(max(20, len(self.players))) +
+                        ' players online:', ', '.join(self.players)]
+            if command == 'worldborder get':
+                return ['World border is currently ' + str(self.border) + ' blocks wide']
+            if len(words) >= 3 and words[:2] == ['worldborder', 'set'] and words[2].isnumeric():
+                self.border = int(words[2])
+                return ['Set world border to ' + words[2] + ' blocks wide']
+            if words[:3] == ['scoreboard', 'players', 'list'] and len(words) == 4:
+                return ['Player ' + words[3] + ' has no scores recorded']
+            if words == []:
+                return ['Unknown command. Try /help for a list of commands']
+            return []
+
+
+# Console output, most of it the server talking to itself
+chatter = ['Saving chunks for level \'world\'/Overworld', 'Saving chunks for level \'world\'/Nether',
+           'Saving chunks for level \'world\'/The End', 'ThreadedAnvilChunkStorage (world): All chunks are saved',
+           'Preparing spawn area: 42%']
+chat = ['gg', 'anyone', 'near', 'spawn', 'was', 'by', 'help', 'lol', 'where', 'is', 'everybody', 'diamonds']
+killers = ['Zombie', 'Skeleton', 'Cave Spider', 'Creeper', 'Witch', 'Enderman']
+deaths = ['was shot by {killer}', 'was slain by {killer}', 'was slain by {killer} using [Excalibur]', 'drowned',
+          'drowned whilst trying to escape {killer}', 'blew up', 'was blown up by {killer}', 'hit the ground too hard',
+          'fell from a high place', 'fell out of the world', 'tried to swim in lava', 'was killed by magic',
+          'was killed by {killer} using magic', 'starved to death', 'suffocated in a wall', 'withered away']
+
+
+class Generator:
+    # Makes up plausible console messages for a busy match: mostly chunk noise,
+    # then chat, then players coming and going, and a few deaths
+    def __init__(self, world, players, seed=1):
+        self.world = world
+        self.random = random.Random(seed)
+        self.names = ['Player' + str(n) for n in range(players)]
+        self.count = 0
+
+    def line(self):
+        roll = self.random.random()
+        name = self.random.choice(self.names)
+        self.count += 1
+        if roll < 0.70:
+            return self.random.choice(chatter)
+        if roll < 0.90:
+            return '<' + name + '> ' + ' '.join(self.random.choice(chat) for w in range(self.random.randint(1, 12)))
+        if roll < 0.95:
+            with self.world.lock:
+                if name in self.world.players:
+                    self.world.players.remove(name)
+                    return name + ' lost connection: Disconnected'
+                self.world.players.append(name)
+            return name + '[/10.0.' + str(self.count // 250 % 250) + '.' + str(self.count % 250) + \
+                ':51234] logged in with entity id ' + str(self.count) + ' at (0.5, 64.0, 0.5)'
+        return name + ' ' + self.random.choice(deaths).replace('{killer}', self.random.choice(killers + self.names))
+
+
+class Console:
+    # The server's standard input and output, as the wrapper sees them
+    def __init__(self, world, output=sys.stdout):
+        self.world = world
+        self.output = output
+        self.lock = threading.Lock()
+
+    def say(self, message, level='INFO', thread='Server thread'):
+        with self.lock:
+            self.output.write('[' + time.strftime('%H:%M:%S') + '] [' + thread + '/' + level + ']: ' + message + '\n')
+            self.output.flush()
+
+    def say_many(self, messages):
+        stamp = '[' + time.strftime('%H:%M:%S') + '] [Server thread/INFO]: '
+        with self.lock:
+            self.output.write(''.join(stamp + message + '\n' for message in messages))
+            self.output.flush()
+
+    def read_commands(self, source=sys.stdin):
+        for command in source:
+            self.say_many(self.world.command(command.strip()))
+
+    def generate(self, generator, rate, duration=None):
+        # Write rate lines a second, in small batches
+        started = time.monotonic()
+        sent = 0
+        while duration is None or time.monotonic() - started < duration:
+            due = int((time.monotonic() - started) * rate) - sent
+            if due > 0:
+                self.say_many([generator.line() for n in range(due)])
+                sent += due
+            time.sleep(0.01)
+
+
+class RconHandler(socketserver.BaseRequestHandler):
+    def read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if chunk == b'':
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+    def write(self, request_id, kind, body):
+        payload = struct.pack('<ii', request_id, kind) + body + b'\0\0'
+        self.request.sendall(struct.pack('<i', len(payload)) + payload)
+
+    def handle(self):
+        authorised = False
+        try:
+            while True:
+                size, = struct.unpack('<i', self.read_exactly(4))
+                request_id, kind = struct.unpack('<ii', self.read_exactly(8))
+                body = self.read_exactly(size - 8)[:-2].decode()
+                if kind == 3:
+                    authorised = body == self.server.password
+                    self.write(request_id if authorised else -1, 2, b'')
+                elif kind == 2 and authorised:
+                    reply = ''.join(self.server.world.command(body)).encode()
+                    # Long replies are split, as the real server does
+                    for start in range(0, max(len(reply), 1), 4096):
+                        self.write(request_id, 0, reply[start:start + 4096])
+                else:
+                    self.write(request_id, 0, ('Unknown request ' + hex(kind)[2:]).encode())
+        except (ConnectionError, OSError, struct.error):
+            pass
+
+
+class RconServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, password, world):
+        self.password = password
+        self.world = world
+        socketserver.ThreadingTCPServer.__init__(self, address, RconHandler)
+
+
+def start_rcon(world, port, password, host='127.0.0.1'):
+    # Runs an RCON server in the background, and returns it. Port 0 picks a free port.
+    server = RconServer((host, port), password, world)
+    threading.Thread(target=server.serve_forever, name='rcon server', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in Minecraft server for uhc_wrapper.py')
+    parser.add_argument('--players', type=int, default=20, help='number of players taking part')
+    parser.add_argument('--rate', type=float, default=0, help='lines of console output a second')
+    parser.add_argument('--seconds', type=float, help='stop after this long')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--rcon-port', type=int, help='also answer RCON requests on this port')
+    parser.add_argument('--rcon-password', default='')
+    parser.add_argument('--record', help='write every command received to this file')
+    # Accepted, and ignored, so that the wrapper can run this in place of java -jar server.jar nogui
+    parser.add_argument('-jar')
+    parser.add_argument('nogui', nargs='?')
+    arguments = parser.parse_args()
+    world = World(arguments.record)
+    console = Console(world)
+    console.say('Starting minecraft server version 1.9.2')
+    console.say('Done (0.042s)! For help, type "help" or "?"')
+    if arguments.rcon_port is not None:
+        server = start_rcon(world, arguments.rcon_port, arguments.rcon_password)
+        console.say('RCON running on 0.0.0.0:' + str(server.server_address[1]), thread='RCON Listener #1')
+    threading.Thread(target=console.read_commands, name='console', daemon=True).start()
+    try:
+        if arguments.rate > 0:
+            console.generate(Generator(world, arguments.players, arguments.seed), arguments.rate, arguments.seconds)
+        else:
+            time.sleep(arguments.seconds if arguments.seconds is not None else 1e9)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
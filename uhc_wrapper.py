@@ -19,42 +19,190 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
+import fcntl
+import functools
+import json
+import os
 import random
 import re
+import socket
+import struct
+import sys
+import termios
+import threading
 import time
 import math
+from collections import deque, namedtuple
+from json.encoder import encode_basestring
 
-import pexpect
-import yaml
+# pexpect, yaml, and the heavier parts of the standard library, are imported where they're
+# used, so that importing this module reads nothing, starts nothing, and takes no time.
 
 # Config file
 configfile = 'uhc_wrapper.yml'
 
 uhc_prefix = '{"text":"[UHC] ","color":"yellow"}'
 
-# read the config
-config = yaml.load(open(configfile, 'r'))
-
-# Command line builder
-commandline = str(config['java']) + ' -jar ' + config['jar'] + ' nogui'
-
-# Set variables defined in config
-x = int(config['x'])
-z = int(config['z'])
-minute_marker = int(config['minutemarker'])
-teamsize = int(config['playersperteam'])
-reveal_names = int(config['revealnames'])
-timeout = int(config['timeout'])
-
-spectators = set(config['ops'])  # Default value only
+# What the config must contain. A type, a tuple of allowed values, a list of things
+# of one type, settings of their own, or {str: type} for a mapping of names.
+config_schema = {
+    'java': str, 'jar': str, 'x': int, 'z': int, 'minutemarker': int, 'playersperteam': int, 'revealnames': int,
+    'timeout': int, 'commandrate': int, 'ops': [str], 'teamnames': [str],
+    'eternal': {'mode': ('day', 'night', 'off'), 'timebegin': int},
+    'worldborder': {'duration': int, 'finish': int, 'start': int, 'timebegin': int},
+    'transport': ('console', 'rcon', 'pipe'), 'pipe': str, 'rcon': {'host': str, 'port': int, 'password': str},
+    'metrics': {'host': str, 'port': int, 'dump': str}, 'journal': str, 'friends': [[str]], 'skill': {str: float},
+    'colour': ('auto', 'always', 'never'), 'events': {'file': str, 'maxbytes': int, 'keep': int},
+    'stats': {'file': str, 'season': str}, 'pregen': {'step': int, 'checkpoint': str},
+}
+# Settings that may be left out, and what they are then
+config_defaults = {
+    'commandrate': 100, 'transport': 'console', 'pipe': 'uhc_commands',
+    'rcon': {'host': 'localhost', 'port': 25575, 'password': ''}, 'metrics': {'host': 'localhost', 'port': 0, 'dump': ''},
+    'journal': '', 'friends': [], 'skill': {}, 'matches': [], 'colour': 'auto',
+    'events': {'file': '', 'maxbytes': 10000000, 'keep': 5}, 'stats': {'file': '', 'season': ''},
+    'pregen': {'step': 160, 'checkpoint': 'uhc_pregen.json'},
+}
+# Settings only read when the wrapper starts
+config_restart = {'java', 'jar', 'transport', 'pipe', 'rcon', 'metrics', 'journal', 'matches', 'events', 'stats'}
+
+
+def check_setting(value, spec, where, problems):
+    # Returns the value, as the type spec calls for where that is unambiguous, noting any problems
+    if isinstance(spec, dict) and list(spec) == [str]:
+        if not isinstance(value, dict):
+            problems.append(where + ' should be a list of names and values')
+            return value
+        return {str(key): check_setting(item, spec[str], where + '.' + str(key), problems)
+                for key, item in value.items()}
+    if isinstance(spec, dict):
+        if not isinstance(value, dict):
+            problems.append(where + ' should be a group of settings')
+            return value
+        checked = dict(value)
+        for key in spec:
+            if key in value:
+                checked[key] = check_setting(value[key], spec[key], where + '.' + key, problems)
+            else:
+                problems.append(where + '.' + key + ' is missing')
+        return checked
+    if isinstance(spec, list):
+        if not isinstance(value, list):
+            problems.append(where + ' should be a list')
+            return value
+        return [check_setting(item, spec[0], where + '[' + str(n) + ']', problems) for n, item in enumerate(value)]
+    if isinstance(spec, tuple):
+        if value not in spec:
+            problems.append(where + ' should be one of ' + ', '.join(spec))
+        return value
+    if spec is str:
+        if value is None or isinstance(value, (dict, list)):
+            problems.append(where + ' should be text')
+            return value
+        return str(value)
+    # A number
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        return spec(value)
+    except (TypeError, ValueError):
+        problems.append(where + ' should be a number')
+        return value
+
+
+def validate_config(settings):
+    # Returns a checked copy of the settings, with defaults filled in, or raises ValueError saying what's wrong
+    if not isinstance(settings, dict):
+        raise ValueError(configfile + ' is not a list of settings')
+    settings = dict(settings)
+    for key in config_defaults:
+        if key not in settings or settings[key] is None:
+            settings[key] = config_defaults[key]
+        elif isinstance(config_defaults[key], dict) and isinstance(settings[key], dict):
+            settings[key] = dict(config_defaults[key], **settings[key])
+    problems = []
+    settings = check_setting(settings, config_schema, 'config', problems)
+    if problems == []:
+        for key in ('playersperteam', 'commandrate'):
+            if settings[key] < 1:
+                problems.append('config.' + key + ' should be at least 1')
+        if settings['pregen']['step'] < 1:
+            problems.append('config.pregen.step should be at least 1')
+        for key in ('minutemarker', 'revealnames', 'timeout'):
+            if settings[key] < 0:
+                problems.append('config.' + key + ' should not be negative')
+        if settings['teamnames'] == []:
+            problems.append('config.teamnames should have at least one name')
+    if problems != []:
+        raise ValueError('; '.join(problems))
+    return settings
+
+
+def configure(settings):
+    # Set variables defined in config. A supervised match is given its own.
+    global config, commandline, x, z, minute_marker, teamsize, reveal_names, timeout, command_rate, console_colour
+    global ops
+    config = settings
+    ops = set(config['ops'])
+    # Command line builder
+    commandline = str(config['java']) + ' -jar ' + config['jar'] + ' nogui'
+    x = int(config['x'])
+    z = int(config['z'])
+    minute_marker = int(config['minutemarker'])
+    teamsize = int(config['playersperteam'])
+    reveal_names = int(config['revealnames'])
+    timeout = int(config['timeout'])
+    command_rate = int(config.get('commandrate', 100))
+    console_colour = config['colour'] == 'always' or (config['colour'] == 'auto' and sys.stdout.isatty())
+
+
+def load_settings():
+    # Reads the config file afresh. A supervised match's settings come from more than one file, and it replaces this.
+    import yaml
+    with open(configfile, 'r') as settings:
+        return validate_config(yaml.safe_load(settings))
+
+
+def setup(settings):
+    # Nothing else works until this has been given validated settings
+    global config_loaded, spectators
+    configure(settings)
+    config_loaded = config
+    spectators = set(config['ops'])
+
+
+def engine(settings, name='uhc_engine'):
+    # A fresh instance of this module, with state entirely its own, set up with settings. Each of a
+    # supervisor's matches is one, and anything else that wants a wrapper to drive can have one too.
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, os.path.abspath(__file__))
+    instance = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(instance)
+    instance.setup(settings)
+    return instance
+
+
+config = None  # Until setup() is called
+config_loaded = None  # The settings as last read from the file, so that edits to it can be spotted
+config_files = [configfile]  # Files watched for changes
+config_stamps = {}
+spectators = set()  # Ops, to begin with
+
+# Where the server runs, and what this match is called, if it's one of several
+directory = '.'
+match_name = None
+log_file = None
 
 # Internal variables
 players = set()
 time_start = None
 target_time = 0
-worldborder_announce = set()
 teams = {}
-playerteams = {}
+playerteams = {}  # Living players' teams
+teammembers = {}  # Each team's living players
+live_teams = set()  # Teams with anybody left alive
+match_decided = False
 dead_players = set()
 teamcolours = {
     0: 'red',
@@ -70,618 +218,1921 @@ teamcolours = {
     10: 'dark_aqua',
     11: 'dark_purple',
     12: 'gray',
-    13: 'dark_grey',
+    13: 'dark_gray',
     14: 'black'
 }
 flag_border = True
 flag_visibility = True
 flag_eternal = True
 disconnected_players = {}
+timers = {}
+clock = time.time  # The time as far as the game is concerned. A replay has a virtual clock instead.
+background_timers = {'lag', 'pregen'}  # Timers that aren't part of a game, and outlast one
+loop = None
+minecraft = None
+
+# Outbound commands wait in these lanes, and are written in lane order
+lane_critical, lane_normal, lane_cosmetic = 0, 1, 2
+outbound = (deque(), deque(), deque())
+outbound_limit = 5000  # Cosmetic commands beyond this backlog are dropped
+outbound_ready = threading.Condition()
+transport = None
+
+######################
+# Instrumentation. Cheap enough to be always on. If metrics: port is set in the
+# config, it is served in Prometheus text format, at http://localhost:port/metrics
+
+class Histogram:
+    # Counts of observations (in seconds) at or below each bucket's upper bound
+    buckets = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Histograms, by name: Prometheus name, label name (if any) and description
+histogram_names = {
+    'classify': ('uhc_classify_seconds', 'event', 'Time to classify a console line, by what it turned out to be'),
+    'handler': ('uhc_handler_seconds', 'handler', 'Time spent in event handlers'),
+    'console_wait': ('uhc_console_wait_seconds', None, 'Time spent waiting for the server to write something'),
+    'console_read': ('uhc_console_read_seconds', None, 'Time spent handling each read of console output'),
+    'timer': ('uhc_timer_lateness_seconds', 'timer', 'How late scheduled game events ran'),
+    'pregen_probe': ('uhc_pregen_probe_seconds', None, 'How long the server took to answer while pregenerating'),
+}
+histograms = {}  # (name, label) -> Histogram
+counters = {'lines': 0, 'commands_sent': 0, 'commands_merged': 0, 'commands_dropped': 0, 'chat_handled': 0,
+            'chat_limited': 0}
+lines_per_second = 0.0
+lines_window = [time.monotonic(), 0]  # Start of the current one second window, and lines read in it
+console_idle_since = None
+
+
+def observe(name, label, value):
+    histogram = histograms.get((name, label))
+    if histogram is None:
+        histogram = histograms[(name, label)] = Histogram()
+    histogram.observe(value)
+
+
+def timed(handler):
+    # Decorator, recording how long each call of an event handler takes
+    def decorate(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe('handler', handler, time.perf_counter() - start)
+        return timed_function
+    return decorate
+
+
+def count_lines(count):
+    global lines_per_second
+    counters['lines'] += count
+    now = time.monotonic()
+    if now - lines_window[0] >= 1:
+        lines_per_second = lines_window[1] / (now - lines_window[0])
+        lines_window[0] = now
+        lines_window[1] = 0
+    lines_window[1] += count
+
+
+def console_backlog():
+    # Bytes the server has written that haven't been read yet
+    if minecraft is None:
+        return 0
+    try:
+        return struct.unpack('i', fcntl.ioctl(minecraft.child_fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+    except OSError:
+        return 0
+
+
+metric_labels = ''  # Added to every sample; a supervised match is labelled with its name
+
+
+def metric_families():
+    # Each metric's type, description and samples, in Prometheus text format
+    families = {}
+
+    def metric(name, kind, description, samples):
+        families[name] = (kind, description, [
+            name + ('{' + ','.join(label for label in (metric_labels, labels) if label != '') + '}'
+                    if metric_labels + labels != '' else '') + ' ' + repr(value) for labels, value in samples])
+
+    metric('uhc_lines_total', 'counter', 'Console lines read', [('', counters['lines'])])
+    metric('uhc_lines_per_second', 'gauge', 'Console lines read in the last second', [('', lines_per_second)])
+    metric('uhc_console_backlog_bytes', 'gauge', 'Console output written by the server but not yet read',
+           [('', console_backlog())])
+    metric('uhc_commands_total', 'counter', 'Commands, by what became of them',
+           [('result="' + result + '"', counters['commands_' + result]) for result in ('sent', 'merged', 'dropped')])
+    metric('uhc_chat_commands_total', 'counter', 'Chat commands from players, by what became of them',
+           [('result="' + result + '"', counters['chat_' + result]) for result in ('handled', 'limited')])
+    metric('uhc_outbound_queue', 'gauge', 'Commands waiting to be sent, by lane',
+           [('lane="' + lane + '"', len(outbound[number]))
+            for number, lane in enumerate(('critical', 'normal', 'cosmetic'))])
+    metric('uhc_timers', 'gauge', 'Game events scheduled', [('', len(timers))])
+    metric('uhc_server_ticks_per_second', 'gauge', 'Server tick rate, from its lag warnings over the last minute',
+           [('', ticks_per_second())])
+    metric('uhc_console_round_trip_seconds', 'gauge', 'Rolling average time for the server to answer a probe',
+           [('', lag_average or 0.0)])
+    metric('uhc_command_throttle', 'gauge', 'Fraction of the command rate in use', [('', command_throttle)])
+    for name in histogram_names:
+        prometheus_name, label_name, description = histogram_names[name]
+        labelled = sorted((label, histogram) for (histogram_name, label), histogram in histograms.items()
+                          if histogram_name == name)
+        if labelled == []:
+            continue
+        samples = []
+        for label, histogram in labelled:
+            labels = label_name + '="' + label + '"' if label_name is not None else ''
+            cumulative = 0
+            for bound, count in zip(Histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                samples.append(('_bucket', (labels + ',' if labels != '' else '') + 'le="' + str(bound) + '"',
+                                cumulative))
+            samples.append(('_sum', labels, histogram.sum))
+            samples.append(('_count', labels, histogram.count))
+        families[prometheus_name] = ('histogram', description, [
+            prometheus_name + suffix + ('{' + ','.join(label for label in (metric_labels, labels) if label != '') +
+                                        '}' if metric_labels + labels != '' else '') + ' ' + repr(value)
+            for suffix, labels, value in samples])
+    return families
+
+
+def metrics_text():
+    # A supervisor reports on all of its matches, with each metric's samples kept together
+    families = {}
+    # An engine() is a copy of this module that was never imported, so this one's own
+    # metric_families is called directly rather than looked up
+    for match_families in [match.metric_families for match in matches.values()] or [metric_families]:
+        for name, (kind, description, samples) in match_families().items():
+            families.setdefault(name, (kind, description, []))[2].extend(samples)
+    text = []
+    for name, (kind, description, samples) in families.items():
+        text.append('# HELP ' + name + ' ' + description)
+        text.append('# TYPE ' + name + ' ' + kind)
+        text.extend(samples)
+    return '\n'.join(text) + '\n'
+
+
+async def serve_metrics(reader, writer):
+    # Just enough HTTP for a Prometheus scraper, or a curious human with curl
+    try:
+        request = (await reader.readline()).split()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if request[1:2] == [b'/metrics']:
+            status, body = '200 OK', metrics_text()
+        else:
+            status, body = '404 Not Found', 'Try /metrics\n'
+        body = body.encode()
+        writer.write(('HTTP/1.0 ' + status + '\r\nContent-Type: text/plain; version=0.0.4\r\n' +
+                      'Content-Length: ' + str(len(body)) + '\r\n\r\n').encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def start_metrics(offset=0):
+    # Supervisor worker processes each serve their own matches' metrics, on successive ports
+    settings = config.get('metrics', {})
+    if not settings.get('port'):
+        return
+    port = settings['port'] + offset
+    import asyncio
+    loop.run_until_complete(asyncio.start_server(serve_metrics, settings.get('host', 'localhost'), port))
+    log('Metrics at http://' + settings.get('host', 'localhost') + ':' + str(port) + '/metrics')
+
+
+def dump_metrics():
+    # At the end of a match, keep its numbers if metrics: dump names a file
+    filename = config.get('metrics', {}).get('dump')
+    if not filename:
+        return
+    try:
+        with open(filename, 'w') as dump:
+            dump.write(metrics_text())
+    except OSError as e:
+        log('Could not write metrics to ' + filename + ': ' + str(e))
+
 
 ######################
-# Compile some regular expressions. Things we look for in the minecraft server output.
-regexp = {}
-# Just to add colour, and so that we can strip them out.
-regexp['info'] = re.compile('^>*\[[0-9]+:[0-9]+:[0-9]+.*INFO\]: ')
-regexp['warn'] = re.compile('^>*\[[0-9]+:[0-9]+:[0-9]+.*WARN\]: ')
-# This lets us know that the server is up and ready
-regexp['done'] = re.compile('^Done \([0-p].[0-9]+s\)! For help, type "help" or "?"')
-# This matches a player connecting to the server
-regexp['connect'] = re.compile('^\w+\[/[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+:[0-9]+\] logged in')
-# This matches a player diconnecting from the server
-regexp['disconnect'] = re.compile('\w+ lost connection: ')
-# A command typed by a player
-regexp['command'] = re.compile('^<.+> !\w+')
-# The world border's current width
-regexp['border'] = re.compile('^World border is currently [0-9]+ blocks wide')
-# For technical reasons...
-regexp['unknown'] = re.compile('^Unknown command. Try /help for a list of commands')
-# List of players
-regexp['playerlist'] = re.compile('^(\w+, )*(\w+)$')
+# Some regular expressions. Things we look for in the minecraft server output.
+
+class Patterns(dict):
+    # Each is compiled the first time it's looked up, and kept
+    def __init__(self, **sources):
+        dict.__init__(self)
+        self.sources = sources
+
+    def __missing__(self, key):
+        pattern = self[key] = re.compile(self.sources[key])
+        return pattern
+
+
+regexp = Patterns(
+    # The time/thread/level prefix. Just to add colour, and so that we can strip it out.
+    prefix=r'^>*\[[0-9]+:[0-9]+:[0-9]+.*?(INFO|WARN)\]: ',
+    # This lets us know that the server is up and ready
+    done=r'^Done \([0-p].[0-9]+s\)! For help, type "help" or "?"',
+    # This matches a player connecting to the server
+    connect=r'^\w+\[/[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+:[0-9]+\] logged in',
+    # This matches a player diconnecting from the server
+    disconnect=r'\w+ lost connection: ',
+    # A command typed by a player
+    command=r'^<.+> !\w+',
+    # The world border's current width
+    border=r'^World border is currently [0-9]+ blocks wide',
+    # The server saying it's behind
+    lag=r'Running ([0-9]+)ms behind, skipping ([0-9]+) tick',
+)
 # Death messages. Why can't this be simple?
-regexp['death'] = re.compile('.+ was shot by arrow|' +
-                             '.+ was shot by .+|' +
-                             '.+ was shot by .+ using .+|' +
-                             '.+ was pricked to death|' +
-                             '.+ walked into a cactus while trying to escape .+|' +
-                             '.+ was stabbed to death|' +
-                             '.+ drowned|' +
-                             '.+ drowned whilst trying to escape .+|' +
-                             '.+ experienced kinetic energy|' +
-                             '.+ blew up|' +
-                             '.+ was blown up by .+|' +
-                             '.+ hit the ground too hard|' +
-                             '.+ fell from a high place|' +
-                             '.+ fell off a ladder|' +
-                             '.+ fell off some vines|' +
-                             '.+ fell out of the water|' +
-                             '.+ fell into a patch of fire|' +
-                             '.+ fell into a patch of cacti|' +
-                             '.+ was doomed to fall by .+|' +
-                             '.+ was shot off some vines by .+|' +
-                             '.+ was shot off a ladder by .+|' +
-                             '.+ was blown from a high place by .+|' +
-                             '.+ was squashed by a falling anvil|' +
-                             '.+ was squashed by a falling block|' +
-                             '.+ went up in flames|' +
-                             '.+ burned to death|' +
-                             '.+ was burnt to a crisp whilst fighting .+|' +
-                             '.+ walked into a fire whilst fighting .+|' +
-                             '.+ tried to swim in lava|' +
-                             '.+ tried to swim in lava while trying to escape .+|' +
-                             '.+ was struck by lightning|' +
-                             '.+ was slain by .+|' +
-                             '.+ was slain by .+ using .+|' +
-                             '.+ got finished off by .+|' +
-                             '.+ got finished off by .+ using .+|' +
-                             '.+ was fireballed by .+|' +
-                             '.+ was killed by magic|' +
-                             '.+ was killed by .+ using magic|' +
-                             '.+ starved to death|' +
-                             '.+ suffocated in a wall|' +
-                             '.+ was killed while trying to hurt .+|' +
-                             '.+ fell out of the world|' +
-                             '.+ fell from a high place and fell out of the world|' +
-                             '.+ withered away|' +
-                             '.+ was pummeled by .+')
+# Each message follows the victim's name. {killer} is whatever is left of the line,
+# and may itself end in ' using <weapon>'. The second item is the cause of death.
+death_messages = [
+    ('was shot by arrow', 'arrow'),
+    ('was shot by {killer}', 'arrow'),
+    ('was pricked to death', 'cactus'),
+    ('walked into a cactus while trying to escape {killer}', 'cactus'),
+    ('was stabbed to death', 'generic'),
+    ('drowned', 'drown'),
+    ('drowned whilst trying to escape {killer}', 'drown'),
+    ('experienced kinetic energy', 'flyIntoWall'),
+    ('blew up', 'explosion'),
+    ('was blown up by {killer}', 'explosion'),
+    ('hit the ground too hard', 'fall'),
+    ('fell from a high place', 'fall'),
+    ('fell off a ladder', 'fall'),
+    ('fell off some vines', 'fall'),
+    ('fell out of the water', 'fall'),
+    ('fell into a patch of fire', 'fall'),
+    ('fell into a patch of cacti', 'fall'),
+    ('was doomed to fall by {killer}', 'fall'),
+    ('was shot off some vines by {killer}', 'fall'),
+    ('was shot off a ladder by {killer}', 'fall'),
+    ('was blown from a high place by {killer}', 'fall'),
+    ('was squashed by a falling anvil', 'anvil'),
+    ('was squashed by a falling block', 'fallingBlock'),
+    ('went up in flames', 'inFire'),
+    ('burned to death', 'onFire'),
+    ('was burnt to a crisp whilst fighting {killer}', 'onFire'),
+    ('walked into a fire whilst fighting {killer}', 'inFire'),
+    ('tried to swim in lava', 'lava'),
+    ('tried to swim in lava while trying to escape {killer}', 'lava'),
+    ('was struck by lightning', 'lightningBolt'),
+    ('was slain by {killer}', 'mob'),
+    ('got finished off by {killer}', 'mob'),
+    ('was fireballed by {killer}', 'fireball'),
+    ('was killed by magic', 'magic'),
+    ('was killed by {killer}', 'magic'),
+    ('starved to death', 'starve'),
+    ('suffocated in a wall', 'inWall'),
+    ('was killed while trying to hurt {killer}', 'thorns'),
+    ('fell out of the world', 'outOfWorld'),
+    ('fell from a high place and fell out of the world', 'outOfWorld'),
+    ('withered away', 'wither'),
+    ('was pummeled by {killer}', 'mob')
+]
+
+
+def build_death_trie(messages):
+    # Word trie. Each node is [children, cause if the line ends here, cause if a killer follows]
+    root = [{}, None, None]
+    for message, cause in messages:
+        node = root
+        for word in message.split(' '):
+            if word == '{killer}':
+                node[2] = cause
+                break
+            node = node[0].setdefault(word, [{}, None, None])
+        else:
+            node[1] = cause
+    return root
+
+
+death_trie = build_death_trie(death_messages)
+
+######################
+# Console events. Each line of output is classified as at most one of these.
+Join = namedtuple('Join', 'name ip')
+Leave = namedtuple('Leave', 'name')
+ChatCommand = namedtuple('ChatCommand', 'name command args')
+BorderReport = namedtuple('BorderReport', 'text')
+LagWarning = namedtuple('LagWarning', 'behind skipped')
+PlayerList = namedtuple('PlayerList', 'names')
+Death = namedtuple('Death', 'victim killer weapon cause')
+Other = namedtuple('Other', 'text')
+
+
+def split_prefix(line):
+    # Returns the prefix and the rest of the line
+    if line[:1] not in ('[', '>'):
+        return '', line
+    m = regexp['prefix'].match(line)
+    if m is None:
+        return '', line
+    return m.group(), line[m.end():]
+
+
+def colour_prefix(prefix):
+    # Green for INFO, yellow for WARN, if the console wants colour
+    if prefix == '' or not console_colour:
+        return prefix
+    if prefix.endswith('INFO]: '):
+        return '\033[32m' + prefix + '\033[m'
+    return '\033[33m' + prefix + '\033[m'
+
+
+def classify(line):
+    # Cheap tests on the first character and on keywords pick the one
+    # regular expression that could possibly match, so most lines see none.
+    if line == '':
+        return Other(line)
+    first = line[0]
+    # A command typed by a player
+    if first == '<':
+        m = regexp['command'].match(line)
+        if m is not None:
+            # First word, chop off the < and >, and run through the team colour stripper
+            name = fix_name(m.group().split()[0][1:-1])
+            # Everything right of the bang, then any arguments
+            return ChatCommand(name, m.group().split('!')[1], line[m.end():].lstrip())
+        return Other(line)
+    if first == 'W' and line.startswith('World border is currently'):
+        if regexp['border'].match(line) is not None:
+            return BorderReport(line)
+        return Other(line)
+    if first == 'C' and line.startswith("Can't keep up!"):
+        m = regexp['lag'].search(line)
+        if m is not None:
+            return LagWarning(int(m.group(1)), int(m.group(2)))
+        return Other(line)
+    space = line.find(' ')
+    if space == -1:
+        # A bare word; nothing we're looking for
+        return Other(line)
+    if ' logged in' in line:
+        m = regexp['connect'].match(line)
+        if m is not None:
+            nameip = m.group().split(' ')[0]
+            return Join(nameip.split('[')[0], nameip.split('/')[1].split(':')[0])
+        return Other(line)
+    if ' lost connection: ' in line:
+        m = regexp['disconnect'].match(line)
+        if m is not None:
+            return Leave(m.group().split()[0])
+        return Other(line)
+    event = match_death(line)
+    if event is not None:
+        return event
+    return Other(line)
+
+
+def match_death(line):
+    # Walks the death trie once, word by word; no backtracking. The victim is always the
+    # first word. Where a message can be followed by a killer, the deepest such point
+    # that the line reaches is remembered, in case the killer's name happens to start
+    # with a word that the trie also knows.
+    space = line.find(' ')
+    verb_end = line.find(' ', space + 1)
+    if space == -1 or line[space + 1:verb_end if verb_end != -1 else len(line)] not in death_trie[0]:
+        return None
+    words = line.split(' ')
+    node = death_trie
+    slot = None
+    i = 1
+    while i < len(words):
+        child = node[0].get(words[i])
+        if child is None:
+            break
+        node = child
+        i += 1
+        if node[2] is not None and i < len(words):
+            slot = (node[2], i)
+    if i == len(words) and node[1] is not None:
+        return Death(fix_name(words[0]), None, None, node[1])
+    if slot is None:
+        return None
+    killer, _, weapon = ' '.join(words[slot[1]:]).partition(' using ')
+    return Death(fix_name(words[0]), fix_name(killer), weapon or None, slot[0])
+
+
+def send(command, lane=lane_normal):
+    # Queue a console command for the writer thread. A command identical to the last one still
+    # waiting in its lane would have the same effect, so it is merged with that one. One further
+    # back isn't, as whatever was queued in between may have undone it.
+    send_many([command], lane)
+
+
+def send_many(commands, lane=lane_normal):
+    # Queue several commands at once, to be written in order without others between them
+    with outbound_ready:
+        for command in commands:
+            command = command.strip()
+            if command == '':
+                continue
+            if len(outbound[lane]) > 0 and outbound[lane][-1] == command:
+                counters['commands_merged'] += 1
+                continue
+            if lane == lane_cosmetic and sum(map(len, outbound)) >= outbound_limit:
+                counters['commands_dropped'] += 1
+                continue
+            outbound[lane].append(command)
+        outbound_ready.notify()
+
+
+def command_writer():
+    # Drains the lanes, most important first, at no more than command_rate commands a second,
+    # or the fraction of that that the lag monitor thinks the server can take
+    global transport
+    next_send = time.monotonic()
+    retry_delay = 1
+    while True:
+        with outbound_ready:
+            while not any(outbound):
+                outbound_ready.wait()
+            for lane, queue in enumerate(outbound):
+                if len(queue) > 0:
+                    command = queue.popleft()
+                    break
+        now = time.monotonic()
+        if next_send > now:
+            time.sleep(next_send - now)
+        else:
+            next_send = now
+        # Slowed down while the server is struggling, apart from what can't wait
+        next_send += 1 / (command_rate if lane == lane_critical else command_rate * command_throttle)
+        try:
+            sent = transport.send(command)
+            # RCON hands back a future, already failed if the command couldn't be written
+            if sent is not None and sent.done() and sent.exception() is not None:
+                raise sent.exception()
+        except (OSError, ConnectionError) as e:
+            if minecraft is not None:
+                # RCON has gone away for good; the console of the server being run is still there
+                log('RCON failed, going back to the console: ' + str(e))
+                transport = ConsoleTransport()
+                transport.send(command)
+            else:
+                # Attached, there is no console. The command goes back to the front of its lane,
+                # and is tried again, less and less often, until the server can be reached.
+                log('Could not send commands (' + str(e) + '), trying again in ' + str(retry_delay) + 's')
+                with outbound_ready:
+                    outbound[lane].appendleft(command)
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+                continue
+        retry_delay = 1
+        counters['commands_sent'] += 1
+
+
+######################
+# Transports. Commands go to the server either typed into its console, or over RCON.
+
+class ConsoleTransport:
+    # Typing into the server console. Replies are mixed into the console output.
+    replies = False
+
+    def send(self, command):
+        minecraft.sendline(command)
+
+
+class RconClient:
+    # Minecraft's remote console protocol. Each packet is length, request id, type and
+    # a null-terminated body. Requests are pipelined; the server answers them in order,
+    # each with the id it was sent with, so every reply finds its own request.
+    # A long reply comes in several packets, and nothing says which is the last, so each
+    # command is followed by a request of a type the server doesn't know. Its answer comes
+    # after the whole of the command's reply.
+    replies = True
+    login, command, response = 3, 2, 0
+
+    def __init__(self, host, port, password, keepalive=30):
+        self.host, self.port, self.password = host, port, password
+        self.keepalive = keepalive
+        self.lock = threading.Lock()
+        self.sock = None
+        self.next_id = 0
+        self.waiting = {}  # Request id -> [future, reply so far]
+        self.ends = {}  # Id of the request following each command -> the command's id
+        self.last_used = time.monotonic()
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.write(sock, 0, self.login, self.password)
+        request_id, kind, body = self.read(sock)
+        if request_id == -1:
+            sock.close()
+            raise ConnectionError('RCON password was refused')
+        sock.settimeout(None)
+        self.sock = sock
+        threading.Thread(target=self.reader, args=(sock,), name='rcon reader', daemon=True).start()
+        threading.Thread(target=self.pinger, args=(sock,), name='rcon keepalive', daemon=True).start()
+
+    @staticmethod
+    def write(sock, request_id, kind, body):
+        payload = struct.pack('<ii', request_id, kind) + body.encode() + b'\0\0'
+        sock.sendall(struct.pack('<i', len(payload)) + payload)
+
+    @staticmethod
+    def read_exactly(sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if chunk == b'':
+                raise ConnectionError('RCON connection closed')
+            data += chunk
+        return data
+
+    def read(self, sock):
+        size, = struct.unpack('<i', self.read_exactly(sock, 4))
+        request_id, kind = struct.unpack('<ii', self.read_exactly(sock, 8))
+        body = self.read_exactly(sock, size - 8)[:-2]
+        return request_id, kind, body.decode(errors='replace')
+
+    def open(self):
+        with self.lock:
+            if self.sock is None:
+                self.connect()
+
+    def send(self, command):
+        # Returns a future for the server's reply to command. It never raises; a command that
+        # couldn't be sent has a future that has already failed. Connecting can take a while,
+        # so this is only called from threads other than the event loop's.
+        import concurrent.futures
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.last_used = time.monotonic()
+            request_id = self.next_id % 0x7ffffffe + 1
+            self.next_id = request_id + 1
+            try:
+                # Reconnect once, as the server may have restarted
+                for attempt in range(2):
+                    try:
+                        if self.sock is None:
+                            self.connect()
+                        self.write(self.sock, request_id, self.command, command)
+                        self.write(self.sock, request_id + 1, self.response, '')
+                        break
+                    except OSError:
+                        self.drop(self.sock)
+                        if attempt == 1:
+                            raise
+            except OSError as e:
+                future.set_exception(e)
+                return future
+            self.waiting[request_id] = [future, '']
+            self.ends[request_id + 1] = request_id
+        return future
+
+    def reader(self, sock):
+        try:
+            while True:
+                request_id, kind, body = self.read(sock)
+                with self.lock:
+                    if request_id in self.ends:
+                        future, reply = self.waiting.pop(self.ends.pop(request_id))
+                        future.set_result(reply)
+                    elif request_id in self.waiting:
+                        self.waiting[request_id][1] += body
+        except (OSError, ConnectionError, struct.error):
+            with self.lock:
+                self.drop(sock)
+
+    def drop(self, sock):
+        # Fail everything still waiting on a dead connection. Call with the lock held.
+        if sock is None or self.sock is not sock:
+            return
+        self.sock = None
+        sock.close()
+        for future, body in self.waiting.values():
+            future.set_exception(ConnectionError('RCON connection lost'))
+        self.waiting.clear()
+        self.ends.clear()
+
+    def pinger(self, sock):
+        # Stop an idle connection being timed out by anything in between
+        while self.sock is sock:
+            idle = time.monotonic() - self.last_used
+            if idle >= self.keepalive:
+                reply = self.send('list')
+                if reply.done() and reply.exception() is not None:
+                    return
+                idle = 0
+            time.sleep(self.keepalive - idle)
+
+
+def use_rcon():
+    # Called once the server says RCON is up. Commands switch over from the console.
+    rcon = RconClient(config['rcon'].get('host', 'localhost'), int(config['rcon'].get('port', 25575)),
+                      str(config['rcon'].get('password', '')))
+
+    def connected(attempt):
+        global transport
+        if attempt.exception() is not None:
+            log('Could not connect to RCON, staying on the console: ' + str(attempt.exception()))
+            return
+        transport = rcon
+        log('Sending commands by RCON')
+    # Connecting can take a while, so it's done on another thread
+    loop.run_in_executor(None, rcon.open).add_done_callback(connected)
+
+
+######################
+# Queries. Over RCON, each command has its own reply. On the console, replies are mixed in with
+# everything else, so the command is sent between two sentinel commands, each of which gets a
+# reply that's easy to spot, and whatever the server says between those is the answer.
+
+sentinel = 'uhc_sentinel_'
+queries = {}  # Query number -> future for its reply
+asking = {}  # Command -> future for its reply, while it's being asked
+query_number = 0
+query_open = None  # The number of the query whose reply is being collected, and its lines so far
+query_lines = []
+quiet_queries = set()  # Numbers of queries whose replies aren't worth showing or recording
+
+
+def query(command, callback, timeout=5, silent=False):
+    # Send command ahead of the queue, and call callback with the reply, or with None if there's no reply in time.
+    # Whoever asks the same thing while it's being asked shares the answer. A silent query's reply is
+    # for the wrapper alone, and is neither shown on the console nor recorded as events.
+    global query_number
+    if command in asking:
+        asking[command].add_done_callback(lambda future: callback(None if future.cancelled() else future.result()))
+        return asking[command]
+    query_number += 1
+    number = query_number
+    future = loop.create_future()
+    queries[number] = future
+    handle = loop.call_later(timeout, query_timeout, number)
+    future.add_done_callback(lambda future: handle.cancel())
+    asking[command] = future
+    future.add_done_callback(lambda future: asking.pop(command, None))
+    if silent:
+        quiet_queries.add(number)
+        future.add_done_callback(lambda future: quiet_queries.discard(number))
+    future.add_done_callback(lambda future: callback(None if future.cancelled() else future.result()))
+    if transport.replies:
+        # A reply that can't be had is None straight away, rather than when the query times out
+        def done(reply):
+            loop.call_soon_threadsafe(query_done, number, reply.result() if reply.exception() is None else None)
+        # Sent from another thread, as connecting can take a while
+        loop.run_in_executor(None, transport.send, command).add_done_callback(
+            lambda sent: sent.result().add_done_callback(done))
+    else:
+        # The critical lane is written in order, and ahead of everything else, so nothing comes between
+        send_many(['scoreboard players list ' + sentinel + str(number) + 'a', command,
+                   'scoreboard players list ' + sentinel + str(number) + 'z'], lane_critical)
+    return future
+
+
+def query_done(number, reply):
+    future = queries.pop(number, None)
+    if future is not None and not future.done():
+        future.set_result(reply)
+
+
+def query_timeout(number):
+    global query_open
+    future = queries.pop(number, None)
+    if future is not None:
+        log('No reply to query ' + str(number))
+        future.cancel()
+    if query_open == number:
+        query_open = None
+
+
+def collect_reply(line):
+    # Returns True if the line is a sentinel. Other lines between a query's sentinels are taken
+    # as its reply, but still go on to be classified, in case something else happened meanwhile.
+    # The sentinel's reply is 'Player uhc_sentinel_<number><a or z> has no scores recorded'.
+    global query_open, query_lines
+    if line.startswith('Player ' + sentinel):
+        token = line.split()[1][len(sentinel):]
+        if not token[:-1].isnumeric():
+            return False
+        number = int(token[:-1])
+        if token[-1] == 'a' and number in queries:
+            query_open, query_lines = number, []
+        elif token[-1] == 'z' and number == query_open:
+            query_open = None
+            query_done(number, '\n'.join(query_lines))
+        return True
+    if query_open is not None:
+        query_lines.append(line)
+    return False
+
+
+def reply_line(reply, start):
+    # The line of a reply that begins with start, and the line after it
+    lines = reply.split('\n') + ['']
+    for n in range(len(lines) - 1):
+        if lines[n].startswith(start):
+            return lines[n], lines[n + 1]
+    return None, None
+
+
+######################
+# Messages. A template is the JSON of some tellraw text components, with {slots} inside its
+# strings. It's parsed once, into the JSON between the slots; filling it in is then a matter
+# of escaping each value and joining the pieces, with no JSON to build or encode.
+
+class Template:
+    def __init__(self, text):
+        parts = re.split(r'\{(\w+)\}', text)
+        self.pieces = parts[0::2]
+        self.slots = parts[1::2]
+
+    def __call__(self, **values):
+        if self.slots == []:
+            return self.pieces[0]
+        filled = [self.pieces[0]]
+        for slot, piece in zip(self.slots, self.pieces[1:]):
+            filled.append(escape(values[slot]))
+            filled.append(piece)
+        return ''.join(filled)
+
+
+def escape(value):
+    # For the inside of a JSON string: quotes, backslashes and control characters
+    return encode_basestring(str(value))[1:-1]
+
+
+gold_message = Template('{"text":"{message}","color":"gold"}')
+coloured_message = Template('{"text":"{message}","color":"{colour}"}')
+team_members_message = Template('{"text":"Your team members are ","color":"gold"},{"selector":"@a[team={team}]"}')
+help_message = Template('{"text":"!{command}","color":"white"},{"text":" {description}","color":"gold"}')
+title_message = Template('title {target} {position} {"text":"{message}","color":"{colour}"}')
+congratulations_message = Template(
+    'tellraw @a [{"text":"Congratulations to ","color":"gold"},{"selector":"@a[team={team}]"}]')
+line_break = ',{"text":"\\n"},' + uhc_prefix + ','
+tellraw_limit = 30000  # The server won't take a chat message much longer than 32k of JSON
+
+
+def tell(name, lines):
+    # Lines of filled-in components, each after the [UHC] prefix. As many as fit are sent in one tellraw.
+    commands = []
+    batch = []
+    size = 0
+    for line in lines:
+        if batch != [] and size + len(line) > tellraw_limit:
+            commands.append('tellraw ' + name + ' [' + uhc_prefix + ',' + line_break.join(batch) + ']')
+            batch, size = [], 0
+        batch.append(line)
+        size += len(line) + len(line_break)
+    if batch != []:
+        commands.append('tellraw ' + name + ' [' + uhc_prefix + ',' + line_break.join(batch) + ']')
+    send_many(commands, lane_cosmetic)
 
 
 def announce(name, json_message):
-    minecraft.sendline('tellraw ' + name + ' [' + uhc_prefix + ',' + json_message + ']')
+    tell(name, [json_message])
 
 
 def announce_all(json_message):
     announce('@a', json_message)
 
 
-def announce_gold(name, message):
-    announce(name, '{"text":"' + message + '","color":"gold"}')
+def announce_gold(name, *messages):
+    # Several messages are shown on separate lines of one tellraw
+    tell(name, [gold_message(message=message) for message in messages])
 
 
-def announce_all_gold(message):
-    announce_gold('@a', message)
+def announce_all_gold(*messages):
+    announce_gold('@a', *messages)
 
 
+######################
+# Scoreboard. What the server's scoreboard is known to hold: teams, their options and members,
+# objectives, and the scores set here. Each change is made by saying what it should hold, and
+# only the commands for what differs are sent. Until the wrapper has set something up itself,
+# e.g. after a restart, it can't know what's there, and the first change clears out anything
+# that might be.
+
+board_teams = None  # Team number -> [display name, {option: value}], once known
+board_members = {}  # Player -> team number
+board_objectives = None  # Objective -> criterion, once known
+board_display = {}  # Display slot -> objective
+board_scores = {}  # (player, objective) -> score, for scores set here by name
+board_batch = 20  # Most players named in one command
+lobby_objectives = {'health': 'health', 'spectating': 'dummy'}
+game_objectives = dict(lobby_objectives, dead='stat.deaths', indeathroom='dummy')
+
+
+def batched(command, names):
+    return [command + ' ' + ' '.join(names[start:start + board_batch]) for start in range(0, len(names), board_batch)]
+
+
+def sync_teams(wanted, members):
+    # Makes the teams wanted (number -> display name), as a new match has them, with members
+    # (player -> team number) in them, and nobody else
+    global board_teams
+    commands = []
+    if board_teams is None:
+        # Teams left over from before a restart are only known to be among the first few
+        commands += ['scoreboard teams remove ' + str(team)
+                     for team in range(max(len(teamcolours), len(teams), len(wanted)))]
+        board_teams = {}
+        board_members.clear()
+    # A team's display name can't be changed; it has to be made again
+    for team in sorted(board_teams):
+        if wanted.get(team) != board_teams[team][0]:
+            commands.append('scoreboard teams remove ' + str(team))
+            del board_teams[team]
+    for player in [player for player, team in board_members.items() if team not in board_teams]:
+        del board_members[player]
+    for team in sorted(wanted):
+        if team not in board_teams:
+            commands.append('scoreboard teams add ' + str(team) + ' ' + wanted[team])
+            board_teams[team] = [wanted[team], {}]
+        commands += team_options(team, color=team_colour(team), nametagVisibility='hideForOtherTeams')
+    leaving = sorted(player for player in board_members if player not in members)
+    commands += batched('scoreboard teams leave', leaving)
+    for player in leaving:
+        del board_members[player]
+    commands += team_joins(members)
+    send_many(commands)
+
+
+def team_options(team, **options):
+    # Commands for the options that aren't known to be as given already
+    known = board_teams[team][1] if board_teams is not None and team in board_teams else {}
+    commands = []
+    for option, value in options.items():
+        if known.get(option) != value:
+            commands.append('scoreboard teams option ' + str(team) + ' ' + option + ' ' + value)
+            known[option] = value
+    return commands
+
+
+def team_joins(members):
+    # Commands putting players (player -> team number) into their teams, from wherever they
+    # are. A single join command can take many players.
+    joining = {}
+    for player, team in members.items():
+        if board_members.get(player) != team:
+            joining.setdefault(team, []).append(player)
+            board_members[player] = team
+    return [command for team in sorted(joining)
+            for command in batched('scoreboard teams join ' + str(team), sorted(joining[team]))]
+
+
+def sync_objectives(wanted, display):
+    # Makes the objectives wanted (objective -> criterion) and no others, shown in the display
+    # slots given (slot -> objective). Removing an objective is the only way to clear its scores.
+    global board_objectives
+    commands = []
+    if board_objectives is None:
+        # Any of the wrapper's objectives might be there, made for anything
+        board_objectives = dict.fromkeys(game_objectives, 'unknown')
+        board_display.clear()
+    for objective in sorted(board_objectives):
+        if wanted.get(objective) != board_objectives[objective]:
+            commands.append('scoreboard objectives remove ' + objective)
+            del board_objectives[objective]
+            forget_scores(objective)
+            for slot in [slot for slot, shown in board_display.items() if shown == objective]:
+                del board_display[slot]
+    for objective in sorted(wanted):
+        if objective not in board_objectives:
+            commands.append('scoreboard objectives add ' + objective + ' ' + wanted[objective])
+            board_objectives[objective] = wanted[objective]
+    for slot in sorted(display):
+        if board_display.get(slot) != display[slot]:
+            commands.append('scoreboard objectives setdisplay ' + slot + ' ' + display[slot])
+            board_display[slot] = display[slot]
+    send_many(commands)
+
+
+def set_score(target, objective, score, lane=lane_normal):
+    # A selector may set anybody's score, so what was known about that objective no longer is
+    if target.startswith('@'):
+        forget_scores(objective)
+    elif board_scores.get((target, objective)) == score:
+        return
+    else:
+        board_scores[(target, objective)] = score
+    send('scoreboard players set ' + target + ' ' + objective + ' ' + str(score), lane)
+
+
+def forget_scores(objective):
+    for key in [key for key in board_scores if key[1] == objective]:
+        del board_scores[key]
+
+
+######################
+# Teams
+
 def destroy_teams():
-    # Scoreboard
-    for teamnumber in range(0, 15):
-        minecraft.sendline('scoreboard teams remove ' + str(teamnumber) + '\n')
+    sync_teams({}, {})
     # Internal
+    clear_teams()
+
+
+def clear_teams():
     playerteams.clear()
+    teammembers.clear()
+    live_teams.clear()
     teams.clear()
+    journal('clear')
+
+
+def join_team(name, team):
+    leave_team(name)
+    playerteams[name] = team
+    teammembers.setdefault(team, set()).add(name)
+    live_teams.add(team)
+    journal('join', name, team)
+
+
+def leave_team(name):
+    # Returns the team the player was in, if any. A team that has lost its last member is no longer live.
+    team = playerteams.pop(name, None)
+    if team is not None:
+        teammembers[team].discard(name)
+        if len(teammembers[team]) == 0:
+            live_teams.discard(team)
+        journal('leave', name)
+    return team
+
+
+def team_lines(team):
+    return [coloured_message(message='Your team is ' + teams[team], colour=team_colour(team)),
+            team_members_message(team=team)]
 
 
 def show_team(name):
     if name in playerteams:
-        team = playerteams[name]
-        minecraft.sendline(
-            'tellraw ' + name + ' [' + uhc_prefix + ',{"text":"Your team is ' + teams[team] + '",' +
-            '"color":"' + teamcolours[team] + '"}]\n')
-        minecraft.sendline(
-            'tellraw ' + name + ' [' + uhc_prefix + ',{"text":"Your team members are ","color":"gold"},' +
-            '{"selector":"@a[team=' + str(team) + ']"}]\n')
+        tell(name, team_lines(playerteams[name]))
     else:
         announce_gold(name, 'You have not yet been assigned to a team')
 
 
 def show_teams():
     for team in teams:
-        minecraft.sendline('tellraw @a[team=' + str(team) + '] [' + uhc_prefix + ',{"text":"Your team is ' + teams[
-            team] + '","color":"' + teamcolours[team] + '"}]\n')
-        minecraft.sendline('tellraw @a[team=' + str(
-            team) + '] [' + uhc_prefix + ',{"text":"Your team members are ","color":"gold"},' +
-                           '{"selector":"@a[team=' + str(team) + ']"}]\n')
-    for spectator in spectators:
+        tell('@a[team=' + str(team) + ']', team_lines(team))
+    for spectator in sorted(spectators):
         announce_gold(spectator, 'You are a spectator')
 
 
+def team_colour(team):
+    # There are only so many colours. Teams beyond those share them, and are told apart by name.
+    return teamcolours[team % len(teamcolours)]
+
+
+def team_name(teamnumber, names):
+    # Team names are used in turn. Where a colour comes round again, a prefix tells
+    # the teams wearing it apart; where the names run out, they are used again, numbered.
+    name = names[teamnumber % len(names)]
+    if teamnumber >= len(names):
+        name += ' ' + str(teamnumber // len(names) + 1)
+    rounds = teamnumber // len(teamcolours)
+    if rounds > 0:
+        name = ['II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X'][min(rounds, 9) - 1] + ' ' + name
+    return name[:32]  # Longest display name a scoreboard team can have
+
+
+def allocate_teams(pool, number_of_teams):
+    # Returns a team number for each player. Team sizes differ by no more than one, except
+    # where keeping friends together makes that impossible. Declared friend groups are
+    # placed first, biggest first; then everybody else, best first, each into the smallest
+    # team with the lowest total skill, so that skill is spread as evenly as sizes.
+    skill = config.get('skill', {})
+    biggest = math.ceil(len(pool) / number_of_teams)
+    placed = set()
+    units = []
+    for group in config.get('friends', []):
+        group = [name for name in group if name in pool and name not in placed]
+        # A group too big for one team is split
+        for start in range(0, len(group), biggest):
+            units.append(group[start:start + biggest])
+        placed.update(group)
+    singles = [name for name in pool if name not in placed]
+    random.shuffle(singles)
+    units.sort(key=len, reverse=True)
+    units.extend([name] for name in sorted(singles, key=lambda name: skill.get(name, 0), reverse=True))
+    sizes = [0] * number_of_teams
+    totals = [0] * number_of_teams
+    allocation = {}
+    for unit in units:
+        fits = [team for team in range(number_of_teams) if sizes[team] + len(unit) <= biggest]
+        if fits == []:
+            # Nowhere left for the whole group; its members are placed one at a time
+            units.extend([name] for name in unit)
+            continue
+        team = min(fits, key=lambda team: (sizes[team], totals[team]))
+        for name in unit:
+            allocation[name] = team
+        sizes[team] += len(unit)
+        totals[team] += sum(skill.get(name, 0) for name in unit)
+    return allocation
+
+
+@timed('create_teams')
 def create_teams():
-    destroy_teams()
-    teampool = list(players - spectators)
+    teampool = sorted(players - spectators)
     if len(teampool) == 0:
+        destroy_teams()
         announce_all_gold('Cannot assign teams, because everybody is spectating')
         return
-    number_of_teams = min(math.ceil(len(teampool) / teamsize), 15)  # hard-coded max of 15 teams
-    teamnames = config['teamnames'].copy()
-    global teams
-    global playerteams
-    # Create actual teams
-    random.shuffle(teamnames)
-    for teamnumber in range(0, number_of_teams):
-        if teamnumber < number_of_teams:  # teamnumber is indexed from zero
-            # Internal
-            teams[teamnumber] = teamnames.pop()
-            # Scoreboard
-            minecraft.sendline('scoreboard teams add ' + str(teamnumber) + ' ' + teams[teamnumber] + '\n')
-            minecraft.sendline(
-                'scoreboard teams option ' + str(teamnumber) + ' color ' + teamcolours[teamnumber] + '\n')
-            minecraft.sendline('scoreboard teams option ' + str(teamnumber) + ' nametagVisibility hideForOtherTeams\n')
-    # Randomly assign players to those teams
-    random.shuffle(teampool)
+    number_of_teams = math.ceil(len(teampool) / teamsize)
+    # Drawn again with as many teams as before, the teams keep their names, and the scoreboard
+    # only needs telling who has changed team
+    if len(teams) == number_of_teams:
+        names = dict(teams)
+    else:
+        teamnames = config['teamnames'].copy()
+        random.shuffle(teamnames)
+        names = {teamnumber: team_name(teamnumber, teamnames) for teamnumber in range(number_of_teams)}
     # Internal
-    while len(teampool) > 0:
-        for teamnumber in teams:
-            if len(teampool) > 0:
-                playerteams[teampool.pop()] = teamnumber
-    # Scoreboard
-    for player in playerteams:
-        minecraft.sendline('scoreboard teams join ' + str(playerteams[player]) + ' ' + player + '\n')
+    clear_teams()
+    teams.update(names)
+    journal('teams', sorted(teams.items()))
+    for player, teamnumber in allocate_teams(teampool, number_of_teams).items():
+        join_team(player, teamnumber)
+    sync_teams(teams, playerteams)
     show_teams()
-    minecraft.sendline('effect @a minecraft:glowing 3 1 true')
+    send('effect @a minecraft:glowing 3 1 true', lane_cosmetic)
 
 
 def swap_team_member(player1, player2):
     if set(playerteams.keys()) & {player1, player2} == {player1, player2}:
         # Internal
-        playerteams[player1], playerteams[player2] = playerteams[player2], playerteams[player1]
-        # Scoreboard
-        minecraft.sendline('scoreboard teams leave ' + player1 + '\r')
-        minecraft.sendline('scoreboard teams leave ' + player2 + '\r')
-        minecraft.sendline('scoreboard teams join ' + str(playerteams[player1]) + ' ' + player1 + '\r')
-        minecraft.sendline('scoreboard teams join ' + str(playerteams[player2]) + ' ' + player2 + '\r')
-        minecraft.sendline('effect @a[team=' + str(playerteams[player1]) + '] minecraft:glowing 3 1 true')
-        minecraft.sendline('effect @a[team=' + str(playerteams[player2]) + '] minecraft:glowing 3 1 true')
-
-
-def spectate(name, args):
-    if args == '':
+        team1, team2 = playerteams[player1], playerteams[player2]
+        join_team(player1, team2)
+        join_team(player2, team1)
+        # Scoreboard. Joining a team takes a player out of the one they were in.
+        send_many(team_joins({player1: team2, player2: team1}))
+        send('effect @a[team=' + str(playerteams[player1]) + '] minecraft:glowing 3 1 true', lane_cosmetic)
+        send('effect @a[team=' + str(playerteams[player2]) + '] minecraft:glowing 3 1 true', lane_cosmetic)
+
+
+def spectate(name, names):
+    if names == []:
         announce_gold(name, 'Toggle spectators by providing their names (case sensitive)')
     else:
-        for spectator in args.split():
+        for spectator in names:
             if spectator in spectators:
                 spectators.remove(spectator)
                 if time_start is not None:
-                    minecraft.sendline('scoreboard players set ' + spectator + ' spectating 0\n')
+                    set_score(spectator, 'spectating', 0)
             else:
                 spectators.add(spectator)
                 if time_start is not None:
-                    minecraft.sendline('scoreboard players set ' + spectator + ' spectating 1\n')
-                    minecraft.sendline('gamemode 3 ' + spectator + '\n')
-    spectator_output = list()
-    for spectator in spectators:
-        spectator_output.append(', ')
-        spectator_output.append(spectator)
-    spectator_output.pop(0)
-    if len(spectator_output) > 2:
-        spectator_output[1] = ' and '
-    spectator_output.reverse()
-    output = ''
-    for w in spectator_output:
-        output = output + w
-    announce_gold(name, 'Spectators: ' + output)
+                    set_score(spectator, 'spectating', 1)
+                    send('gamemode 3 ' + spectator, lane_critical)
+        journal('spectators', sorted(spectators))
+    listed = sorted(spectators)
+    if len(listed) > 1:
+        listed[-2:] = [listed[-2] + ' and ' + listed[-1]]
+    announce_gold(name, 'Spectators: ' + (', '.join(listed) or 'none'))
+
+
+######################
+# Structures. Each is a list of volumes (x1, y1, z1, x2, y2, z2, block), where later volumes
+# overwrite earlier ones. A block is given as for setblock, including any data value and NBT.
+
+def lobby_structure():
+    return [(x - 9, 251, z - 9, x + 8, 255, z + 8, 'minecraft:barrier'),
+            (x - 9, 255, z - 9, x + 8, 255, z + 8, 'minecraft:stained_glass 15'),
+            (x - 8, 253, z - 8, x + 7, 255, z + 7, 'minecraft:air'),
+            (x, 252, z, x, 252, z, 'minecraft:end_portal_frame 4'),
+            (x, 253, z, x, 253, z, 'minecraft:stained_glass_pane 3')]
+
+
+def no_lobby_structure():
+    return [(x - 9, 251, z - 9, x + 8, 255, z + 8, 'minecraft:air')]
+
+
+def command_block(dx, dz, kind, command):
+    return (x + dx, 1, z + dz, x + dx, 1, z + dz,
+            'minecraft:' + kind + '_command_block 3 replace {auto:1b,Command:"' + command + '"}')
+
+
+def command_bank_structure(*command_blocks):
+    return [(x, 0, z, x + 15, 2, z + 15, 'minecraft:bedrock')] + list(command_blocks)
+
+
+def lobby_command_bank():
+    return command_bank_structure(
+        command_block(1, 1, 'repeating', 'effect @a minecraft:regeneration 5 20 true'),
+        command_block(1, 2, 'chain', 'effect @a minecraft:saturation 5 20 true'),
+        command_block(1, 3, 'chain', 'effect @a minecraft:weakness 1 20 true'),
+        command_block(3, 1, 'repeating', 'tp @e[tag=Origin] ~ ~ ~ ~10 ~'),
+        command_block(3, 2, 'chain', 'weather clear'))
+
+
+def game_command_bank():
+    # Blocks to update the scoreboards
+    return command_bank_structure(
+        command_block(1, 1, 'repeating', 'scoreboard players set @a indeathroom 0'),
+        command_block(1, 2, 'chain', 'scoreboard players set @e[type=Player,x=' + str(x + 1) + ',y=4,z=' + str(
+            z + 1) + ',dx=14,dy=3,dz=14] indeathroom 1'),
+        command_block(1, 3, 'chain', 'tp @e[type=Player,score_indeathroom=0,score_dead_min=1] ' + str(
+            x + 8) + ' 4 ' + str(z + 8)),
+        command_block(1, 4, 'chain', 'effect @a[score_indeathroom_min=1] minecraft:regeneration 5 20 true'),
+        command_block(1, 5, 'chain', 'effect @a[score_indeathroom_min=1] minecraft:saturation 5 20 true'),
+        command_block(1, 6, 'chain', 'effect @a[score_indeathroom_min=1] minecraft:weakness 1 20 true'),
+        command_block(1, 7, 'chain', 'gamemode 2 @a[score_dead_min=1,m=!2]'),
+        command_block(3, 1, 'repeating', 'tp @e[tag=DeathRoom] ~ ~ ~ ~5 ~'),
+        command_block(3, 2, 'chain', 'execute @e[tag=DeathRoom] ~ ~ ~ spawnpoint @a ~ ~1 ~'),
+        command_block(5, 1, 'repeating', 'effect @a[score_spectating_min=1] minecraft:night_vision 20 20 true'))
+
+
+def death_room_structure():
+    return [(x, 3, z, x + 15, 7, z + 15, 'minecraft:bedrock'),
+            (x + 1, 5, z + 1, x + 14, 6, z + 14, 'minecraft:air'),
+            (x + 1, 4, z + 1, x + 14, 4, z + 14, 'minecraft:carpet'),
+            (x + 1, 3, z + 1, x + 14, 3, z + 14, 'minecraft:glowstone')]
+
+
+# The structure last built in each region, so that unchanged blocks needn't be sent again
+built_structures = {}
+fill_limit = 32768  # Most blocks a single fill may change
+
+
+def structure_cells(volumes, bounds):
+    # The number of the volume that has the last word at each cell of the grid made by bounds,
+    # with cells that no volume covers left out
+    xs, ys, zs = bounds
+    cells = {}
+    for i in range(len(xs) - 1):
+        for j in range(len(ys) - 1):
+            for k in range(len(zs) - 1):
+                for n in range(len(volumes) - 1, -1, -1):
+                    x1, y1, z1, x2, y2, z2, block = volumes[n]
+                    if x1 <= xs[i] <= x2 and y1 <= ys[j] <= y2 and z1 <= zs[k] <= z2:
+                        cells[(i, j, k)] = n
+                        break
+    return cells
+
+
+def plan_fills(volumes, previous=None):
+    # Works out the final block everywhere in volumes, and returns the fewest fills it can find
+    # that set each block which differs from previous. That is either the volumes themselves, in
+    # order, so that later ones overwrite earlier ones, or non-overlapping boxes of one block each.
+    # Volume edges split space into a grid of cells that are each a single block type.
+    bounds = (set(), set(), set())
+    for volume in volumes + (previous or []):
+        for axis in range(3):
+            bounds[axis].add(volume[axis])
+            bounds[axis].add(volume[axis + 3] + 1)
+    bounds = tuple(sorted(axis) for axis in bounds)
+    shown = structure_cells(volumes, bounds)
+    final = {cell: volumes[n][6] for cell, n in shown.items()}
+    if previous is None:
+        todo = set(final)
+    else:
+        existing = {cell: previous[n][6] for cell, n in structure_cells(previous, bounds).items()}
+        todo = set(cell for cell, block in final.items() if existing.get(cell) != block)
+    if len(todo) == 0:
+        return []
+    # Cells that already hold a box's block may be included in it for free, as
+    # re-setting a block to what it already is doesn't change or update it
+    free = set(final)
+    plan = []
+    for cell in sorted(todo, key=lambda cell: (cell[1], cell[2], cell[0])):
+        if cell not in free:
+            continue
+        box = largest_box(cell, final[cell], final, free, bounds)
+        for i in range(box[0], box[3] + 1):
+            for j in range(box[1], box[4] + 1):
+                for k in range(box[2], box[5] + 1):
+                    free.discard((i, j, k))
+        xs, ys, zs = bounds
+        plan.append((xs[box[0]], ys[box[1]], zs[box[2]], xs[box[3] + 1] - 1, ys[box[4] + 1] - 1, zs[box[5] + 1] - 1,
+                     final[cell]))
+    plan = merge_boxes(plan)
+    # Hollow and nested structures take far fewer fills built up in layers, which rebuilds all of them
+    layers = [volume for n, volume in enumerate(volumes) if n in shown.values()]
+    if len(layers) < len(plan) and all(box_size(volume) <= fill_limit for volume in layers):
+        return layers
+    return plan
+
+
+def box_size(box):
+    return (box[3] - box[0] + 1) * (box[4] - box[1] + 1) * (box[5] - box[2] + 1)
+
+
+def merge_boxes(boxes):
+    # Joins boxes of the same block that meet face to face, and together make a box, until no two do
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for first in range(len(boxes)):
+            for second in range(first + 1, len(boxes)):
+                joined = joined_box(boxes[first], boxes[second])
+                if joined is not None:
+                    boxes[first] = joined
+                    del boxes[second]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def joined_box(a, b):
+    # The box made of a and b, if they're of one block, the same on two axes, and touching on the third
+    if a[6] != b[6]:
+        return None
+    differ = [axis for axis in range(3) if (a[axis], a[axis + 3]) != (b[axis], b[axis + 3])]
+    if len(differ) != 1:
+        return None
+    axis = differ[0]
+    if a[axis + 3] + 1 != b[axis] and b[axis + 3] + 1 != a[axis]:
+        return None
+    joined = list(a)
+    joined[axis], joined[axis + 3] = min(a[axis], b[axis]), max(a[axis + 3], b[axis + 3])
+    if box_size(joined) > fill_limit:
+        return None
+    return tuple(joined)
+
+
+def largest_box(cell, block, final, free, bounds):
+    # Grows a box of block from cell one axis at a time, trying each order of axes
+    def fits(low, high):
+        for i in range(low[0], high[0] + 1):
+            for j in range(low[1], high[1] + 1):
+                for k in range(low[2], high[2] + 1):
+                    if (i, j, k) not in free or final[(i, j, k)] != block:
+                        return False
+        return True
+
+    def blocks(low, high):
+        size = 1
+        for axis in range(3):
+            size *= bounds[axis][high[axis] + 1] - bounds[axis][low[axis]]
+        return size
+
+    best, best_size = None, 0
+    for order in ((0, 2, 1), (0, 1, 2), (1, 0, 2), (1, 2, 0), (2, 0, 1), (2, 1, 0)):
+        low, high = list(cell), list(cell)
+        for axis in order:
+            while high[axis] + 2 < len(bounds[axis]):
+                # Try one more slice of cells along this axis
+                grown = list(high)
+                grown[axis] += 1
+                slice_low = list(low)
+                slice_low[axis] = grown[axis]
+                if not fits(slice_low, grown) or blocks(low, grown) > fill_limit:
+                    break
+                high = grown
+        if blocks(low, high) > best_size:
+            best, best_size = tuple(low) + tuple(high), blocks(low, high)
+    return best
+
+
+def build_structure(region, volumes):
+    for x1, y1, z1, x2, y2, z2, block in plan_fills(volumes, built_structures.get(region)):
+        if (x1, y1, z1) == (x2, y2, z2):
+            send('setblock ' + str(x1) + ' ' + str(y1) + ' ' + str(z1) + ' ' + block)
+        else:
+            send('fill ' + str(x1) + ' ' + str(y1) + ' ' + str(z1) + ' ' + str(x2) + ' ' + str(y2) + ' ' + str(
+                z2) + ' ' + block)
+    built_structures[region] = volumes
 
 
 def build_lobby():
     # Refresh players
-    minecraft.sendline('list\n')
+    refresh_players()
     dead_players.clear()
+    journal('undead')
     # Build a lobby
-    minecraft.sendline(
-        'fill ' + str(x - 9) + ' 251 ' + str(z - 9) + ' ' + str(x + 8) + ' 255 ' + str(z + 8) + ' minecraft:barrier\n')
-    minecraft.sendline('fill ' + str(x - 9) + ' 255 ' + str(z - 9) + ' ' + str(x + 8) + ' 255 ' + str(
-        z + 8) + ' minecraft:stained_glass 15\n')
-    minecraft.sendline(
-        'fill ' + str(x - 8) + ' 253 ' + str(z - 8) + ' ' + str(x + 7) + ' 255 ' + str(z + 7) + ' minecraft:air\n')
-    minecraft.sendline('setblock ' + str(x) + ' 252 ' + str(z) + ' minecraft:end_portal_frame 4\n')
-    minecraft.sendline('setblock ' + str(x) + ' 253 ' + str(z) + ' minecraft:stained_glass_pane 3\n')
-    minecraft.sendline('setworldspawn ' + str(x) + ' 253 ' + str(z))
+    build_structure('lobby', lobby_structure())
+    send('setworldspawn ' + str(x) + ' 253 ' + str(z))
     # Decorate it and set the spawn
-    minecraft.sendline('kill @e[tag=Origin]\n')
-    minecraft.sendline('summon ArmorStand ' + str(x) + ' 252 ' + str(
+    send('kill @e[tag=Origin]')
+    send('summon ArmorStand ' + str(x) + ' 252 ' + str(
         z) + ' {DisabledSlots:2039567,Invisible:1,CustomName:"UHC Lobby",CustomNameVisible:1,' +
                        'HandItems:[{id:iron_sword},{id:iron_sword}],' +
                        'ArmorItems:[{},{},{},{id:diamond_block,Count:1,tag:{ench:[{id:0,lvl:1}]}}],' +
-                       'CustomNameVisible:1,Invulnerable:1}\n')
-    minecraft.sendline(
-        'scoreboard players tag @e[type=ArmorStand,x=' + str(x) + ',y=252,z=' + str(z) + ',c=1] add Origin\n')
-    minecraft.sendline(
-        'entitydata @e[tag=Origin] {Pose:{LeftArm:[0f,-90f,-60f],RightArm:[0f,90f,60f],Head:[0f,45f,0f]}}\n')
+                       'CustomNameVisible:1,Invulnerable:1}')
+    send(
+        'scoreboard players tag @e[type=ArmorStand,x=' + str(x) + ',y=252,z=' + str(z) + ',c=1] add Origin')
+    send(
+        'entitydata @e[tag=Origin] {Pose:{LeftArm:[0f,-90f,-60f],RightArm:[0f,90f,60f],Head:[0f,45f,0f]}}')
     # Build the command blocks
-    minecraft.sendline(
-        'fill ' + str(x) + ' 0 ' + str(z) + ' ' + str(x + 15) + ' 2 ' + str(z + 15) + ' minecraft:bedrock\n')
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 1) + ' minecraft:repeating_command_block 3 replace {auto:1b,' +
-                       'Command:"effect @a minecraft:regeneration 5 20 true"}\n')
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 2) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"effect @a minecraft:saturation 5 20 true"}\n')
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 3) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"effect @a minecraft:weakness 1 20 true"}\n')
-    minecraft.sendline('setblock ' + str(x + 3) + ' 1 ' + str(
-        z + 1) + ' minecraft:repeating_command_block 3 replace {auto:1b,' +
-                       'Command:"tp @e[tag=Origin] ~ ~ ~ ~10 ~"}\n')
-    minecraft.sendline('setblock ' + str(x + 3) + ' 1 ' + str(
-        z + 2) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"weather clear"}\n')
+    build_structure('commandbank', lobby_command_bank())
     # Put everybody in the lobby
-    minecraft.sendline('gamemode 2 @a')
-    minecraft.sendline('spreadplayers ' + str(x) + ' ' + str(z) + ' 0 6 true @a')
+    send('gamemode 2 @a')
+    send('spreadplayers ' + str(x) + ' ' + str(z) + ' 0 6 true @a')
     announce_all_gold('Welcome to the Ultra Hardcore lobby')
 
 
 def destroy_lobby():
-    minecraft.sendline('kill @e[tag=Origin]\n')
-    minecraft.sendline(
-        'fill ' + str(x - 9) + ' 251 ' + str(z - 9) + ' ' + str(x + 8) + ' 255 ' + str(z + 8) + ' minecraft:air\n')
-    minecraft.sendline(
-        'fill ' + str(x) + ' 0 ' + str(z) + ' ' + str(x + 15) + ' 2 ' + str(z + 15) + ' minecraft:bedrock\n')
+    send('kill @e[tag=Origin]')
+    build_structure('lobby', no_lobby_structure())
+    build_structure('commandbank', command_bank_structure())
 
 
 def prepare_game():
     # Set some game rules
-    minecraft.sendline('gamerule doDaylightCycle false\n')
-    minecraft.sendline('gamerule commandBlockOutput false\n')
-    minecraft.sendline('gamerule logAdminCommands false\n')
-    minecraft.sendline('gamerule naturalRegeneration false\n')
-    minecraft.sendline('time set 6000\n')
-    minecraft.sendline('worldborder center ' + str(x) + ' ' + str(z) + '\n')
-    # Clear in-play objectives
-    minecraft.sendline('scoreboard objectives remove dead\n')
-    minecraft.sendline('scoreboard objectives remove spectating\n')
-    minecraft.sendline('scoreboard objectives remove indeathroom\n')
-    # Create basic objective
-    minecraft.sendline('scoreboard objectives add health health\n')
-    minecraft.sendline('scoreboard objectives setdisplay list health\n')
-    minecraft.sendline('scoreboard objectives add spectating dummy\n')
+    send('gamerule doDaylightCycle false')
+    send('gamerule commandBlockOutput false')
+    send('gamerule logAdminCommands false')
+    send('gamerule naturalRegeneration false')
+    send('time set 6000')
+    send('worldborder center ' + str(x) + ' ' + str(z))
+    # Clear in-play objectives, and show health
+    sync_objectives(lobby_objectives, {'list': 'health'})
     global time_start
     time_start = None
+    journal('set', 'time_start', None)
 
 
 def begin_game():
+    stop_pregen('the match has begun')
     # Create a room for dead players
-    minecraft.sendline(
-        'fill ' + str(x) + ' 3 ' + str(z) + ' ' + str(x + 15) + ' 7 ' + str(z + 15) + ' minecraft:bedrock\n')
-    minecraft.sendline(
-        'fill ' + str(x + 1) + ' 5 ' + str(z + 1) + ' ' + str(x + 14) + ' 6 ' + str(z + 14) + ' minecraft:air\n')
-    minecraft.sendline(
-        'fill ' + str(x + 1) + ' 4 ' + str(z + 1) + ' ' + str(x + 14) + ' 4 ' + str(z + 14) + ' minecraft:carpet\n')
-    minecraft.sendline(
-        'fill ' + str(x + 1) + ' 3 ' + str(z + 1) + ' ' + str(x + 14) + ' 3 ' + str(z + 14) + ' minecraft:glowstone\n')
+    build_structure('deathroom', death_room_structure())
     # Move players from the lobby, clear their inventories
-    minecraft.sendline('tp @a ' + str(x + 8) + ' 4 ' + str(z + 8) + '\n')
-    minecraft.sendline('clear @a\n')
-    # Lose the lobby
-    destroy_lobby()
+    send('tp @a ' + str(x + 8) + ' 4 ' + str(z + 8))
+    send('clear @a')
+    # Lose the lobby. Its command blocks are replaced below.
+    send('kill @e[tag=Origin]')
+    build_structure('lobby', no_lobby_structure())
     # Decorate it
-    minecraft.sendline('kill @e[tag=DeathRoom]')
-    minecraft.sendline('summon ArmorStand ' + str(x + 8) + ' 3 ' + str(
+    send('kill @e[tag=DeathRoom]')
+    send('summon ArmorStand ' + str(x + 8) + ' 3 ' + str(
         z + 8) + ' {DisabledSlots:2039567,Invisible:1,CustomName:"Death Room",CustomNameVisible:1,' +
                        'ArmorItems:[{},{},{},{id:redstone_block,Count:1,tag:{ench:[{id:0,lvl:1}]}}],' +
-                       'CustomNameVisible:1,Invulnerable:1}\n')
-    minecraft.sendline(
-        'scoreboard players tag @e[type=ArmorStand,x=' + str(x + 8) + ',y=3,z=' + str(z + 8) + ',c=1] add DeathRoom\n')
+                       'CustomNameVisible:1,Invulnerable:1}')
+    send(
+        'scoreboard players tag @e[type=ArmorStand,x=' + str(x + 8) + ',y=3,z=' + str(z + 8) + ',c=1] add DeathRoom')
     global time_start
-    time_start = time.time()
+    global flag_border
+    global flag_visibility
+    global flag_eternal
+    global match_decided
+    time_start = clock()
+    flag_border, flag_visibility, flag_eternal = True, True, True
+    match_decided = False
+    schedule_game_events()
+    journal_snapshot()
+    stats_begin()
     # Scoreboard to control it all
-    minecraft.sendline('scoreboard objectives add dead stat.deaths\n')
-    minecraft.sendline('scoreboard objectives add indeathroom dummy\n')
-    # Blocks to update the scoreboards
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 1) + ' minecraft:repeating_command_block 3 replace {auto:1b,' +
-                       'Command:"scoreboard players set @a indeathroom 0"}\n')
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 2) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"scoreboard players set @e[type=Player,x=' + str(
-        x + 1) + ',y=4,z=' + str(z + 1) + ',dx=14,dy=3,dz=14] indeathroom 1"}\n')
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 3) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"tp @e[type=Player,score_indeathroom=0,score_dead_min=1] ' + str(
-        x + 8) + ' 4 ' + str(z + 8) + '"}\n')
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 4) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"effect @a[score_indeathroom_min=1] minecraft:regeneration 5 20 true"}\n')
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 5) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"effect @a[score_indeathroom_min=1] minecraft:saturation 5 20 true"}\n')
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 6) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"effect @a[score_indeathroom_min=1] minecraft:weakness 1 20 true"}\n')
-    minecraft.sendline('setblock ' + str(x + 1) + ' 1 ' + str(
-        z + 7) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"gamemode 2 @a[score_dead_min=1,m=!2]"}\n')
-    minecraft.sendline('setblock ' + str(x + 3) + ' 1 ' + str(
-        z + 1) + ' minecraft:repeating_command_block 3 replace {auto:1b,' +
-                       'Command:"tp @e[tag=DeathRoom] ~ ~ ~ ~5 ~"}\n')
-    minecraft.sendline('setblock ' + str(x + 3) + ' 1 ' + str(
-        z + 2) + ' minecraft:chain_command_block 3 replace {auto:1b,' +
-                       'Command:"execute @e[tag=DeathRoom] ~ ~ ~ spawnpoint @a ~ ~1 ~"}\n')
-    minecraft.sendline('setblock ' + str(x + 5) + ' 1 ' + str(
-        z + 1) + ' minecraft:repeating_command_block 3 replace {auto:1b,' +
-                       'Command:"effect @a[score_spectating_min=1] minecraft:night_vision 20 20 true"}\n')
+    sync_objectives(game_objectives, {'list': 'health'})
+    build_structure('commandbank', game_command_bank())
     # Set the border
-    minecraft.send('worldborder set ' + str(config['worldborder']['start']) + '\n')
+    send('worldborder set ' + str(config['worldborder']['start']), lane_critical)
     # Deal with spectators
-    minecraft.sendline('scoreboard players set @a spectating 0\n')
-    for spectator in players & spectators:
-        minecraft.sendline('scoreboard players set ' + spectator + ' spectating 1\n')
+    set_score('@a', 'spectating', 0)
+    for spectator in sorted(players & spectators):
+        set_score(spectator, 'spectating', 1)
     # Spread the players
-    minecraft.sendline(
+    send(
         'spreadplayers ' + str(x) + ' ' + str(z) + ' ' + str(int(config['worldborder']['start'] - 1) * 0.4) + ' ' + str(
-            int(config['worldborder']['start'] - 1) / 2) + ' true @a[score_spectating=0]\n')
+            int(config['worldborder']['start'] - 1) / 2) + ' true @a[score_spectating=0]')
     # Start the sun
-    minecraft.sendline('gamerule doDaylightCycle true\n')
+    send('gamerule doDaylightCycle true')
     # Set the appropriate game modes
-    minecraft.sendline('gamemode 0 @a[score_spectating=0]\n')
-    minecraft.sendline('gamemode 3 @a[score_spectating_min=1]\n')
-    minecraft.sendline('tp @a[score_spectating_min=1] ~ 200 ~\n')
+    send('gamemode 0 @a[score_spectating=0]')
+    send('gamemode 3 @a[score_spectating_min=1]')
+    send('tp @a[score_spectating_min=1] ~ 200 ~')
     announce_all('{"text":"The game has begun!","color":"green"}')
 
 
 def victorious(team):
     destroy_lobby()
-    minecraft.sendline('gamemode 3 @a[m=2]\n')
-    minecraft.sendline(
-        'title @a subtitle {"text":"' + teams[team] + ' have won","color":"' + teamcolours[team] + '"}\n')
-    minecraft.sendline('title @a title {"text":"Victorious!","color":"gold"}\n')
-    announce_all('{"text":"' + teams[team] + ' have won UHC","color":"' + teamcolours[team] + '"}')
-    minecraft.sendline(
-        'tellraw @a [{"text":"Congratulations to ","color":"gold"},{"selector":"@a[team=' + str(team) + ']"}]\n')
+    send('gamemode 3 @a[m=2]', lane_critical)
+    send_many([title_message(target='@a', position='subtitle', message=teams[team] + ' have won',
+                             colour=team_colour(team)),
+               title_message(target='@a', position='title', message='Victorious!', colour='gold')], lane_cosmetic)
+    announce_all(coloured_message(message=teams[team] + ' have won UHC', colour=team_colour(team)))
+    stats_end('won', team)
+    send(congratulations_message(team=team), lane_cosmetic)
+    dump_metrics()
 
 
 def all_dead(name):
     destroy_lobby()
-    minecraft.sendline('gamemode 3 @a[m=2]\n')
-    minecraft.sendline('title @a subtitle {"text":"All players are dead.","color":"white"}\n')
-    minecraft.sendline('title @a title {"text":"Game Over","color":"gold"}\n')
+    send('gamemode 3 @a[m=2]', lane_critical)
+    send_many([title_message(target='@a', position='subtitle', message='All players are dead.', colour='white'),
+               title_message(target='@a', position='title', message='Game Over', colour='gold')], lane_cosmetic)
     announce_all_gold(name + ' was the last player standing')
+    stats_end('all dead')
+    dump_metrics()
 
 
-def death(name):
+@timed('death')
+def death(name, killer=None, weapon=None, cause=None):
     if name in dead_players:
         return
+    global match_decided
     dead_players.add(name)
-    team = playerteams.pop(name, None)
-    minecraft.sendline('execute @a ~ ~ ~ playsound minecraft:entity.lightning.impact ambient @a[c=1]\n')
+    journal('dead', name)
+    team = leave_team(name)
+    send('execute @a ~ ~ ~ playsound minecraft:entity.lightning.impact ambient @a[c=1]', lane_cosmetic)
     if team is None:
         return
     if name in players:
         players.remove(name)
-    survivors = 0
-    for member in playerteams:
-        if playerteams[member] == team:
-            survivors += 1
-    if survivors == 0:
-        announce_all('{"text":"' + teams[team] + ' have been eliminated","color":"' + teamcolours[team] + '"}')
-    if len(set(playerteams.values())) == 1:
-        for player in playerteams:
-            victorious(playerteams[player])
-    if len(set(playerteams.values())) == 0:
+    if team not in live_teams:
+        announce_all(coloured_message(message=teams[team] + ' have been eliminated', colour=team_colour(team)))
+    # Only the first team to be left standing wins; nothing that happens afterwards changes that
+    if match_decided:
+        return
+    stats_death(name, team, killer, weapon, cause)
+    if len(live_teams) == 1:
+        match_decided = True
+        journal('set', 'match_decided', True)
+        victorious(next(iter(live_teams)))
+    elif len(live_teams) == 0:
+        match_decided = True
+        journal('set', 'match_decided', True)
         all_dead(name)
 
 
+@timed('player_joins')
 def player_joins(name):
     if name not in players:
         announce_gold(name, 'Welcome, ' + name + '. For UHC command help, say !help in chat.')
         players.add(name)
     # New joiners (after game start) treated as dead
     if name not in players | spectators and time_start is not None:
-        minecraft.sendline('scoreboard players set ' + name + ' dead 1\n')
+        set_score(name, 'dead', 1, lane_critical)
     # Players rejoining after the timeout are made dead
-    if time_start is not None and name in disconnected_players:
-        if time.time() > disconnected_players[name] + timeout:
+    if name in disconnected_players:
+        cancel(('timeout', name))
+        if time_start is not None and clock() > disconnected_players[name] + timeout:
             announce_all_gold(name + ' has been declared dead.')
             death(name)
         del disconnected_players[name]
+        journal('forget', name)
 
 
+@timed('player_leaves')
 def player_leaves(name):
     # Make a note of when a player left (ignoring spectators)
     if name in players - spectators:
-        disconnected_players[name] = time.time()
+        disconnected_players[name] = clock()
+        journal('disconnect', name, disconnected_players[name])
+        if time_start is not None:
+            schedule(('timeout', name), disconnected_players[name] + timeout, disconnect_timeout, name)
+
+
+def refresh_players():
+    query('list', player_list_reply)
+
+
+def player_list_reply(reply):
+    # The reply to list is 'There are n/m players online:' and then the names; on the
+    # console the names are on the next line, and over RCON they follow on the same one
+    if reply is None:
+        return
+    line, following = reply_line(reply, 'There are ')
+    if line is None:
+        return
+    names = line.partition(':')[2].strip() or following.strip()
+    if names != '':
+        log_event(PlayerList(names.split(', ')))
+        player_list(names.split(', '))
+
+
+def player_list(names):
+    # Look for missed players (respond to /list)
+    for name in names:
+        if name not in players:
+            player_joins(name)
+    log('Players detected: ' + ', '.join(sorted(players)))
+
+
+def current_config():
+    # The config, with any changes made in-game
+    settings = dict(config, eternal=dict(config['eternal']), worldborder=dict(config['worldborder']))
+    settings.update({'x': x, 'z': z, 'minutemarker': minute_marker, 'playersperteam': teamsize,
+                     'revealnames': reveal_names, 'timeout': timeout})
+    return settings
 
 
 def save_config(name):
-    config['x'] = x
-    config['z'] = z
-    config['minutemarker'] = minute_marker
-    config['playersperteam'] = teamsize
-    config['revealnames'] = reveal_names
-    config['timeout'] = timeout
-    handle = open(configfile, 'w')
-    handle.write(yaml.dump(config, default_flow_style=False))
-    handle.close()
+    # The file is written by another thread, into a new file that then replaces the old one
+    global config
+    import yaml
+    config = current_config()
+    text = yaml.dump(config, default_flow_style=False)
+    loop.run_in_executor(None, write_file, configfile, text).add_done_callback(
+        functools.partial(config_saved, name, config))
+
+
+def write_file(filename, text):
+    with open(filename + '.new', 'w') as new_file:
+        new_file.write(text)
+        new_file.flush()
+        os.fsync(new_file.fileno())
+    os.replace(filename + '.new', filename)
+
+
+def config_saved(name, settings, future):
+    global config_loaded
+    if future.exception() is not None:
+        announce_gold(name, 'Could not save configuration: ' + str(future.exception()))
+        return
+    # What was saved is what's in the file now, so there's no need to reload it
+    config_loaded = settings
+    config_stamps.update(file_stamps())
     announce_gold(name, 'Configuration saved to ' + configfile)
 
 
-def non_op_help():
-    announce(name,
-             '{"text":"========== ","color":"gold"},{"text":"[","color":"yellow"},' +
-             '{"text":"UHC Help","color":"dark_red"},{"text":"]","color":"yellow"},' +
-             '{"text":" ==========","color":"gold"}')
-    announce(name, '{"text":"!help","color":"white"},{"text":" Show this help","color":"gold"}')
-    announce(name, '{"text":"!utc","color":"white"},{"text":" Show current time (UTC)","color":"gold"}')
-    announce(name, '{"text":"!time","color":"white"},{"text":" Show elapsed game time","color":"gold"}')
-    announce(name, '{"text":"!team","color":"white"},{"text":" Show your team information","color":"gold"}')
-    announce(name, '{"text":"!border","color":"white"},{"text":" Show the world border width","color":"gold"}')
-
-
-def op_help():
-    # Continuation of non-op, but for staff/hosts
-    announce(name, '{"text":"!border","color":"white"},' +
-             '{"text":" (admin) set start, finish, timebegin, duration","color":"gold"}')
-    announce(name, '{"text":"!buildlobby","color":"white"},{"text":" Build and initialise the lobby","color":"gold"}')
-    announce(name, '{"text":"!destroylobby","color":"white"},' +
-             '{"text":" Destroy and de-activate the lobby","color":"gold"}')
-    announce(name, '{"text":"!x","color":"white"},{"text":" Set X coordinate of map centre","color":"gold"}')
-    announce(name, '{"text":"!z","color":"white"},{"text":" Set Z coordinate of map centre","color":"gold"}')
-    announce(name, '{"text":"!save","color":"white"},{"text":" Save configuration","color":"gold"}')
-    announce(name, '{"text":"!minutes","color":"white"},{"text":" Set the time between minute markers","color":"gold"}')
-    announce(name, '{"text":"!teamsize","color":"white"},{"text":" Set number of players per team","color":"gold"}')
-    announce(name, '{"text":"!timeout","color":"white"},' +
-             '{"text":" Set number of seconds that players can be disconnected","color":"gold"}')
-    announce(name, '{"text":"!eternal","color":"white"},' +
-             '{"text":" Set eternal day/night/off (after minutes)","color":"gold"}')
-    announce(name, '{"text":"!revealnames","color":"white"},' +
-             '{"text":" Set delay before players can see enemy name tags","color":"gold"}')
-    announce(name, '{"text":"!spectate","color":"white"},{"text":" View or toggle spectators","color":"gold"}')
-    announce(name, '{"text":"!teamswap","color":"white"},{"text":" Swap two players between teams","color":"gold"}')
-    announce(name, '{"text":"!teamup","color":"white"},{"text":" Generate and assign teams","color":"gold"}')
-    announce(name, '{"text":"!refreshplayers","color":"white"},{"text":" Attempt to redetect players","color":"gold"}')
-    announce(name, '{"text":"!begin","color":"white"},{"text":" Start the game","color":"gold"}')
-    announce(name, '{"text":"!abort","color":"white"},{"text":" Abort and reset running game","color":"gold"}')
-    announce(name, '{"text":"!op","color":"white"},{"text":" Get op on server itself","color":"gold"}')
+def file_stamps():
+    stamps = {}
+    for filename in config_files:
+        try:
+            stat = os.stat(filename)
+            stamps[filename] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamps[filename] = None
+    return stamps
+
+
+def watch_config():
+    # A stat of the config every couple of seconds costs next to nothing, and copes with
+    # editors that save by replacing the file rather than writing into it
+    stamps = file_stamps()
+    if stamps != config_stamps:
+        if config_stamps != {}:
+            reload_config()
+        config_stamps.update(stamps)
+    loop.call_later(2, watch_config)
+
+
+def reload_config():
+    # Settings changed in the file take effect at once, all together. Those that weren't
+    # changed there keep any value they have been given in-game since.
+    global config_loaded
+    import yaml
+    try:
+        settings = load_settings()
+    except (OSError, yaml.YAMLError, ValueError) as e:
+        log('Not reloading the config: ' + str(e))
+        return
+    changed = changed_settings(config_loaded, settings)
+    if changed == []:
+        return
+    live = current_config()
+    for path in changed:
+        # Down to the group the setting is in, copied so that the running config isn't touched
+        source, target = settings, live
+        for group in path[:-1]:
+            source = source[group]
+            target[group] = dict(target.get(group) or {})
+            target = target[group]
+        if path[-1] in source:
+            target[path[-1]] = source[path[-1]]
+        else:
+            target.pop(path[-1], None)
+    old_ops = ops
+    configure(live)
+    config_loaded = settings
+    groups = {path[0] for path in changed}
+    changed = ['.'.join(path) for path in changed]
+    # Ops are spectators by default; anybody toggled in-game stays as they are
+    spectators.difference_update(old_ops - ops)
+    spectators.update(ops - old_ops)
+    if time_start is not None:
+        schedule_game_events()
+    log('Reloaded ' + configfile + ': ' + ', '.join(changed))
+    if config_restart & groups:
+        log('Changes to ' + ', '.join(sorted(config_restart & groups)) + ' take effect on restart')
+
+
+def changed_settings(old, new, path=()):
+    # The settings that differ between old and new, each as a path of keys. Groups such as
+    # worldborder are compared setting by setting, so that changing one leaves the rest alone.
+    changed = []
+    for key in sorted(set(old) | set(new), key=str):
+        if isinstance(old.get(key), dict) and isinstance(new.get(key), dict):
+            changed += changed_settings(old[key], new[key], path + (key,))
+        elif old.get(key) != new.get(key):
+            changed.append(path + (key,))
+    return changed
 
 
 def abort_game():
     global target_time
     global time_start
-    target_time = None
+    global match_decided
+    if time_start is not None and not match_decided:
+        stats_end('aborted')
+    stop_pregen('the match was aborted')
+    target_time = 0
     time_start = None
+    match_decided = False
+    cancel_game_events()
     destroy_teams()
+    journal_snapshot()
     prepare_game()
     build_lobby()
-    minecraft.sendline('clear @a\n')
+    send('clear @a')
     announce_all_gold('Aborting UHC match.')
+    dump_metrics()
 
+
+######################
+# Chat commands. Each is registered with what it takes, who may use it, and how often, and
+# found by name in one lookup. Anything a player types too often is dropped before it costs
+# the server anything.
+
+# Arguments are 'number', 'words' (everything left), or any other name for a single word, as shown
+# in the command's usage. Only the first `required` of them must be given.
+CommandSpec = namedtuple('CommandSpec', 'handler description op arguments required cooldown settings op_description')
+chat_commands = {}
+command_buckets = {}  # (player, command), or (player, None) for all of them -> [tokens, when last topped up]
+player_burst = 5  # Commands a player can send at once, who isn't an op
+player_rate = 1  # and how many a second they can keep up after that
+
+
+def chat_command(command, description, op=False, arguments=(), required=0, cooldown=0, settings=False,
+                 op_description=None):
+    # Decorator, registering a handler(name, args) for !command. A cooldown is the seconds between
+    # one player's uses of it; settings commands are journalled once they've done their work.
+    def register(handler):
+        chat_commands[command] = CommandSpec(handler, description, op, arguments, required, cooldown, settings,
+                                             op_description)
+        return handler
+    return register
+
+
+def usage(command):
+    spec = chat_commands[command]
+    words = ['<' + kind + '>' if n < spec.required else '[' + kind + ']' for n, kind in enumerate(spec.arguments)]
+    return ' '.join(['!' + command] + words)
+
+
+def parse_arguments(spec, args):
+    # Returns the arguments as the command takes them, or None if they won't do
+    words = args.split()
+    if len(words) < spec.required:
+        return None
+    parsed = []
+    for n, kind in enumerate(spec.arguments):
+        if n >= len(words):
+            break
+        if kind == 'words':
+            parsed.append(words[n:])
+        elif kind == 'number':
+            if not words[n].isnumeric():
+                return None
+            parsed.append(int(words[n]))
+        else:
+            parsed.append(words[n])
+    return parsed
+
+
+def take_token(key, burst, rate):
+    # Token bucket: up to burst at once, refilled at rate a second
+    now = clock()
+    bucket = command_buckets.get(key)
+    if bucket is None:
+        bucket = command_buckets[key] = [burst, now]
+    else:
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    if bucket[0] < 1:
+        return False
+    bucket[0] -= 1
+    return True
+
+
+@timed('handle_command')
 def handle_command(name, command, args):
+    command = command.lower()  # Make commands case insensitive
+    spec = chat_commands.get(command)
+    if spec is None or (spec.op and name not in ops):
+        return
+    # Ops aren't limited; they may well need to set a lot up in a hurry
+    if name not in ops and (not take_token((name, None), player_burst, player_rate) or
+                            spec.cooldown > 0 and not take_token((name, command), 1, 1 / spec.cooldown)):
+        counters['chat_limited'] += 1
+        return
+    counters['chat_handled'] += 1
+    parsed = parse_arguments(spec, args)
+    if parsed is None:
+        announce_gold(name, usage(command))
+        return
+    spec.handler(name, parsed)
+    if spec.settings:
+        journal('settings', match_settings())
+
+
+@chat_command('help', 'Show this help', cooldown=5)
+def show_help(name, args):
+    # All of it in one tellraw
+    tell(name, help_lines + op_help_lines if name in ops else help_lines)
+
+
+@chat_command('utc', 'Show current time (UTC)', cooldown=2)
+def show_utc(name, args):
+    announce_gold(name, 'Current UTC time: ' + time.strftime('%H:%M (%A)', time.gmtime(clock())))
+
+
+@chat_command('time', 'Show elapsed game time', cooldown=2)
+def show_time(name, args):
+    if time_start is None:
+        announce_gold(name, 'Game has not started yet')
+    else:
+        announce_gold(name, 'Elapsed time: ' + str(int((clock() - time_start) / 60)) + ' minutes')
+
+
+@chat_command('team', 'Show your team information', cooldown=2)
+def show_own_team(name, args):
+    show_team(name)
+
+
+@chat_command('border', 'Show the world border width', arguments=('word', 'number'), cooldown=2, settings=True,
+              op_description='(admin) set start, finish, timebegin, duration')
+def show_border(name, args):
+    query('worldborder get', lambda reply: announce_gold(
+        name, reply_line(reply or '', 'World border is currently')[0] or 'The server did not say'))
+    if name not in ops or time_start is not None:
+        return
+    if len(args) == 2 and args[0] in {'duration', 'finish', 'start', 'timebegin'}:
+        config['worldborder'][args[0]] = args[1]
+    announce_gold(name, 'World border starting width (start): ' + str(config['worldborder']['start']),
+                  'World border final width (finish): ' + str(config['worldborder']['finish']),
+                  'Minutes until border moves (timebegin): ' + str(config['worldborder']['timebegin']),
+                  'Time taken in minutes to shrink (duration): ' + str(config['worldborder']['duration']))
+
+
+@chat_command('stats', 'Show your statistics, or a player\'s', arguments=('word',), cooldown=5)
+def player_stats(name, args):
+    show_stats(name, args[0] if args != [] else name)
+
+
+# Operator commands
+
+@chat_command('buildlobby', 'Build and initialise the lobby', op=True)
+def lobby(name, args):
+    prepare_game()
+    build_lobby()
+
+
+@chat_command('destroylobby', 'Destroy and de-activate the lobby', op=True)
+def no_lobby(name, args):
+    destroy_lobby()
+
+
+@chat_command('x', 'Set X coordinate of map centre', op=True, arguments=('number',), settings=True)
+def set_x(name, args):
     global x
+    if args == []:
+        announce_gold(name, 'Centre X is currently ' + str(x))
+        return
+    x = args[0]
+    announce_gold(name, 'X set to ' + str(x))
+    send('worldborder center ' + str(x) + ' ' + str(z))
+
+
+@chat_command('z', 'Set Z coordinate of map centre', op=True, arguments=('number',), settings=True)
+def set_z(name, args):
     global z
-    command = command.lower()  # Make commands case insensitive
-    if command == 'help':
-        non_op_help()
-    if command == 'utc':
-        announce_gold(name, 'Current UTC time: ' + time.strftime('%H:%M (%A)', time.gmtime()))
-    if command == 'time':
-        if time_start is None:
-            announce_gold(name, 'Game has not started yet')
-        else:
-            announce_gold(name, 'Elapsed time: ' + str(int((time.time() - time_start) / 60)) + ' minutes')
-    if command == 'team':
-        show_team(name)
-    if command == 'border':
-        worldborder_announce.add(name)
-        minecraft.sendline('worldborder get\n')
-    # Operator commands
-    if name in config['ops']:
-        if command == 'help':
-            op_help()
-        if command == 'buildlobby':
-            prepare_game()
-            build_lobby()
-        if command == 'destroylobby':
-            destroy_lobby()
-        if command == 'x':
-            if args.isnumeric():
-                x = int(args)
-                announce_gold(name, 'X set to ' + str(x))
-                minecraft.sendline('worldborder center ' + str(x) + ' ' + str(z) + '\n')
-            else:
-                announce_gold(name, 'Centre X is currently ' + str(x))
-        if command == 'z':
-            if args.isnumeric():
-                z = int(args)
-                announce_gold(name, 'Z set to ' + str(z))
-                minecraft.sendline('worldborder center ' + str(x) + ' ' + str(z) + '\n')
-            else:
-                announce_gold(name, 'Centre Z is currently ' + str(z))
-        if command == 'minutes':
-            if args.isnumeric():
-                global minute_marker
-                minute_marker = int(args)
-            announce_gold(name, 'Minute marker set to every ' + str(minute_marker) + ' minutes')
-        if command == 'revealnames':
-            if args.isnumeric():
-                global reveal_names
-                reveal_names = int(args)
-            announce_gold(name, 'Enemy name tags visible after ' + str(reveal_names) + ' minutes')
-        if command == 'teamsize':
-            if args.isnumeric():
-                global teamsize
-                teamsize = int(args)
-            announce_gold(name, 'Team size is set to ' + str(teamsize) + ' players')
-        if command == 'timeout':
-            if args.isnumeric():
-                global timeout
-                timeout = int(args)
-            announce_gold(name, 'Death on disconnect timeout is set to ' + str(timeout) + ' seconds')
-        if command == 'eternal':
-            subc, suba = '', ''
-            if args != '':
-                subc = args.split()[0]
-                if args != subc:
-                    suba = args.split()[1]
-            if subc in {'day', 'night', 'off'}:
-                config['eternal']['mode'] = subc
-                announce_gold(name, 'Sun stops at permanent state: ' + subc.capitalize())
-                if suba.isnumeric():
-                    config['eternal']['timebegin'] = int(suba)
-                    announce_gold(name, 'This takes place after ' + suba + ' minutes')
-                else:
-                    announce_gold(name, 'This takes place after ' + str(config['eternal']['timebegin']) + ' minutes')
-            elif subc.isnumeric():
-                announce_gold(name, 'Sun stops at permanent state: ' + config['eternal']['mode'].capitalize())
-                config['eternal']['timebegin'] = int(subc)
-                announce_gold(name, 'This takes place after ' + subc + ' minutes')
-            else:
-                announce_gold(name, 'Sun stops at permanent state: ' + config['eternal']['mode'].capitalize())
-                announce_gold(name, 'This takes place after ' + str(config['eternal']['timebegin']) + ' minutes')
-        if command == 'save':
-            save_config(name)
-        if command == 'begin':
-            begin_game()
-        if command == 'abort':
-            abort_game()
-        if command == 'border' and time_start is None:
-            subc, suba = '', ''
-            if args != '':
-                subc = args.split()[0]
-                if args != subc:
-                    suba = args.split()[1]
-            if subc in {'duration', 'finish', 'start', 'timebegin'}:
-                if suba.isnumeric():
-                    config['worldborder'][subc] = int(suba)
-            announce_gold(name, 'World border starting width (start): ' + str(config['worldborder']['start']))
-            announce_gold(name, 'World border final width (finish): ' + str(config['worldborder']['finish']))
-            announce_gold(name, 'Minutes until border moves (timebegin): ' + str(config['worldborder']['timebegin']))
-            announce_gold(name, 'Time taken in minutes to shrink (duration): ' + str(config['worldborder']['duration']))
-        if command == 'teamup':
-            create_teams()
-        if command == 'teamswap':
-            if args != '':
-                player1 = args.split()[0]
-                if args != player1:
-                    player2 = args.split()[1]
-                    swap_team_member(player1, player2)
-                    announce_gold(name, 'Swapped ' + player1 + ' and ' + player2)
-                else:
-                    announce_gold(name, '!teamswap player1 player2')
-            else:
-                announce_gold(name, '!teamswap player1 player2')
-        if command == 'spectate':
-            spectate(name, args)
-        if command == 'refreshplayers':
-            minecraft.sendline('list\n')
-        if command == 'op':
-            minecraft.sendline('op ' + name + '\n')
+    if args == []:
+        announce_gold(name, 'Centre Z is currently ' + str(z))
+        return
+    z = args[0]
+    announce_gold(name, 'Z set to ' + str(z))
+    send('worldborder center ' + str(x) + ' ' + str(z))
+
+
+@chat_command('save', 'Save configuration', op=True)
+def save_settings(name, args):
+    save_config(name)
+
+
+@chat_command('minutes', 'Set the time between minute markers', op=True, arguments=('number',), settings=True)
+def set_minutes(name, args):
+    global minute_marker
+    if args != []:
+        minute_marker = args[0]
+        schedule_game_events()
+    announce_gold(name, 'Minute marker set to every ' + str(minute_marker) + ' minutes')
+
+
+@chat_command('teamsize', 'Set number of players per team', op=True, arguments=('number',), settings=True)
+def set_teamsize(name, args):
+    global teamsize
+    if args != [] and args[0] > 0:
+        teamsize = args[0]
+    announce_gold(name, 'Team size is set to ' + str(teamsize) + ' players')
+
+
+@chat_command('timeout', 'Set number of seconds that players can be disconnected', op=True, arguments=('number',),
+              settings=True)
+def set_timeout(name, args):
+    global timeout
+    if args != []:
+        timeout = args[0]
+        schedule_game_events()
+    announce_gold(name, 'Death on disconnect timeout is set to ' + str(timeout) + ' seconds')
+
+
+@chat_command('eternal', 'Set eternal day/night/off (after minutes)', op=True, arguments=('word', 'word'),
+              settings=True)
+def set_eternal(name, args):
+    if len(args) > 0 and args[0] in {'day', 'night', 'off'}:
+        config['eternal']['mode'] = args[0]
+        if len(args) > 1 and args[1].isnumeric():
+            config['eternal']['timebegin'] = int(args[1])
+    elif len(args) > 0 and args[0].isnumeric():
+        config['eternal']['timebegin'] = int(args[0])
+    announce_gold(name, 'Sun stops at permanent state: ' + config['eternal']['mode'].capitalize(),
+                  'This takes place after ' + str(config['eternal']['timebegin']) + ' minutes')
+    schedule_game_events()
+
+
+@chat_command('revealnames', 'Set delay before players can see enemy name tags', op=True, arguments=('number',),
+              settings=True)
+def set_reveal_names(name, args):
+    global reveal_names
+    if args != []:
+        reveal_names = args[0]
+        schedule_game_events()
+    announce_gold(name, 'Enemy name tags visible after ' + str(reveal_names) + ' minutes')
+
+
+@chat_command('spectate', 'View or toggle spectators', op=True, arguments=('words',))
+def toggle_spectators(name, args):
+    spectate(name, args[0] if args != [] else [])
+
+
+@chat_command('teamswap', 'Swap two players between teams', op=True, arguments=('player1', 'player2'), required=2)
+def teamswap(name, args):
+    swap_team_member(args[0], args[1])
+    announce_gold(name, 'Swapped ' + args[0] + ' and ' + args[1])
+
+
+@chat_command('teamup', 'Generate and assign teams', op=True)
+def teamup(name, args):
+    create_teams()
+
+
+@chat_command('refreshplayers', 'Attempt to redetect players', op=True)
+def redetect_players(name, args):
+    refresh_players()
+
+
+@chat_command('begin', 'Start the game', op=True)
+def begin(name, args):
+    begin_game()
+
+
+@chat_command('abort', 'Abort and reset running game', op=True)
+def abort(name, args):
+    abort_game()
+
+
+@chat_command('pregen', 'Pregenerate the map inside the starting border, or stop', op=True, arguments=('stop',))
+def pregenerate(name, args):
+    if args == ['stop']:
+        stop_pregen('stopped by ' + name)
+    elif pregen is not None:
+        announce_gold(name, pregen.progress())
+    elif time_start is not None:
+        announce_gold(name, 'Pregeneration is for before the match begins')
+    else:
+        start_pregen(name)
+
+
+@chat_command('lag', 'Show how well the server is keeping up', op=True)
+def show_lag(name, args):
+    announce_gold(name, *lag_report())
+
+
+@chat_command('op', 'Get op on server itself', op=True)
+def give_op(name, args):
+    send('op ' + name)
+
+
+# Help is the same every time, so it's filled in once, here
+help_lines = [
+    '{"text":"========== ","color":"gold"},{"text":"[","color":"yellow"},{"text":"UHC Help","color":"dark_red"},' +
+    '{"text":"]","color":"yellow"},{"text":" ==========","color":"gold"}'] + [
+    help_message(command=command, description=spec.description)
+    for command, spec in chat_commands.items() if not spec.op]
+# Continuation of non-op, but for staff/hosts
+op_help_lines = [help_message(command=command, description=spec.op_description or spec.description)
+                 for command, spec in chat_commands.items() if spec.op or spec.op_description is not None]
 
 
 def fix_name(name):
     # Spigot, with team colours
-    if name[0] == '?':
+    if name[:1] == '?':
         return name[2:-2]
     # Vanilla, with team colours
-    if name[0] == '§':
+    if name[:1] == '§':
         return name[2:-2]
     # No colours
     else:
@@ -689,165 +2140,1259 @@ def fix_name(name):
 
 
 ######################
-# Action begins here #
+# Scheduled tasks    #
 ######################
 
-# Spawn the server
-minecraft = pexpect.spawn(commandline, timeout=None, encoding=None, env={"TERM": "dumb"})
-running = minecraft.isalive()
-
-while running:
-
-    # I'll mention it here. All my sendline() commands send an extra '\n' at the end. This is
-    # so that the command as typed by pexpect doesn't interfere with the pattern
-    # matching in this section, which is heavily dependent on line endings.
-    # This does result in one "Unknown command" per command, because Minecraft does not
-    # ignore empty commands. So, they're filtered after the regex matching, toward the end.
-
-    # Read Minecraft console.
-    result = minecraft.expect([
-        # result == 0
-        pexpect.EOF,
-        # result == 1
-        pexpect.TIMEOUT,
-        # result == 2
-        # If pexpect was non-greedy (as documented) this would match one line.
-        # spoiler: It can match several.
-        '^.*\r\n'
-    ], timeout=10)  # The timeout stops this thing blocking, lets us do other things
-
-    # Show all unmatched output
-    print(minecraft.before.replace(b'\r', b'').decode(), end='')
-
-    if result == 0:
-        running = False
-    elif result == 1:
-        # expect was blocking, so just do nothing here. No-op.
-        pass
-    elif result == 2:
-        # To remove in production; assert that '^.*\r\n' left nothing out in front
-        assert (minecraft.before == b'')
-
-        # pexpect docs insist that its regex matching is 100% non-greedy.
-        # This is not true at all. It'll randomly be greedy.
-        # So, we cannot assume that we only got one line. Decode and split.
-        lines = minecraft.after.replace(b'\r', b'').decode().split('\n')
-
-        # Now we can examine each line of output in turn.
-        for line in lines:
-            # First, strip out the prefix (time, thread, info/warn) and
-            # separate it, with ANSI colour codes
-            m = regexp['info'].match(line)
-            if m is not None:
-                line = line.replace(m.group(), '')
-                prefix = '\033[32m' + m.group() + '\033[m'
-            else:
-                m = regexp['warn'].match(line)
-                if m is not None:
-                    line = line.replace(m.group(), '')
-                    prefix = '\033[33m' + m.group() + '\033[m'
-                else:
-                    prefix = ''
-
-            # If the world/spawn was just prepared, then prepare it for UHC
-            # m = regexp['done'].match(line)
-            # if m != None:
-            #    prepareGame()
-
-            # Check if a player has logged in
-            m = regexp['connect'].match(line)
-            if m is not None:
-                nameip = m.group().split(' ')[0]
-                name = nameip.split('[')[0]
-                ip = nameip.split('/')[1].split(':')[0]
-                player_joins(name)
-
-            # Check if a player has left the game
-            m = regexp['disconnect'].match(line)
-            if m is not None:
-                name = m.group().split()[0]
-                player_leaves(name)
-
-            # Look for a command
-            m = regexp['command'].match(line)
-            if m is not None:
-                # First word, chop off the < and >, and run through the team colour stripper
-                name = fix_name(m.group().split()[0][1:-1])
-                # Everything right of the bang
-                command = m.group().split('!')[1]
-                # Any arguments
-                args = line.replace(m.group(), '').lstrip()
-                handle_command(name, command, args)
-
-            # Look for a world border announcement
-            m = regexp['border'].match(line)
-            if m is not None:
-                for name in worldborder_announce:
-                    announce_gold(name, line)
-                worldborder_announce.clear()
-
-            # Look for missed players (respond to /list)
-            m = regexp['playerlist'].match(line)
-            if m is not None and line != 'list':  # 'list' matches a command we use, and isn't likely to be a player )-:
-                for name in m.group().split(', '):
-                    if name not in players:
-                        player_joins(name)
-                print('Players detected: ', players)
-
-            # Look for player deaths
-            m = regexp['death'].match(line)
-            if m is not None:
-                death(fix_name(m.group().split()[0]))
-
-            # Output the line, complete with prefix, for console watchers
-            if len(line) > 0 and regexp['unknown'].match(line) is None:
-                # Ignore the "Unknown command" warnings from our empty lines
-                if line[-1] == '\n':
-                    print(prefix + line, end='')
-                else:
-                    print(prefix + line, end='\n')
-
-    # Scheduled tasks!
-    if time_start is not None:
-        t = time.time()
-        minutes_elapsed = int((t - time_start) / 60)
-        # Show the minute marker
+def schedule(key, when, callback, *args):
+    # Run callback at the wall clock time when, replacing anything already scheduled under key
+    cancel(key)
+    now = clock()
+    timers[key] = loop.call_later(max(0, when - now), fire, key, max(when, now), callback, args)
+
+
+def fire(key, when, callback, args):
+    del timers[key]
+    observe('timer', key[0] if isinstance(key, tuple) else key, max(0, clock() - when))
+    callback(*args)
+
+
+def cancel(key):
+    handle = timers.pop(key, None)
+    if handle is not None:
+        handle.cancel()
+
+
+def schedule_game_events():
+    # (Re)schedule everything still to come in a running game, e.g. after its settings change
+    if time_start is None or loop is None:
+        return
+    global target_time
+    if minute_marker > 0:
         if target_time < time_start:
             target_time = time_start + minute_marker * 60
-        if t > target_time:
-            minecraft.sendline('execute @a ~ ~ ~ playsound minecraft:entity.firework.launch ambient @a[c=1]\n')
-            announce_all_gold('Minute marker: ' + str(minutes_elapsed) + ' minutes')
+            journal('set', 'target_time', target_time)
+        schedule('minutemarker', target_time, minute_marker_reached)
+    if flag_visibility:
+        schedule('revealnames', time_start + reveal_names * 60, reveal_nametags)
+    if flag_eternal:
+        schedule('eternal', time_start + config['eternal']['timebegin'] * 60, eternal_sun)
+    if flag_border:
+        schedule('worldborder', time_start + config['worldborder']['timebegin'] * 60, shrink_border)
+    for name in disconnected_players:
+        schedule(('timeout', name), disconnected_players[name] + timeout, disconnect_timeout, name)
+
+
+def cancel_game_events():
+    for key in list(timers):
+        if key not in background_timers:
+            cancel(key)
+
+
+def minute_marker_reached():
+    global target_time
+    minutes_elapsed = int((clock() - time_start) / 60)
+    send('execute @a ~ ~ ~ playsound minecraft:entity.firework.launch ambient @a[c=1]', lane_cosmetic)
+    announce_all_gold('Minute marker: ' + str(minutes_elapsed) + ' minutes')
+    target_time += minute_marker * 60
+    journal('set', 'target_time', target_time)
+    if minute_marker > 0:
+        schedule('minutemarker', target_time, minute_marker_reached)
+
+
+def reveal_nametags():
+    # Make nametags visible
+    global flag_visibility
+    send_many([command for team in sorted(teams) for command in team_options(team, nametagVisibility='always')])
+    announce_all_gold('Your nametags are now visible to the enemy.')
+    flag_visibility = False
+    journal('set', 'flag_visibility', False)
+
+
+def eternal_sun():
+    # Eternal day/night
+    global flag_eternal
+    if config['eternal']['mode'] == 'day':
+        send('gamerule doDaylightCycle false')
+        send('time set 6000')
+        announce_all_gold('Eternal day has begun.')
+    if config['eternal']['mode'] == 'night':
+        send('gamerule doDaylightCycle false')
+        send('time set 18000')
+        announce_all_gold('Eternal night has begun.')
+    flag_eternal = False
+    journal('set', 'flag_eternal', False)
+
+
+def shrink_border():
+    global flag_border
+    send('worldborder set ' + str(config['worldborder']['finish']) + ' ' + str(
+        config['worldborder']['duration'] * 60), lane_critical)
+    announce_all_gold('The world border has started shrinking.')
+    flag_border = False
+    journal('set', 'flag_border', False)
+
+
+def disconnect_timeout(name):
+    # A player has been disconnected too long
+    if time_start is None or name not in disconnected_players:
+        return
+    announce_all_gold(name + ' has been declared dead.')
+    del disconnected_players[name]
+    journal('forget', name)
+    death(name, None, None, 'disconnected')
+    set_score(name, 'dead', 1, lane_critical)
+
+
+######################
+# Lag monitor. Every few seconds the server is asked something simple, and the time it takes
+# to answer is averaged; the server's own "Can't keep up!" warnings say how far behind it has
+# fallen. Together these set how fast commands are sent, so that big batches of them are
+# spread out while the server is struggling. Critical commands are always sent at full speed.
+
+lag_probe_every = 5  # Seconds between probes, while the server is keeping up
+lag_window = 60  # Seconds over which the server's warnings are counted
+lag_target = 0.1  # Round trips slower than this slow the commands down
+lag_warnings = deque()  # (when, milliseconds behind) for each warning in the window
+lag_behind = 0  # and the total of those milliseconds
+lag_round_trip = None  # The last probe's round trip, and the rolling average of them
+lag_average = None
+command_throttle = 1.0  # Fraction of command_rate used for all but critical commands
+
+
+def ticks_per_second():
+    # 20 is full speed; the server makes up for lost time by skipping ticks
+    global lag_behind
+    now = clock()
+    while len(lag_warnings) > 0 and lag_warnings[0][0] < now - lag_window:
+        lag_behind -= lag_warnings.popleft()[1]
+    behind = lag_behind / 1000
+    return 20 * lag_window / (lag_window + behind)
+
+
+def update_throttle():
+    global command_throttle
+    health = min(1, (ticks_per_second() / 20) ** 2, lag_target / lag_average if lag_average else 1)
+    command_throttle = max(0.1, health)
+
+
+def server_lagging(behind):
+    global lag_behind
+    lag_warnings.append((clock(), behind))
+    lag_behind += behind
+    update_throttle()
+
+
+def start_lag_monitor():
+    schedule('lag', clock() + lag_probe_every, lag_probe)
+
+
+def lag_probe():
+    query('worldborder get', functools.partial(lag_answered, clock()), silent=True)
+
+
+def lag_answered(asked, reply):
+    global lag_round_trip, lag_average
+    lag_round_trip = clock() - asked
+    lag_average = lag_round_trip if lag_average is None else lag_average * 0.7 + lag_round_trip * 0.3
+    update_throttle()
+    # Look again sooner while the server is struggling, so as to notice when it recovers
+    schedule('lag', clock() + (lag_probe_every if command_throttle == 1 else 1), lag_probe)
+
+
+def lag_report():
+    lines = ['Server running at ' + str(round(ticks_per_second(), 1)) + ' ticks a second, ' +
+             str(len(lag_warnings)) + ' lag warnings in the last minute']
+    if lag_round_trip is not None:
+        lines.append('Console round trip ' + str(round(lag_round_trip * 1000)) + 'ms, averaging ' +
+                     str(round(lag_average * 1000)) + 'ms')
+    lines.append('Sending up to ' + str(round(command_rate * command_throttle)) + ' commands a second' +
+                 (' (slowed down)' if command_throttle < 1 else '') + ', ' + str(sum(map(len, outbound))) + ' waiting')
+    return lines
+
+
+######################
+# Pregeneration. Before a match, an op in spectator mode is taken round the area inside the
+# starting world border, in a spiral out from the centre, so that the server generates the map
+# then, rather than while everybody is being spread out. After each teleport, the server is
+# asked something simple until it answers promptly, before moving on. Progress is saved now
+# and then, so that a run that's interrupted carries on from where it got to.
+
+pregen = None  # The run in progress, if any
+pregen_settle = 1  # Seconds after a teleport before asking whether the server has caught up
+pregen_busy = 0.15  # An answer slower than this means it hasn't
+pregen_report_every = 30  # Seconds between progress reports
+pregen_checkpoint_every = 10  # Teleports between checkpoints
+
+
+def spiral(rings):
+    # Grid positions out to rings from (0, 0), each next to the one before
+    positions = [(0, 0)]
+    for ring in range(1, rings + 1):
+        positions += [(ring, dz) for dz in range(-ring + 1, ring + 1)]
+        positions += [(dx, ring) for dx in range(ring - 1, -ring - 1, -1)]
+        positions += [(-ring, dz) for dz in range(ring - 1, -ring - 1, -1)]
+        positions += [(dx, -ring) for dx in range(-ring + 1, ring + 1)]
+    return positions
+
+
+class Pregeneration:
+    def __init__(self, name):
+        self.name = name
+        self.area = {'x': x, 'z': z, 'size': config['worldborder']['start'], 'step': config['pregen']['step']}
+        self.positions = spiral(math.ceil(self.area['size'] / 2 / self.area['step']))
+        self.done = 0
+        self.resumed = 0  # Where this run started from
+        self.started = clock()
+        self.reported = self.started
+        self.asked = None  # When the server was last asked whether it had caught up
+
+    def progress(self):
+        text = ('Pregenerated ' + str(self.done) + ' of ' + str(len(self.positions)) + ' areas (' +
+                str(self.done * 100 // len(self.positions)) + '%)')
+        if self.done > self.resumed:
+            left = (clock() - self.started) / (self.done - self.resumed) * (len(self.positions) - self.done)
+            minutes = math.ceil(left / 60)
+            text += ', about ' + (str(minutes) + ' minutes' if minutes > 1 else 'a minute') + ' to go'
+        return text
+
+
+def pregen_checkpoint_path():
+    return os.path.join(directory, config['pregen']['checkpoint'])
+
+
+def start_pregen(name):
+    # Carries on from the checkpoint, if it was for the same area
+    global pregen
+    pregen = Pregeneration(name)
+    try:
+        with open(pregen_checkpoint_path()) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if {key: checkpoint.get(key) for key in pregen.area} == pregen.area:
+            pregen.done = pregen.resumed = min(int(checkpoint['done']), len(pregen.positions))
+    except (OSError, ValueError, KeyError):
+        pass
+    send('gamemode 3 ' + name, lane_critical)
+    announce_gold(name, ('Resuming' if pregen.done > 0 else 'Starting') + ' pregeneration of ' +
+                  str(len(pregen.positions)) + ' areas, ' + str(pregen.area['step']) + ' blocks apart',
+                  pregen.progress())
+    log('Pregeneration started by ' + name + ': ' + pregen.progress())
+    pregen_step()
+
+
+def stop_pregen(reason):
+    global pregen
+    if pregen is None:
+        return
+    cancel('pregen')
+    save_pregen_checkpoint()
+    log('Pregeneration stopped (' + reason + '): ' + pregen.progress())
+    if pregen.name in players:
+        announce_gold(pregen.name, 'Pregeneration stopped (' + reason + '). !pregen carries on from here.')
+    pregen = None
+
+
+def save_pregen_checkpoint():
+    checkpoint = dict(pregen.area, done=pregen.done)
+    loop.run_in_executor(None, write_file, pregen_checkpoint_path(), json.dumps(checkpoint))
+
+
+def pregen_step():
+    # Teleport to the next position, then wait for the server to catch up
+    if pregen is None:
+        return
+    if pregen.name not in players:
+        stop_pregen(pregen.name + ' left')
+        return
+    if pregen.done >= len(pregen.positions):
+        finish_pregen()
+        return
+    dx, dz = pregen.positions[pregen.done]
+    send('tp ' + pregen.name + ' ' + str(pregen.area['x'] + dx * pregen.area['step']) + ' 128 ' +
+         str(pregen.area['z'] + dz * pregen.area['step']), lane_critical)
+    schedule('pregen', clock() + pregen_settle, pregen_probe)
+
+
+def pregen_probe():
+    pregen.asked = clock()
+    query('worldborder get', functools.partial(pregen_answered, pregen), silent=True)
+
+
+def pregen_answered(run, reply):
+    if run is not pregen:
+        return  # Stopped while waiting
+    latency = clock() - pregen.asked
+    observe('pregen_probe', '', latency)
+    # Still busy generating; ask again in a while, waiting longer the slower it is
+    if reply is None or latency > pregen_busy:
+        schedule('pregen', clock() + max(pregen_settle, latency * 4), pregen_probe)
+        return
+    pregen.done += 1
+    if pregen.done % pregen_checkpoint_every == 0:
+        save_pregen_checkpoint()
+    if clock() - pregen.reported >= pregen_report_every:
+        pregen.reported = clock()
+        announce_gold(pregen.name, pregen.progress())
+    pregen_step()
+
+
+def finish_pregen():
+    global pregen
+    log('Pregeneration finished in ' + str(math.ceil((clock() - pregen.started) / 60)) + ' minutes')
+    announce_gold(pregen.name, 'Pregeneration finished. The map is ready.')
+    send('tp ' + pregen.name + ' ' + str(x) + ' 253 ' + str(z + 2))
+    send('gamemode 2 ' + pregen.name)
+    try:
+        os.remove(pregen_checkpoint_path())
+    except FileNotFoundError:
+        pass
+    pregen = None
+
+
+######################
+# Journal. Every change to the match's state is appended to a file, by a thread of its
+# own, so that a wrapper restarted mid-match can pick up where it left off. Now and then
+# the whole state is written as a snapshot, and the file starts again from there.
+
+journal_path = None  # Not journalling until recover() has read what's already there
+journal_queue = deque()
+journal_ready = threading.Condition()
+journal_records = 0
+journal_snapshot_every = 1000
+journal_globals = {'time_start', 'target_time', 'flag_border', 'flag_visibility', 'flag_eternal', 'match_decided'}
+
+
+def journal(op, *args):
+    # Costs the caller an append; encoding and writing happen on the journal thread
+    global journal_records
+    if journal_path is None:
+        return
+    with journal_ready:
+        journal_queue.append((op,) + args)
+        journal_ready.notify()
+    journal_records += 1
+    if journal_records >= journal_snapshot_every:
+        journal_snapshot()
+
+
+def journal_snapshot():
+    global journal_records
+    if journal_path is None:
+        return
+    journal_records = 0
+    state = {'time_start': time_start, 'target_time': target_time, 'flag_border': flag_border,
+             'flag_visibility': flag_visibility, 'flag_eternal': flag_eternal, 'match_decided': match_decided,
+             'teams': sorted(teams.items()), 'playerteams': dict(playerteams), 'dead': sorted(dead_players),
+             'disconnected': dict(disconnected_players), 'spectators': sorted(spectators),
+             'settings': match_settings()}
+    with journal_ready:
+        journal_queue.append(('snapshot', state))
+        journal_ready.notify()
+
+
+def match_settings():
+    # Settings that can be changed in-game, and that the game's timing depends on
+    return {'x': x, 'z': z, 'minutemarker': minute_marker, 'playersperteam': teamsize, 'revealnames': reveal_names,
+            'timeout': timeout, 'eternal': dict(config['eternal']), 'worldborder': dict(config['worldborder'])}
+
+
+def journal_writer():
+    # Opened when first needed, and again after any failure, so that a journal that can't be
+    # written is logged each time, and the queue is still drained
+    journal_file = None
+    while True:
+        with journal_ready:
+            while len(journal_queue) == 0:
+                journal_ready.wait()
+            records = list(journal_queue)
+            journal_queue.clear()
+        # A snapshot makes everything before it redundant, so the file is replaced
+        snapshots = [n for n in range(len(records)) if records[n][0] == 'snapshot']
+        start = snapshots[-1] if snapshots != [] else 0
+        text = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records[start:])
+        try:
+            if snapshots != []:
+                if journal_file is not None:
+                    journal_file.close()
+                    journal_file = None
+                with open(journal_path + '.new', 'w') as new_journal:
+                    new_journal.write(text)
+                    new_journal.flush()
+                    os.fsync(new_journal.fileno())
+                os.replace(journal_path + '.new', journal_path)
+            else:
+                if journal_file is None:
+                    journal_file = open(journal_path, 'a')
+                journal_file.write(text)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+        except OSError as e:
+            log('Could not write to the journal: ' + str(e))
+            if journal_file is not None:
+                journal_file.close()
+                journal_file = None
+
+
+def replay(record):
+    # Apply one journal record to the match's state
+    global x, z, minute_marker, teamsize, reveal_names, timeout
+    op, args = record[0], record[1:]
+    if op == 'snapshot':
+        state = args[0]
+        for name in journal_globals:
+            globals()[name] = state[name]
+        clear_teams()
+        teams.update(state['teams'])
+        for name, team in state['playerteams'].items():
+            join_team(name, team)
+        dead_players.clear()
+        dead_players.update(state['dead'])
+        disconnected_players.clear()
+        disconnected_players.update(state['disconnected'])
+        spectators.clear()
+        spectators.update(state['spectators'])
+        replay(('settings', state['settings']))
+    elif op == 'set' and args[0] in journal_globals:
+        globals()[args[0]] = args[1]
+    elif op == 'clear':
+        clear_teams()
+    elif op == 'teams':
+        teams.update(args[0])
+    elif op == 'join':
+        join_team(args[0], args[1])
+    elif op == 'leave':
+        leave_team(args[0])
+    elif op == 'dead':
+        dead_players.add(args[0])
+    elif op == 'undead':
+        dead_players.clear()
+    elif op == 'disconnect':
+        disconnected_players[args[0]] = args[1]
+    elif op == 'forget':
+        disconnected_players.pop(args[0], None)
+    elif op == 'spectators':
+        spectators.clear()
+        spectators.update(args[0])
+    elif op == 'settings':
+        settings = args[0]
+        x, z, minute_marker = settings['x'], settings['z'], settings['minutemarker']
+        teamsize, reveal_names, timeout = settings['playersperteam'], settings['revealnames'], settings['timeout']
+        config['eternal'].update(settings['eternal'])
+        config['worldborder'].update(settings['worldborder'])
+
+
+def recover():
+    # Rebuild the match from its journal, if it has one, then carry on journalling
+    global journal_path, target_time
+    if not config.get('journal'):
+        return
+    path = os.path.join(directory, config['journal'])
+    start = time.perf_counter()
+    records = 0
+    try:
+        with open(path, 'r') as old_journal:
+            for line in old_journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # Half a line, written as the wrapper died
+                replay(record)
+                records += 1
+    except FileNotFoundError:
+        pass
+    journal_path = path
+    threading.Thread(target=journal_writer, name='journal writer', daemon=True).start()
+    journal_snapshot()
+    if time_start is None:
+        return
+    if match_decided:
+        # Won, or lost, before the wrapper stopped; there is nothing left to time
+        log('The match in ' + path + ' had already finished, so is not resumed')
+        return
+    log('Recovered a match in progress from ' + path + ': ' + str(len(teams)) + ' teams, ' +
+        str(len(playerteams)) + ' players alive, ' + str(records) + ' records in ' +
+        str(round((time.perf_counter() - start) * 1000, 1)) + 'ms')
+    # Minute markers missed while the wrapper was down are skipped, rather than all announced at once
+    if minute_marker > 0:
+        while target_time < clock():
             target_time += minute_marker * 60
-        # Make nametags visible
-        if flag_visibility and minutes_elapsed >= reveal_names:
-            for team in playerteams:
-                minecraft.sendline('scoreboard teams option ' + str(playerteams[team]) + ' nametagVisibility always\n')
-            announce_all_gold('Your nametags are now visible to the enemy.')
-            flag_visibility = False
-        # Eternal day/night
-        if flag_eternal and minutes_elapsed >= config['eternal']['timebegin']:
-            if config['eternal']['mode'] == 'day':
-                minecraft.sendline('gamerule doDaylightCycle false\n')
-                minecraft.sendline('time set 6000\n')
-                announce_all_gold('Eternal day has begun.')
-            if config['eternal']['mode'] == 'night':
-                minecraft.sendline('gamerule doDaylightCycle false\n')
-                minecraft.sendline('time set 18000\n')
-                announce_all_gold('Eternal night has begun.')
-            flag_eternal = False
-        # Worldborder
-        if flag_border and minutes_elapsed >= config['worldborder']['timebegin']:
-            minecraft.send('worldborder set ' + str(config['worldborder']['finish']) + ' ' + str(
-                config['worldborder']['duration'] * 60) + '\n')
-            announce_all_gold('The world border has started shrinking.')
-            flag_border = False
-        # Players who've been disconnected too long
-        deleted = set()
-        for name in disconnected_players:
-            if time.time() > disconnected_players[name] + timeout:
-                announce_all_gold(name + ' has been declared dead.')
-                deleted.add(name)
-                death(name)
-                minecraft.sendline('scoreboard players set ' + name + ' dead 1\n')
-        for name in deleted:
-            del disconnected_players[name]
+    schedule_game_events()
+    # Once there's a server to ask, find out who is still there
+    loop.call_soon(refresh_players)
+
+
+######################
+# Statistics. Each match's kills, deaths, eliminations and result are kept in an SQLite
+# database, for standings across many matches. Writes are queued, and made in batches by
+# a thread of their own, which also keeps a summary up to date for !stats to answer from.
+
+stats_path = None  # Not recording until open_stats() has been called
+stats_thread = None
+stats_queue = deque()
+stats_ready = threading.Condition()
+stats_summary = {'players': {}, 'killers': []}  # Replaced whole by the writer, never changed in place
+stats_batch_wait = 1  # Seconds for a batch of writes to build up
+stats_queued = 0  # Statements ever queued, and ever run, so flush_stats knows when it's caught up
+stats_done = 0
+
+stats_tables = '''
+CREATE TABLE IF NOT EXISTS matches (id TEXT PRIMARY KEY, name TEXT, season TEXT, started REAL, finished REAL,
+                                    result TEXT, winner TEXT, teamsize INTEGER, teams INTEGER, players INTEGER);
+CREATE TABLE IF NOT EXISTS players (match TEXT, player TEXT, team TEXT, place INTEGER, died REAL, killer TEXT,
+                                    weapon TEXT, cause TEXT, PRIMARY KEY (match, player));
+CREATE TABLE IF NOT EXISTS teams (match TEXT, team TEXT, size INTEGER, place INTEGER, PRIMARY KEY (match, team));
+CREATE TABLE IF NOT EXISTS kills (match TEXT, at REAL, killer TEXT, victim TEXT, weapon TEXT, cause TEXT);
+CREATE INDEX IF NOT EXISTS matches_season ON matches (season, teamsize);
+CREATE INDEX IF NOT EXISTS players_player ON players (player);
+CREATE INDEX IF NOT EXISTS kills_killer ON kills (killer, match);
+CREATE INDEX IF NOT EXISTS kills_match ON kills (match);
+'''
+
+
+def stats(statement, *parameters):
+    # Costs the caller an append; the statement is run on the statistics thread
+    global stats_queued
+    if stats_path is None:
+        return
+    with stats_ready:
+        stats_queue.append((statement, parameters))
+        stats_queued += 1
+        stats_ready.notify()
+
+
+def flush_stats():
+    # Wait for everything queued so far to be written, e.g. before exiting
+    target = stats_queued
+    while stats_done < target and stats_thread is not None and stats_thread.is_alive():
+        time.sleep(0.05)
+
+
+def match_id():
+    # Matches are told apart by when they began, which the journal keeps across a restart
+    return (match_name or 'uhc') + '-' + str(int(time_start * 1000))
+
+
+def stats_begin():
+    match = match_id()
+    stats('INSERT OR REPLACE INTO matches (id, name, season, started, teamsize, teams, players) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?)', match, match_name, config['stats']['season'], time_start, teamsize,
+          len(live_teams), len(playerteams))
+    for team in live_teams:
+        stats('INSERT OR REPLACE INTO teams (match, team, size) VALUES (?, ?, ?)', match, teams[team],
+              len(teammembers[team]))
+    for name, team in playerteams.items():
+        stats('INSERT OR REPLACE INTO players (match, player, team) VALUES (?, ?, ?)', match, name, teams[team])
+
+
+def stats_death(name, team, killer, weapon, cause):
+    # A player's place is how many were left, counting them. Deaths before the match starts don't count.
+    if time_start is None:
+        return
+    match = match_id()
+    stats('UPDATE players SET place = ?, died = ?, killer = ?, weapon = ?, cause = ? WHERE match = ? AND player = ?',
+          len(playerteams) + 1, clock(), killer, weapon, cause, match, name)
+    if killer is not None and killer != name and (killer in playerteams or killer in dead_players):
+        stats('INSERT INTO kills VALUES (?, ?, ?, ?, ?, ?)', match, clock(), killer, name, weapon, cause)
+    if team not in live_teams:
+        stats('UPDATE teams SET place = ? WHERE match = ? AND team = ?', len(live_teams) + 1, match, teams[team])
+
+
+def stats_end(result, team=None):
+    if time_start is None:
+        return
+    match = match_id()
+    if team is not None:
+        stats('UPDATE teams SET place = 1 WHERE match = ? AND team = ?', match, teams[team])
+        stats('UPDATE players SET place = 1 WHERE match = ? AND team = ? AND place IS NULL', match, teams[team])
+    stats('UPDATE matches SET finished = ?, result = ?, winner = ? WHERE id = ?', clock(), result,
+          teams[team] if team is not None else None, match)
+
+
+def open_stats():
+    global stats_path, stats_thread
+    if not config['stats']['file']:
+        return
+    stats_path = os.path.join(directory, config['stats']['file'])
+    stats_thread = threading.Thread(target=stats_writer, name='statistics writer', daemon=True)
+    stats_thread.start()
+
+
+def stats_writer():
+    global stats_summary, stats_done, stats_path
+    import sqlite3
+    database = None
+    try:
+        database = sqlite3.connect(stats_path, timeout=30)
+        # Supervised matches, in this process or others, can share one database
+        database.execute('PRAGMA journal_mode=WAL')
+        database.executescript(stats_tables)
+        stats_summary = summarise_stats(database, config['stats']['season'])
+    except sqlite3.Error as e:
+        log('Could not open the statistics database: ' + str(e))
+        if database is None:
+            # Nowhere to write them, so statistics stop being kept
+            stats_path = None
+            return
+    while True:
+        with stats_ready:
+            while len(stats_queue) == 0:
+                stats_ready.wait()
+        time.sleep(stats_batch_wait)
+        with stats_ready:
+            statements = list(stats_queue)
+            stats_queue.clear()
+        # One transaction for the whole batch
+        try:
+            with database:
+                for statement, parameters in statements:
+                    database.execute(statement, parameters)
+            stats_summary = summarise_stats(database, config['stats']['season'])
+        except sqlite3.Error as e:
+            log('Could not write ' + str(len(statements)) + ' statistics: ' + str(e))
+        stats_done += len(statements)
+
+
+def leaderboards(database, season=None):
+    # Standings across finished matches, of one season or all of them. Each is a list of rows.
+    where = 'matches.finished IS NOT NULL' + (' AND matches.season = ?' if season else '')
+    parameters = (season,) if season else ()
+    return {
+        'killers': database.execute(
+            'SELECT kills.killer, COUNT(*) FROM kills JOIN matches ON matches.id = kills.match WHERE ' + where +
+            ' GROUP BY kills.killer ORDER BY COUNT(*) DESC, kills.killer LIMIT 10', parameters).fetchall(),
+        'winners': database.execute(
+            'SELECT players.player, COUNT(*) FROM players JOIN matches ON matches.id = players.match WHERE ' + where +
+            ' AND players.team = matches.winner GROUP BY players.player ORDER BY COUNT(*) DESC, players.player LIMIT 10',
+            parameters).fetchall(),
+        'survival': database.execute(
+            'SELECT matches.teamsize, AVG(COALESCE(players.died, matches.finished) - matches.started) / 60, COUNT(*) '
+            'FROM players JOIN matches ON matches.id = players.match WHERE ' + where +
+            ' GROUP BY matches.teamsize ORDER BY matches.teamsize', parameters).fetchall(),
+        'players': database.execute(
+            'SELECT players.player, COUNT(*), SUM(players.team IS matches.winner), SUM(players.died IS NOT NULL), '
+            'AVG(COALESCE(players.died, matches.finished) - matches.started) / 60, '
+            '(SELECT COUNT(*) FROM kills JOIN matches ON matches.id = kills.match WHERE ' + where +
+            ' AND kills.killer = players.player) '
+            'FROM players JOIN matches ON matches.id = players.match WHERE ' + where +
+            ' GROUP BY players.player', parameters * 2).fetchall(),
+    }
+
+
+def summarise_stats(database, season):
+    boards = leaderboards(database, season)
+    return {'killers': boards['killers'][:5],
+            'players': {row[0]: row[1:] for row in boards['players']}}
+
+
+def show_stats(name, player):
+    # Answered from the summary; the database isn't touched
+    summary = stats_summary
+    season = config['stats']['season']
+    if player in summary['players']:
+        played, won, died, survived, kills = summary['players'][player]
+        lines = [player + (' this season' if season else '') + ': ' + str(played) + ' matches, ' + str(won) +
+                 ' won, ' + str(kills) + ' kills, ' + str(died) + ' deaths, average survival ' +
+                 str(int(survived or 0)) + ' minutes']
+    else:
+        lines = ['No finished matches for ' + player]
+    if summary['killers'] != []:
+        lines.append('Top killers: ' + ', '.join(killer + ' ' + str(kills) for killer, kills in summary['killers']))
+    announce_gold(name, *lines)
+
+
+def print_stats(season):
+    # For --stats; reads the database directly
+    if not config['stats']['file']:
+        raise SystemExit('Set stats: file in ' + configfile + ' to keep statistics')
+    path = os.path.join(directory, config['stats']['file'])
+    if not os.path.exists(path):
+        raise SystemExit('No statistics in ' + path)
+    import sqlite3
+    with sqlite3.connect(path) as database:
+        boards = leaderboards(database, season)
+    print('Top killers' + (' in ' + season if season else ''))
+    for killer, kills in boards['killers']:
+        print('  {:<20} {:>5}'.format(killer, kills))
+    print('Most wins')
+    for player, wins in boards['winners']:
+        print('  {:<20} {:>5}'.format(player, wins))
+    print('Average survival by team size')
+    for size, minutes, count in boards['survival']:
+        print('  {:<20} {:>5.1f} minutes ({} players)'.format(str(size) + ' per team', minutes, count))
+
+
+######################
+# Console reading    #
+######################
+
+record_file = None  # Where the console is being recorded, if it is
+
+
+def start_recording(path):
+    # For uhc_replay.py. The settings come first, then each read of the console, with when it was
+    # read. Anything that isn't UTF-8 is kept as escapes, so that every byte comes back.
+    global record_file
+    record_file = open(path, 'w', buffering=1)
+    record_file.write(json.dumps({'start': clock(), 'config': current_config()}) + '\n')
+
+
+# Lines are framed on bytes, in place. Only those that might be an event are decoded and
+# handled here; runs of the rest are handed to the log writer as they are, to be shown.
+console_buffer = bytearray()  # What's been read, up to and including any partial line
+console_chunk = bytearray(65536)  # Every read goes into this
+console_chunk_view = memoryview(console_chunk)
+
+# Matches, after any prefix that regexp['prefix'] would strip (vanilla's '[12:00:00] [Server thread/INFO]: '
+# or Spigot's '[12:00:00 INFO]: '), the start of every line that classify, collect_reply or handle_line
+# could take an interest in. It may match more than that, but never less.
+regexp.sources['candidate'] = (
+    rb"(?:>*\[[0-9]+:[0-9]+:[0-9]+[^\n]*?(?:INFO|WARN)\]: )?" +
+    rb"(?:<.+> !|World border is currently|RCON running on|Can't keep up!|" +
+    re.escape(('Player ' + sentinel).encode()) + rb'|\w+\[/[^ ]*\] logged in|\w+ lost connection: |' +
+    rb'[^ \r\n]+ (?:' + b'|'.join(re.escape(word.encode()) for word in death_trie[0]) + rb')(?:[ \r]|$))')
+
+
+def read_console():
+    # Called by the event loop whenever the server has written something
+    try:
+        size = os.readv(minecraft.child_fd, [console_chunk])
+    except OSError:  # The pty reports EIO once the server has gone
+        size = 0
+    if size == 0:
+        loop.remove_reader(minecraft.child_fd)
+        flush_console()
+        server_stopped()
+        return
+    feed_console(console_chunk_view[:size])
+
+
+def feed_console(data):
+    # Takes any bytes-like object, e.g. a slice of the read buffer
+    global console_idle_since
+    start = time.perf_counter()
+    if console_idle_since is not None:
+        observe('console_wait', '', start - console_idle_since)
+    if record_file is not None:
+        record_file.write(json.dumps([clock(), bytes(data).decode('utf-8', 'surrogateescape')]) + '\n')
+    console_buffer.extend(data)
+    # Any partial line is kept until the rest of it arrives
+    end = console_buffer.rfind(b'\n') + 1
+    if end > 0:
+        with memoryview(console_buffer) as view:
+            count_lines(frame_lines(view, end))
+        del console_buffer[:end]
+    console_idle_since = time.perf_counter()
+    observe('console_read', '', console_idle_since - start)
+
+
+def frame_lines(view, end):
+    # Handles the whole lines in view[:end], and returns how many there were
+    buffer = console_buffer
+    match = regexp['candidate'].match
+    shown = 0  # Start of the run of lines that only need showing
+    start = 0
+    count = 0
+    while start < end:
+        stop = buffer.find(b'\n', start, end)
+        count += 1
+        # Until a query's reply is complete, every line might be part of it
+        if query_open is not None or match(buffer, start, stop) is not None:
+            if shown < start:
+                show_console(bytes(view[shown:start]))
+            line_end = stop - 1 if stop > start and buffer[stop - 1] == 13 else stop
+            handle_safely(str(view[start:line_end], 'utf-8', 'replace'))
+            shown = stop + 1
+        start = stop + 1
+    if shown < end:
+        show_console(bytes(view[shown:end]))
+    return count
+
+
+def handle_safely(line):
+    # A line that a handler fails on is logged and left behind. The lines around it are still
+    # handled, and none of them twice, however the failure comes about.
+    try:
+        handle_line(line)
+    except Exception:
+        import traceback
+        log('Error handling ' + repr(line) + ':\n' + traceback.format_exc().rstrip())
+
+
+def flush_console():
+    if len(console_buffer) > 0:
+        handle_safely(console_buffer.replace(b'\r', b'').decode(errors='replace'))
+    console_buffer.clear()
+
+
+def server_stopped():
+    # The server has gone, so there's nothing left to do. A supervisor has other matches, and replaces this.
+    loop.stop()
+
+
+######################
+# Logging. Console output, and the record of events, are written in batches by a thread
+# of their own, so that a burst of output can never hold up reading the server.
+
+log_queue = deque()
+log_ready = threading.Event()
+log_queued = 0  # Items ever queued, and ever written, so flush_log knows when it's caught up
+log_written = 0
+log_thread = None
+
+
+def log(text):
+    # Output for console watchers. A supervised match labels its lines, and keeps its own log.
+    if match_name is not None:
+        text = '[' + match_name + '] ' + text
+    queue_log(None, text)
+
+
+def show_console(data):
+    # Console lines, as bytes, that are only to be shown. The log writer decodes them.
+    queue_log(None, data)
+
+
+def console_text(data):
+    # The lines given to show_console, as log would have shown each of them
+    text = []
+    for line in data.decode(errors='replace').replace('\r', '').split('\n'):
+        prefix, line = split_prefix(line)
+        if line != '':
+            if match_name is not None:
+                text.append('[' + match_name + '] ' + colour_prefix(prefix) + line + '\n')
+            else:
+                text.append(colour_prefix(prefix) + line + '\n')
+    return ''.join(text)
+
+
+def log_event(event):
+    # Keep a record of something that happened, if events: file is set
+    if config['events']['file'] != '':
+        queue_log(clock(), event)
+
+
+def queue_log(when, item):
+    # deque appends are thread safe, so there's no lock to take; the writer is only woken if it's asleep
+    global log_queued, log_thread
+    log_queue.append((when, item))
+    log_queued += 1
+    if not log_ready.is_set():
+        log_ready.set()
+    if log_thread is None:
+        log_thread = threading.Thread(target=log_writer, name='log writer', daemon=True)
+        log_thread.start()
+
+
+def flush_log():
+    # Wait for everything logged so far to be written, e.g. before exiting
+    target = log_queued
+    while log_written < target and log_thread is not None and log_thread.is_alive():
+        time.sleep(0.01)
+
+
+def log_writer():
+    global log_written
+    events_file = None
+    while True:
+        log_ready.wait()
+        log_ready.clear()
+        # Let a burst build up, to be written all at once
+        time.sleep(0.01)
+        items = []
+        while len(log_queue) > 0:
+            items.append(log_queue.popleft())
+        text = []
+        events = []
+        for when, item in items:
+            if when is None and isinstance(item, bytes):
+                text.append(console_text(item))
+            elif when is None:
+                text.append(item + '\n')
+            else:
+                record = {'time': round(when, 3), 'type': type(item).__name__}
+                if match_name is not None:
+                    record['match'] = match_name
+                record.update(item._asdict())
+                events.append(json.dumps(record, separators=(',', ':')) + '\n')
+        try:
+            if text != []:
+                output = ''.join(text)
+                sys.stdout.write(output)
+                sys.stdout.flush()
+                if log_file is not None:
+                    log_file.write(re.sub('\033\\[[0-9;]*m', '', output))
+                    log_file.flush()
+            if events != []:
+                if events_file is None:
+                    events_path = os.path.join(directory, config['events']['file'])
+                    events_file = open(events_path, 'a')
+                events_file.write(''.join(events))
+                events_file.flush()
+                if events_file.tell() >= config['events']['maxbytes']:
+                    events_file.close()
+                    events_file = None
+                    rotate_events(events_path, config['events']['keep'])
+        except (OSError, ValueError) as e:
+            sys.stderr.write('Logging failed: ' + str(e) + '\n')
+        log_written += len(items)
+
+
+def rotate_events(path, keep):
+    # The full file is compressed to .1.gz; older ones move up one, and the oldest goes
+    import gzip
+    import shutil
+    for n in range(keep - 1, 0, -1):
+        if os.path.exists(path + '.' + str(n) + '.gz'):
+            os.replace(path + '.' + str(n) + '.gz', path + '.' + str(n + 1) + '.gz')
+    with open(path, 'rb') as plain, gzip.open(path + '.1.gz', 'wb') as packed:
+        shutil.copyfileobj(plain, packed)
+    os.remove(path)
+
+
+######################
+# Attach mode. Rather than running the server, follow its log file and send
+# commands by RCON or through a named pipe, so the wrapper can be restarted alone.
+
+class PipeTransport:
+    # Writes commands into a named pipe that feeds the server's console
+    replies = False
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    def send(self, command):
+        for attempt in range(2):
+            try:
+                if self.handle is None:
+                    self.handle = self.open()
+                self.handle.write(command + '\n')
+                return
+            except BrokenPipeError:
+                self.handle = None
+        raise ConnectionError('Nothing is reading ' + self.path)
+
+    def open(self):
+        # Blocks until something is reading the pipe. Nothing is created: commands written to
+        # an ordinary file in its place would go nowhere, so a missing pipe is an error.
+        import stat
+        fd = os.open(self.path, os.O_WRONLY)
+        if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+            os.close(fd)
+            raise ConnectionError(self.path + ' is not a named pipe')
+        return os.fdopen(fd, 'w', buffering=1)
+
+
+class LogTail:
+    # Follows a log file as it grows. Inotify on its directory says when to look,
+    # falling back to looking every second where inotify isn't available. When the
+    # server starts a new log, the old one is finished off and the new one read from its start.
+    in_modify, in_moved_from, in_moved_to, in_create, in_delete = 0x2, 0x40, 0x80, 0x100, 0x200
+    poll_interval = 1
+
+    def __init__(self, path, callback):
+        self.path = path
+        self.callback = callback
+        self.handle = None
+        self.inotify = None
+
+    def start(self):
+        self.open(from_start=False)
+        self.inotify = self.watch(os.path.dirname(os.path.abspath(self.path)))
+        if self.inotify is not None:
+            loop.add_reader(self.inotify, self.notified)
+        else:
+            loop.call_later(self.poll_interval, self.poll)
+
+    def watch(self, directory):
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            return None
+        if fd < 0:
+            return None
+        mask = self.in_modify | self.in_moved_from | self.in_moved_to | self.in_create | self.in_delete
+        if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def notified(self):
+        # Which file changed doesn't matter; there's only one we're interested in
+        try:
+            while os.read(self.inotify, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        self.read()
+
+    def poll(self):
+        self.read()
+        loop.call_later(self.poll_interval, self.poll)
+
+    def open(self, from_start):
+        try:
+            self.handle = open(self.path, 'rb', buffering=0)
+        except FileNotFoundError:
+            self.handle = None
+            return
+        if not from_start:
+            # Attaching part way through; what's already logged has been dealt with
+            self.handle.seek(0, os.SEEK_END)
+
+    def read(self):
+        if self.handle is not None:
+            self.drain()
+            try:
+                rotated = os.stat(self.path).st_ino != os.fstat(self.handle.fileno()).st_ino or \
+                          os.stat(self.path).st_size < self.handle.tell()
+            except FileNotFoundError:
+                rotated = True
+            if not rotated:
+                return
+            self.handle.close()
+            flush_console()
+        self.open(from_start=True)
+        if self.handle is not None:
+            self.drain()
+
+    def drain(self):
+        while True:
+            data = self.handle.read(65536)
+            if not data:
+                return
+            self.callback(data)
+
+
+def handle_line(line):
+    # First, strip out the prefix (time, thread, info/warn) and
+    # separate it, with ANSI colour codes
+    prefix, line = split_prefix(line)
+
+    # If the world/spawn was just prepared, then prepare it for UHC
+    # m = regexp['done'].match(line)
+    # if m != None:
+    #    prepareGame()
+
+    # Replies to queries are passed to whoever asked. Sentinels are neither events nor worth showing,
+    # including those of a query that has already timed out.
+    if (len(queries) > 0 or line.startswith('Player ' + sentinel)) and collect_reply(line):
+        return
+
+    start = time.perf_counter()
+    event = classify(line)
+    observe('classify', type(event).__name__, time.perf_counter() - start)
+    # The server's answer to a silent query is neither recorded nor shown. Anything else that
+    # happens to arrive in the middle of it, a death or a chat command, still is.
+    quiet = query_open in quiet_queries and isinstance(event, (Other, BorderReport, PlayerList))
+    if not isinstance(event, Other) and not quiet:
+        log_event(event)
+    if isinstance(event, Join):
+        player_joins(event.name)
+    elif isinstance(event, Leave):
+        player_leaves(event.name)
+    elif isinstance(event, ChatCommand):
+        handle_command(event.name, event.command, event.args)
+    elif isinstance(event, Death):
+        death(*event)
+    elif isinstance(event, LagWarning):
+        server_lagging(event.behind)
+    elif line.startswith('RCON running on') and config.get('transport') == 'rcon':
+        use_rcon()
+
+    # Output the line, complete with prefix, for console watchers
+    if len(line) > 0 and not quiet:
+        log(colour_prefix(prefix) + line)
+
+
+######################
+# Action begins here #
+######################
+
+def attach(logfile):
+    global transport
+    if config.get('transport') == 'pipe':
+        transport = PipeTransport(os.path.join(directory, config['pipe']))
+    elif config.get('transport') == 'rcon':
+        transport = RconClient(config['rcon'].get('host', 'localhost'), int(config['rcon'].get('port', 25575)),
+                               str(config['rcon'].get('password', '')))
+    else:
+        raise SystemExit('Attach mode needs transport: rcon or transport: pipe in ' + configfile)
+    threading.Thread(target=command_writer, name='command writer', daemon=True).start()
+    LogTail(logfile, feed_console).start()
+    log('Attached to ' + logfile)
+
+
+def spawn():
+    global minecraft
+    global transport
+    import pexpect
+    # Spawn the server. Commands aren't echoed back, so they never need filtering out of its output.
+    minecraft = pexpect.spawn(commandline, cwd=directory, timeout=None, encoding=None, env={"TERM": "dumb"},
+                              echo=False)
+    minecraft.delaybeforesend = None
+    transport = ConsoleTransport()
+    threading.Thread(target=command_writer, name='command writer', daemon=True).start()
+    loop.add_reader(minecraft.child_fd, read_console)
+
+
+######################
+# Supervisor mode. Several matches, each on its own server, run from one process and share
+# one event loop. Each match is a separate instance of this module, with globals of its own.
+
+matches = {}  # Name -> the match's instance of this module
+running = set()  # Names of matches whose servers are still up
+
+
+def match_config(section, shared=None):
+    # A match has the shared settings, overridden by its own section of matches:, overridden
+    # in turn by any uhc_wrapper.yml in its directory (which is where its !save writes)
+    settings = {key: value for key, value in (shared or config).items() if key != 'matches'}
+    settings.update(section)
+    import yaml
+    own = os.path.join(section['directory'], configfile)
+    if os.path.abspath(own) != os.path.abspath(configfile) and os.path.exists(own):
+        with open(own, 'r') as own_config:
+            settings.update(yaml.safe_load(own_config))
+    return validate_config(settings)
+
+
+def load_match_settings(name):
+    # A supervised match's settings, read afresh from the shared config and its own
+    shared = load_settings()
+    for section in shared['matches']:
+        if str(section.get('name')) == name:
+            return match_config(section, shared)
+    raise ValueError('match ' + name + ' is no longer listed under matches:')
+
+
+def start_match(section):
+    name = str(section['name'])
+    if 'directory' not in section:
+        raise SystemExit('Match ' + name + ' needs a directory: of its own for its server')
+    try:
+        match = engine(match_config(section), 'uhc_match_' + name)
+    except ValueError as e:
+        raise SystemExit('Problem with the settings for match ' + name + ': ' + str(e))
+    match.directory = section['directory']
+    match.configfile = os.path.join(match.directory, configfile)
+    match.config_files = [configfile, match.configfile]
+    match.load_settings = functools.partial(load_match_settings, name)
+    match.match_name = name
+    match.metric_labels = 'match="' + name + '"'
+    match.log_file = open(section.get('log', name + '.log'), 'a', buffering=1)
+    match.loop = loop
+    match.server_stopped = functools.partial(match_stopped, name)
+    matches[name] = match
+    running.add(name)
+    match.recover()
+    match.open_stats()
+    match.watch_config()
+    if 'attach' in section:
+        match.attach(os.path.join(match.directory, section['attach']))
+    else:
+        match.spawn()
+    match.start_lag_monitor()
+
+
+def match_stopped(name):
+    running.discard(name)
+    matches[name].log('Server has stopped')
+    if len(running) == 0:
+        loop.stop()
+
+
+def run_matches(sections, worker=0):
+    global loop
+    import asyncio
+    loop = asyncio.new_event_loop()
+    start_metrics(worker)
+    for section in sections:
+        start_match(section)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+        for match in matches.values():
+            match.flush_stats()
+            match.flush_log()
+        flush_log()
+
+
+def supervise(workers):
+    # With more than one worker, the matches are shared out between that many processes,
+    # for when there is more console output than one process can keep up with
+    sections = config.get('matches') or []
+    if sections == []:
+        raise SystemExit('Supervisor mode needs a list of matches: in ' + configfile)
+    if workers <= 1:
+        run_matches(sections)
+        return
+    import multiprocessing
+    processes = [multiprocessing.Process(target=run_matches, args=(sections[worker::workers], worker),
+                                         name='uhc worker ' + str(worker))
+                 for worker in range(min(workers, len(sections)))]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+def main(argv=None):
+    # The command line. Everything it needs is imported and read here, not when the module is.
+    global loop
+    import argparse
+    import asyncio
+    parser = argparse.ArgumentParser(description='Runs a Minecraft server as an Ultra Hardcore match')
+    parser.add_argument('--attach', nargs='?', const='logs/latest.log', metavar='LOGFILE',
+                        help='follow the log of a server that is already running, instead of starting one')
+    parser.add_argument('--supervise', action='store_true', help='run every match listed under matches:')
+    parser.add_argument('--workers', type=int, default=1, help='processes to share supervised matches between')
+    parser.add_argument('--record', metavar='FILE', help='record the console, to be replayed by uhc_replay.py')
+    parser.add_argument('--stats', nargs='?', const='', metavar='SEASON',
+                        help='print the leaderboards, for one season or all of them, and exit')
+    arguments = parser.parse_args(argv)
+    try:
+        setup(load_settings())
+    except ValueError as e:
+        raise SystemExit('Problem with ' + configfile + ': ' + str(e))
+    if arguments.stats is not None:
+        print_stats(arguments.stats)
+        return
+    if arguments.supervise:
+        supervise(arguments.workers)
+        return
+
+    # Nothing polls. The loop sleeps until the server writes something or a timer is due.
+    loop = asyncio.new_event_loop()
+    if arguments.record is not None:
+        start_recording(arguments.record)
+    start_metrics()
+    recover()
+    open_stats()
+    watch_config()
+    if arguments.attach is not None:
+        attach(arguments.attach)
+    else:
+        spawn()
+    start_lag_monitor()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+        flush_stats()
+        flush_log()
+
+
+if __name__ == '__main__':
+    main()